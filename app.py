@@ -1,29 +1,44 @@
+import argparse
 import asyncio
+import importlib
+import multiprocessing
 import os
 import json
+import secrets
+import tempfile
 
 from pathlib import Path
+from typing import Optional
 import aioschedule
-from aiogram import Bot, Dispatcher, executor, types
-from aiogram.types import KeyboardButton
-
-from converbot.bot_utils import parse_context, create_conversation_from_context
-from converbot.constants import DEFAULT_CONFIG_PATH
-from converbot.database import ConversationDB
-
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import KeyboardButton
 from aiogram.utils import executor
+from aiohttp import web
 
-CONVERSATIONS_DB = ConversationDB()
-
-API_TOKEN = (Path(__file__).parent / "token.txt").read_text().strip().replace("\n", "")
-
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dispatcher = Dispatcher(bot, storage=storage)
+from converbot.admission import set_admission_user
+from converbot.constants import DEFAULT_CONFIG_PATH, NO_CHATBOT_RESPONSE
+from converbot.database import ConversationDB
+from converbot.metrics import get_metrics, start_metrics_server
+from converbot.onboarding import PersonaPreprocessor
+from converbot.reply import ProgressiveReply, TimedBot
+from converbot.sharding import ShardRouter, serve_shard
+from converbot.turn_queue import TurnQueue
+from converbot.webhook import WebhookServer
+
+# The language model stack (langchain, openai) and numpy, for retrieval, are imported on first use
+# or by warm_up, see create_app
+LANGUAGE_MODEL_MODULES = ("converbot.bot_utils", "converbot.llm_registry", "converbot.resilience", "numpy")
+
+# Built by create_app, nothing is built when the module is imported
+CONVERSATIONS_DB: Optional[ConversationDB] = None
+TURN_QUEUE: Optional[TurnQueue] = None
+PERSONA_PREPROCESSOR: Optional[PersonaPreprocessor] = None
+bot: Optional[TimedBot] = None
+dispatcher: Optional[Dispatcher] = None
 
 RESTART_KEYBOARD = types.ReplyKeyboardMarkup(
     keyboard=[[KeyboardButton('/start')], [KeyboardButton('/debug')]], resize_keyboard=True,
@@ -31,139 +46,178 @@ RESTART_KEYBOARD = types.ReplyKeyboardMarkup(
 )
 
 IS_DEBUG = False
+# The local port serving the metrics in the Prometheus format, disabled if None
+METRICS_PORT = None
+METRICS_RUNNER = None
+
+class SharedLLMSessionMiddleware(BaseMiddleware):
+    """
+    Make LLM calls of every handled update reuse the pooled HTTP session of the registry and
+    charge them to the user of the update for the admission control.
+    """
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        from converbot.llm_registry import get_registry
+
+        await get_registry().bind_session()
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        set_admission_user(message.from_user.id if message.from_user is not None else None)
+
+
+class ErrorShown(Exception):
+    """
+    Raised by a handler that already showed its error to the user, ``try_`` sends nothing more.
+    """
+
+
+def error_reply(e: Exception) -> str:
+    from converbot.resilience import CircuitOpenError
+
+    if isinstance(e, CircuitOpenError) or 'overloaded with other requests' in str(e).lower():
+        return '\nPlease, try again later, We are currently under heavy load'
+    return '\nSomething went wrong, please type \"/start\" to start over'
+
 
 def try_(func):
+    # LLM calls are retried by the call policy of the registry, a failed handler is not run again
     async def try_except(message):
-        error=''
-        for i in range(4):
-            try:
-                await func(message)
-                return None
-            except Exception as e:
-                print(e)
-                error=str(e).lower()
-                pass
-            await asyncio.sleep(1)
-        if 'overloaded with other requests' in error:
-            await bot.send_message(message.from_user.id, '\nPlease, try again later, We are currently under heavy load')
-        else:
-            await bot.send_message(message.from_user.id, '\nSomething went wrong, please type \"/start\" to start over')
+        from converbot.resilience import CircuitOpenError
+
+        try:
+            await func(message)
+            return None
+        except ErrorShown:
+            return None
+        except CircuitOpenError as e:
+            error = e
+        except Exception as e:
+            print(e)
+            error = e
+        await bot.send_message(message.from_user.id, error_reply(error))
         return None
 
     return try_except
 
 
-@dispatcher.message_handler(commands=["start"])
+# Define the states for the onboarding conversation
+class BotInfo(StatesGroup):
+    name = State()
+    age = State()
+    gender = State()
+    interest = State()
+    profession = State()
+    appearance = State()
+    relationship = State()
+    mood = State()
+
+
 @try_
 async def start(message: types.Message):
     """
     This handler will be called when user sends /start command
     """
-
-    # Define the states for the conversation
-    class BotInfo(StatesGroup):
-        name = State()
-        age = State()
-        gender = State()
-        interest = State()
-        profession = State()
-        appearance = State()
-        relationship = State()
-        mood = State()
-
     # Set the initial state to 'name'
     await BotInfo.name.set()
+    PERSONA_PREPROCESSOR.discard(message.from_user.id)
 
     # Ask for the bot's name
     await bot.send_message(message.from_user.id, text="Welcome to Neece.ai\n"
                                                       "Let’s take a moment to describe the AI persona you want to talk to.")
     await bot.send_message(message.from_user.id, text="What is the name you want to give your companion?")
 
-    # Define the handler for the bot's name
-    @dispatcher.message_handler(state=BotInfo.name)
-    async def process_name(message: types.Message, state: FSMContext):
-        async with state.proxy() as data:
-            data['name'] = message.text
-        await BotInfo.age.set()
-        await bot.send_message(message.from_user.id, text="What is their age?")
-
-    @dispatcher.message_handler(state=BotInfo.age, content_types=types.ContentTypes.TEXT)
-    async def process_age(message: types.Message, state: FSMContext):
-        if not message.text.isdigit():
-            return await message.reply("Age should be a number.\nHow old is your bot?")
-        async with state.proxy() as data:
-            data['age'] = message.text
-        await BotInfo.gender.set()
-        await bot.send_message(message.from_user.id, text="What gender?")
-
-    @dispatcher.message_handler(state=BotInfo.gender)
-    async def process_gender(message: types.Message, state: FSMContext):
-        async with state.proxy() as data:
-            data['gender'] = message.text
-            # You can use the data dictionary here to create your bot object with the collected information
-        await BotInfo.interest.set()
-        await bot.send_message(message.from_user.id, text="What do they like to do for fun?")
-
-    @dispatcher.message_handler(state=BotInfo.interest)
-    async def process_interest(message: types.Message, state: FSMContext):
-        async with state.proxy() as data:
-            data['interest'] = message.text
-        await BotInfo.profession.set()
-        await bot.send_message(message.from_user.id, text="What is their profession?")
-
-    @dispatcher.message_handler(state=BotInfo.profession)
-    async def process_profession(message: types.Message, state: FSMContext):
-        async with state.proxy() as data:
-            data['profession'] = message.text
-        await BotInfo.appearance.set()
-        await bot.send_message(message.from_user.id, text="What do they look like?")
-
-    @dispatcher.message_handler(state=BotInfo.appearance)
-    async def process_appearance(message: types.Message, state: FSMContext):
-        async with state.proxy() as data:
-            data['appearance'] = message.text
-        await BotInfo.relationship.set()
-        await bot.send_message(message.from_user.id, text="What is their relationship status?")
-
-    @dispatcher.message_handler(state=BotInfo.relationship)
-    async def process_relationship(message: types.Message, state: FSMContext):
-        async with state.proxy() as data:
-            data['relationship'] = message.text
-        await BotInfo.mood.set()
-        await bot.send_message(message.from_user.id, text="Thank you. Finally, describe their personality.")
-
-    @dispatcher.message_handler(state=BotInfo.mood)
-    async def process_mood(message: types.Message, state: FSMContext):
-        async with state.proxy() as data:
-            data['mood'] = message.text
-            # You can use the data dictionary here to create your bot object with the collected information
-        context, tone = await show_data(message)
-        await bot.send_message(message.from_user.id, text=context)
-        # Try to handle context
-        await state.finish()
-        await bot.send_message(message.from_user.id, text="Thank you! Bot information has been saved. One moment...")
-        await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-#       await asyncio.sleep(1.5)
-#       await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-#       await asyncio.sleep(1)
-
-#       await bot.send_message(message.from_user.id,
-#                              text="Lets start the conversation, can you tell me a little about yourself?")
-        if CONVERSATIONS_DB.exists(message.from_user.id) is False:
-            conversation = create_conversation_from_context(context, tone, config_path=DEFAULT_CONFIG_PATH)
-            CONVERSATIONS_DB.add_conversation(message.from_user.id, conversation)
-            CONVERSATIONS_DB.write_chat_history(message.from_user.id, message.text, chatbot_response="None")
-            await bot.send_message(message.from_user.id,
-                                    text="Lets start the conversation, can you tell me a little about yourself?")
-            return None
 
-        CONVERSATIONS_DB.remove_conversation(message.from_user.id)
+async def process_name(message: types.Message, state: FSMContext):
+    async with state.proxy() as data:
+        data['name'] = message.text
+    await BotInfo.age.set()
+    await bot.send_message(message.from_user.id, text="What is their age?")
+
+
+async def process_age(message: types.Message, state: FSMContext):
+    if not message.text.isdigit():
+        return await message.reply("Age should be a number.\nHow old is your bot?")
+    async with state.proxy() as data:
+        data['age'] = message.text
+    await BotInfo.gender.set()
+    await bot.send_message(message.from_user.id, text="What gender?")
+
+
+async def process_gender(message: types.Message, state: FSMContext):
+    async with state.proxy() as data:
+        data['gender'] = message.text
+        # You can use the data dictionary here to create your bot object with the collected information
+    await BotInfo.interest.set()
+    await bot.send_message(message.from_user.id, text="What do they like to do for fun?")
+
+
+async def process_interest(message: types.Message, state: FSMContext):
+    async with state.proxy() as data:
+        data['interest'] = message.text
+    await BotInfo.profession.set()
+    await bot.send_message(message.from_user.id, text="What is their profession?")
+
+
+async def process_profession(message: types.Message, state: FSMContext):
+    async with state.proxy() as data:
+        data['profession'] = message.text
+    await BotInfo.appearance.set()
+    await bot.send_message(message.from_user.id, text="What do they look like?")
+
+
+async def process_appearance(message: types.Message, state: FSMContext):
+    async with state.proxy() as data:
+        data['appearance'] = message.text
+    await BotInfo.relationship.set()
+    await bot.send_message(message.from_user.id, text="What is their relationship status?")
+
+
+async def process_relationship(message: types.Message, state: FSMContext):
+    async with state.proxy() as data:
+        data['relationship'] = message.text
+        # Everything but the personality is known, the texting style is drafted while the user describes it
+        PERSONA_PREPROCESSOR.draft_text_style(message.from_user.id, format_context(data, include_personality=False))
+    await BotInfo.mood.set()
+    await bot.send_message(message.from_user.id, text="Thank you. Finally, describe their personality.")
+
+
+async def process_mood(message: types.Message, state: FSMContext):
+    async with state.proxy() as data:
+        data['mood'] = message.text
+        # You can use the data dictionary here to create your bot object with the collected information
+    context, tone = await show_data(message)
+    await bot.send_message(message.from_user.id, text=context)
+    # Try to handle context
+    await state.finish()
+    await bot.send_message(message.from_user.id, text="Thank you! Bot information has been saved. One moment...")
+    await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
+#   await asyncio.sleep(1.5)
+#   await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
+#   await asyncio.sleep(1)
+
+#   await bot.send_message(message.from_user.id,
+#                          text="Lets start the conversation, can you tell me a little about yourself?")
+    if await CONVERSATIONS_DB.aexists(message.from_user.id) is False:
+        conversation = await PERSONA_PREPROCESSOR.create_conversation(
+            message.from_user.id, context, tone, config_path=DEFAULT_CONFIG_PATH
+        )
+        CONVERSATIONS_DB.add_conversation(message.from_user.id, conversation)
+        CONVERSATIONS_DB.write_chat_history(message.from_user.id, message.text, chatbot_response=NO_CHATBOT_RESPONSE)
+        await bot.send_message(message.from_user.id,
+                               text="Lets start the conversation, can you tell me a little about yourself?")
+        return None
+
+    PERSONA_PREPROCESSOR.discard(message.from_user.id)
+    await CONVERSATIONS_DB.aremove_conversation(message.from_user.id)
 
 
 async def show_data(message: types.Message):
     state = dispatcher.current_state(chat=message.chat.id, user=message.from_user.id)
     data = await state.get_data()
+    return format_context(data), data.get('mood', 'Not provided')
+
 
+def format_context(data, include_personality=True):
 #    res = f"Here's the information about your companion:\n\n" \
     res = f"Name: {data.get('name', 'Not provided')}\n" \
           f"Age: {data.get('age', 'Not provided')}\n" \
@@ -171,14 +225,14 @@ async def show_data(message: types.Message):
           f"interests: {data.get('interest', 'Not provided')}\n" \
           f"Profession: {data.get('profession', 'Not provided')}\n" \
           f"Appearance: {data.get('appearance', 'Not provided')}\n" \
-          f"Relationship status: {data.get('relationship', 'Not provided')}\n" \
-          f"Personality: {data.get('mood', 'Not provided')}\n"
-    return res, data.get('mood', 'Not provided')
+          f"Relationship status: {data.get('relationship', 'Not provided')}\n"
+    if include_personality:
+        res += f"Personality: {data.get('mood', 'Not provided')}\n"
+    return res
 
 
-@dispatcher.message_handler(commands=["debug"])
 async def debug(message: types.Message):
-    conversation = CONVERSATIONS_DB.get_conversation(message.from_user.id)
+    conversation = await CONVERSATIONS_DB.aget_conversation(message.from_user.id)
     if conversation is None:
         await bot.send_message(message.from_user.id,
                                text="Please, provide initial context.")
@@ -194,12 +248,17 @@ async def debug(message: types.Message):
     # await bot.send_message(message.from_user.id, text=config["prompt_template"])
 
 
-@dispatcher.message_handler()
 @try_
 async def handle_message(message: types.Message) -> None:
     if message.text.startswith("/"):
-        conversation = CONVERSATIONS_DB.get_conversation(message.from_user.id)
-        conversation.set_tone(message.text[1:])
+        async def set_tone() -> None:
+            # The tone generated at the end of the onboarding must not override this one
+            await PERSONA_PREPROCESSOR.wait_ready(message.from_user.id)
+            conversation = await CONVERSATIONS_DB.aget_conversation(message.from_user.id)
+            await conversation.aset_tone(message.text[1:])
+
+        # A turn in flight keeps the tone it started with, the next turns get the new one
+        await TURN_QUEUE.run_exclusive(message.from_user.id, set_tone)
 
         await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
         await asyncio.sleep(1)
@@ -207,21 +266,120 @@ async def handle_message(message: types.Message) -> None:
         await bot.send_message(message.from_user.id, text=f"Information «{message.text[1:]}» has been added.")
         return None
 
-    # Handle conversation
+    async def run_turn(user_input: str) -> str:
+        await PERSONA_PREPROCESSOR.wait_ready(message.from_user.id)
+        conversation = await CONVERSATIONS_DB.aget_conversation(message.from_user.id)
+        # The reply is shown while it is generated, its typing delay overlaps with the generation
+        reply = ProgressiveReply(bot, message.from_user.id)
+        reply.start()
+        try:
+            chatbot_response = await conversation.aask(user_input, on_token=reply.add_token, on_retry=reply.restart)
+        except Exception as e:
+            print(e)
+            # The partial reply becomes the error, instead of staying next to it
+            await reply.fail(error_reply(e))
+            raise ErrorShown() from e
+        CONVERSATIONS_DB.write_chat_history(message.from_user.id, user_input, chatbot_response)
+        await reply.finish(chatbot_response)
+        return chatbot_response
+
+    # Handle conversation, messages sent while the previous reply is pending are merged into one turn
     await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
+    await TURN_QUEUE.submit(message.from_user.id, message.text, run_turn)
 
-    conversation = CONVERSATIONS_DB.get_conversation(message.from_user.id)
-    chatbot_response = conversation.ask(message.text)
-    CONVERSATIONS_DB.write_chat_history(message.from_user.id, message.text, chatbot_response)
-    await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-    await asyncio.sleep(len(chatbot_response) * 0.07)
-    await bot.send_chat_action(message.from_user.id, action=types.ChatActions.TYPING)
-    await bot.send_message(message.from_user.id, text=chatbot_response)
+
+def register_handlers(dispatcher: Dispatcher) -> None:
+    dispatcher.middleware.setup(SharedLLMSessionMiddleware())
+    dispatcher.register_message_handler(start, commands=["start"])
+    dispatcher.register_message_handler(process_name, state=BotInfo.name)
+    dispatcher.register_message_handler(process_age, state=BotInfo.age, content_types=types.ContentTypes.TEXT)
+    dispatcher.register_message_handler(process_gender, state=BotInfo.gender)
+    dispatcher.register_message_handler(process_interest, state=BotInfo.interest)
+    dispatcher.register_message_handler(process_profession, state=BotInfo.profession)
+    dispatcher.register_message_handler(process_appearance, state=BotInfo.appearance)
+    dispatcher.register_message_handler(process_relationship, state=BotInfo.relationship)
+    dispatcher.register_message_handler(process_mood, state=BotInfo.mood)
+    dispatcher.register_message_handler(debug, commands=["debug"])
+    dispatcher.register_message_handler(handle_message)
+
+
+def read_token() -> str:
+    return os.environ.get("TELEGRAM_BOT_TOKEN") or \
+        (Path(__file__).parent / "token.txt").read_text().strip().replace("\n", "")
+
+
+def create_app(token: Optional[str] = None, conversations_db: Optional[ConversationDB] = None) -> Dispatcher:
+    """
+    Build the bot, its dispatcher with the handlers, the conversations database, the turn queue
+    and the persona preprocessor.
+
+    They are module globals used by the handlers, None until this is called, so importing the
+    module builds nothing. The language model stack is not imported either, see ``warm_up``.
+
+    Args:
+        token: The Telegram bot token, read from TELEGRAM_BOT_TOKEN or token.txt if not provided.
+        conversations_db: The conversations database, the default one if not provided.
+
+    Returns: The dispatcher.
+    """
+    global CONVERSATIONS_DB, TURN_QUEUE, PERSONA_PREPROCESSOR, bot, dispatcher
+    CONVERSATIONS_DB = conversations_db or ConversationDB()
+    TURN_QUEUE = TurnQueue()
+    PERSONA_PREPROCESSOR = PersonaPreprocessor()
+    bot = TimedBot(token=token or read_token())
+    dispatcher = Dispatcher(bot, storage=MemoryStorage())
+    register_handlers(dispatcher)
+
+    def llm_stats():
+        from converbot.llm_registry import get_registry
+
+        return get_registry().call_policy.stats
+
+    def persona_stats():
+        from converbot.llm_registry import get_registry
+
+        return get_registry().personas.stats
+
+    get_metrics().add_gauges("conversations", lambda: CONVERSATIONS_DB.stats)
+    get_metrics().add_gauges("history", lambda: CONVERSATIONS_DB.history_writer.stats)
+    get_metrics().add_gauges("turns", lambda: TURN_QUEUE.stats)
+    get_metrics().add_gauges("onboarding", lambda: PERSONA_PREPROCESSOR.stats)
+    get_metrics().add_gauges("llm", llm_stats)
+    get_metrics().add_gauges("personas", persona_stats)
+    get_metrics().add_gauges("retrieval", lambda: CONVERSATIONS_DB.retrieval.stats)
+    return dispatcher
+
+
+async def warm_up() -> None:
+    """
+    Import the language model stack, build the shared clients and load the tokenizer, so the first
+    message does not wait for them.
+
+    The imports and the tokenizer load run in a thread while the bot connects to Telegram.
+    """
+    loop = asyncio.get_running_loop()
+    for module in LANGUAGE_MODEL_MODULES:
+        await loop.run_in_executor(None, importlib.import_module, module)
+    from converbot.llm_registry import get_registry
+    from converbot.tokens import get_encoding
+
+    registry = get_registry()
+    registry.get_llm()
+    registry.tone_handler()
+    registry.text_style_handler()
+    registry.text_style_refinement_handler()
+    registry.context_handler()
+    try:
+        await loop.run_in_executor(None, get_encoding, registry.get_config().model)
+    except Exception as e:
+        # Loaded again on the first count
+        print(e)
 
 
 async def serialize_conversation_task():
-    # CONVERSATIONS_DB.serialize_conversations()
-    pass
+    # The checkpoint saves the conversations evicted as idle
+    CONVERSATIONS_DB.evict_idle()
+    await CONVERSATIONS_DB.acheckpoint()
 
 
 async def scheduler():
@@ -232,7 +390,22 @@ async def scheduler():
 
 
 async def on_startup(dispatcher):
+    global METRICS_RUNNER
+    if METRICS_PORT is not None:
+        METRICS_RUNNER = await start_metrics_server(port=METRICS_PORT)
+    CONVERSATIONS_DB.history_writer.start()
     asyncio.create_task(scheduler())
+    asyncio.create_task(warm_up())
+
+
+async def on_shutdown(dispatcher):
+    await CONVERSATIONS_DB.history_writer.close()
+    CONVERSATIONS_DB.checkpoint()
+    from converbot.llm_registry import get_registry
+
+    await get_registry().close()
+    if METRICS_RUNNER is not None:
+        await METRICS_RUNNER.cleanup()
 
 
 def read_json_file(file_path):
@@ -244,6 +417,123 @@ def read_json_file(file_path):
         return data
 
 
+def run_shard(socket_path: Path, metrics_port: Optional[int] = None) -> None:
+    global METRICS_PORT
+    METRICS_PORT = metrics_port
+    if dispatcher is None:
+        create_app()
+    asyncio.run(serve_shard(dispatcher, socket_path, on_startup=on_startup, on_shutdown=on_shutdown))
+
+
+def run_sharded(num_shards: int, metrics_port: Optional[int] = None) -> None:
+    """
+    Run the bot as one polling front process routing the updates to num_shards worker processes.
+
+    Args:
+        num_shards: The number of worker processes.
+        metrics_port: The metrics port of the first worker, the next workers take the next ports.
+    """
+    socket_dir = Path(tempfile.mkdtemp(prefix="converbot-"))
+    socket_paths = [socket_dir / f"shard-{shard}.sock" for shard in range(num_shards)]
+    context = multiprocessing.get_context("spawn")
+
+    def start_worker(shard: int) -> multiprocessing.Process:
+        worker = context.Process(
+            target=run_shard,
+            args=(socket_paths[shard], metrics_port + shard if metrics_port is not None else None),
+        )
+        worker.start()
+        return worker
+
+    workers = [start_worker(shard) for shard in range(num_shards)]
+
+    async def restart_worker(shard: int) -> None:
+        worker = workers[shard]
+        loop = asyncio.get_running_loop()
+        # The connection closes a moment before the process exits
+        await loop.run_in_executor(None, worker.join, 5.0)
+        if worker.is_alive():
+            worker.terminate()
+            await loop.run_in_executor(None, worker.join)
+        print(f"Shard {shard} worker exited with code {worker.exitcode}, restarting it")
+        workers[shard] = start_worker(shard)
+
+    async def route_updates():
+        # The front process only polls, it builds neither the dispatcher nor the language models
+        front_bot = TimedBot(token=read_token())
+        router = ShardRouter(socket_paths, on_shard_lost=restart_worker)
+        await router.connect()
+        try:
+            await router.poll(front_bot)
+        finally:
+            await router.close()
+            await front_bot.close()
+
+    try:
+        asyncio.run(route_updates())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+def run_webhook(args: argparse.Namespace) -> None:
+    """
+    Run the bot as a webhook server, with bounded concurrency and intake queue.
+
+    Args:
+        args: The command line arguments.
+    """
+    # Telegram sends the secret token with every update, the other requests are rejected
+    secret_token = args.webhook_secret or secrets.token_urlsafe(32)
+
+    async def on_webhook_startup(dispatcher):
+        await bot.set_webhook(args.webhook_url, secret_token=secret_token)
+        await on_startup(dispatcher)
+
+    server = WebhookServer(
+        dispatcher,
+        path=args.webhook_path,
+        max_in_flight=args.max_in_flight,
+        queue_size=args.intake_queue_size,
+        intake_timeout=args.intake_timeout,
+        overflow=args.overflow,
+        secret_token=secret_token,
+        on_startup=on_webhook_startup,
+        on_shutdown=on_shutdown,
+    )
+    web.run_app(server.make_app(), host=args.host, port=args.port)
+
+
 if __name__ == "__main__":
-    executor.start_polling(dispatcher, skip_updates=False, on_startup=on_startup)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=0, help="The number of worker processes, 0 to run in one process")
+    parser.add_argument("--webhook-url", help="The public URL of the webhook, long polling is used if not provided")
+    parser.add_argument("--webhook-path", default="/webhook")
+    parser.add_argument("--webhook-secret", default=os.environ.get("TELEGRAM_WEBHOOK_SECRET"),
+                        help="The secret token of the webhook, shared by the instances behind a load balancer, "
+                             "random if not provided")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-in-flight", type=int, default=100, help="The maximum number of updates handled at once")
+    parser.add_argument("--intake-queue-size", type=int, default=1000)
+    parser.add_argument("--intake-timeout", type=float, default=1.0,
+                        help="The maximum number of seconds an update waits for room in a full intake queue")
+    parser.add_argument("--overflow", choices=["retry", "drop"], default="retry",
+                        help="Whether updates finding the intake queue full are retried by Telegram or dropped")
+    parser.add_argument("--metrics-port", type=int,
+                        help="Serve the metrics on this local port at /metrics, one port per worker when sharded")
+    args = parser.parse_args()
+    METRICS_PORT = args.metrics_port
+    if args.webhook_url:
+        create_app()
+        run_webhook(args)
+    elif args.shards > 0:
+        run_sharded(args.shards, args.metrics_port)
+    else:
+        create_app()
+        executor.start_polling(dispatcher, skip_updates=False, on_startup=on_startup, on_shutdown=on_shutdown)
   
\ No newline at end of file
@@ -0,0 +1,69 @@
+"""
+Run the checks of the benchmarks, every module with a ``check`` function, and fail if any of them fails.
+
+The checks are the quick correctness parts of the benchmarks, e.g. that concurrent turns overlap
+on the async ask path, that the message handlers do not grow with the onboardings and that no
+reply waits for a deferred summarization. The exit status is non-zero if a check failed.
+
+Usage:
+    python -m benchmarks
+    python -m benchmarks concurrent_turns summary_latency
+"""
+import argparse
+import importlib
+import pkgutil
+import time
+import traceback
+from pathlib import Path
+from typing import Callable, Dict
+
+
+def find_checks() -> Dict[str, Callable[[], None]]:
+    checks = {}
+    for module_info in pkgutil.iter_modules([str(Path(__file__).parent)]):
+        if module_info.name.startswith("_"):
+            continue
+        module = importlib.import_module(f"benchmarks.{module_info.name}")
+        check = getattr(module, "check", None)
+        if callable(check):
+            checks[module_info.name] = check
+    return checks
+
+
+def run_check(name: str, check: Callable[[], None]) -> bool:
+    start = time.perf_counter()
+    try:
+        check()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            print(f"FAIL {name}: {e.code}")
+            return False
+    except Exception:
+        traceback.print_exc()
+        print(f"FAIL {name}")
+        return False
+    print(f"ok   {name} ({time.perf_counter() - start:.1f}s)")
+    return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("names", nargs="*", help="The benchmarks whose check is run, all of them if none")
+    args = parser.parse_args()
+
+    checks = find_checks()
+    unknown = [name for name in args.names if name not in checks]
+    if unknown:
+        parser.error(f"No check in {', '.join(unknown)}, the checks are: {', '.join(sorted(checks))}")
+
+    names = args.names or sorted(checks)
+    failed = [name for name in names if not run_check(name, checks[name])]
+    if failed:
+        raise SystemExit(f"{len(failed)} of {len(names)} checks failed: {', '.join(failed)}")
+    print(f"all {len(names)} checks passed")
+
+
+if __name__ == "__main__":
+    main()
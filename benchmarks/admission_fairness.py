@@ -0,0 +1,83 @@
+"""
+Show how the admission control shares a small request budget between users.
+
+A chatty user floods the provider with turns while light users send a single turn each and
+background summarizations compete for the same budget. The turns of the light users should be
+admitted within a few slots of their arrival instead of waiting behind the whole flood, and the
+background calls should only go out when no turn is waiting.
+
+Usage:
+    python -m benchmarks.admission_fairness --rpm 600 --flood 100 --light-users 20 --summaries 20
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Dict, List, Optional
+
+from converbot.admission import BACKGROUND, AdmissionController, admission_priority, set_admission_user
+from converbot.resilience import RetryPolicy
+
+
+async def run(rpm: float, flood: int, light_users: int, summaries: int, latency: float,
+              fair: bool) -> None:
+    # The requests bucket starts full, a burst of 1 second shows the queueing right away
+    admission = AdmissionController(requests_per_minute=rpm)
+    admission._requests.level = 1
+    policy = RetryPolicy(admission=admission)
+    waits: Dict[str, List[float]] = {"chatty": [], "light": [], "background": []}
+
+    async def fake_completion() -> str:
+        await asyncio.sleep(latency)
+        return "Hi!"
+
+    async def call(kind: str, user_id: Optional[int], priority_background: bool = False) -> None:
+        # Without fairness every call is charged to the same user and priority, a plain FIFO
+        set_admission_user(user_id if fair else None)
+        start = time.perf_counter()
+        if priority_background and fair:
+            with admission_priority(BACKGROUND):
+                await policy.call(fake_completion, tokens=500)
+        else:
+            await policy.call(fake_completion, tokens=500)
+        waits[kind].append(time.perf_counter() - start - latency)
+
+    async def light_user(user_id: int) -> None:
+        # The light users show up while the flood is already queued
+        await asyncio.sleep(0.01 * user_id)
+        await call("light", user_id)
+
+    async def monitor() -> None:
+        while admission.admitted < flood + light_users + summaries:
+            print(f"  {admission.stats}")
+            await asyncio.sleep(1.0)
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        monitor(),
+        *(call("chatty", 0) for _ in range(flood)),
+        *(call("background", 1000 + index, priority_background=True) for index in range(summaries)),
+        *(light_user(user_id) for user_id in range(1, light_users + 1)),
+    )
+    print(f"All {admission.admitted} calls admitted in {time.perf_counter() - start:.1f}s")
+    for kind, kind_waits in waits.items():
+        if kind_waits:
+            print(f"{kind:>10}: median wait {statistics.median(kind_waits):6.2f}s, "
+                  f"max wait {max(kind_waits):6.2f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rpm", type=float, default=600)
+    parser.add_argument("--flood", type=int, default=100)
+    parser.add_argument("--light-users", type=int, default=20)
+    parser.add_argument("--summaries", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.1)
+    args = parser.parse_args()
+    for fair in (False, True):
+        print("Fair admission" if fair else "First come, first served")
+        asyncio.run(run(args.rpm, args.flood, args.light_users, args.summaries, args.latency, fair))
+
+
+if __name__ == "__main__":
+    main()
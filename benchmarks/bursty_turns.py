@@ -0,0 +1,84 @@
+"""
+Send bursts of messages for one user and check that turns run in order and bursts are merged.
+
+With ``--check`` it also checks that a command run with ``run_exclusive`` waits for the turn in
+flight and that the next turn waits for the command.
+
+Usage:
+    python -m benchmarks.bursty_turns --bursts 5 --burst-size 3
+    python -m benchmarks.bursty_turns --check
+"""
+import argparse
+import asyncio
+
+from benchmarks.concurrent_turns import build_conversation
+from benchmarks.fake_llm import FakeLatencyLLM
+from converbot.turn_queue import TurnQueue
+
+
+async def run(bursts: int, burst_size: int, latency: float) -> None:
+    llm = FakeLatencyLLM(latency=latency)
+    conversation = build_conversation(llm)
+    queue = TurnQueue()
+    turns = []
+    for burst in range(bursts):
+        messages = [f"message {burst}.{i}" for i in range(burst_size)]
+        results = await asyncio.gather(*(queue.submit(1, text, conversation.aask) for text in messages))
+        turns.extend(turn for turn in results if turn is not None)
+
+    buffered = "\n".join(conversation._memory.buffer)
+    expected = [f"message {burst}.{i}" for burst in range(bursts) for i in range(burst_size)]
+    positions = [buffered.index(text) for text in expected]
+    print(f"{bursts * burst_size} messages -> {llm.requests} completions in {len(turns)} turns, {queue.stats}")
+    if positions != sorted(positions):
+        raise SystemExit("Memory is out of order")
+
+
+async def check_exclusive() -> None:
+    queue = TurnQueue()
+    events = []
+
+    async def run_turn(user_input: str) -> str:
+        events.append(f"start {user_input}")
+        await asyncio.sleep(0.05)
+        events.append(f"end {user_input}")
+        return "ok"
+
+    async def set_tone() -> None:
+        events.append("tone")
+
+    turn = asyncio.ensure_future(queue.submit(1, "first", run_turn))
+    await asyncio.sleep(0.01)
+    command = asyncio.ensure_future(queue.run_exclusive(1, set_tone))
+    await asyncio.sleep(0.01)
+    await asyncio.gather(turn, command, queue.submit(1, "second", run_turn))
+    if events != ["start first", "end first", "tone", "start second", "end second"]:
+        raise SystemExit(f"The command did not run between the turns: {events}")
+    if queue.stats["active_users"]:
+        raise SystemExit("The turns of a user are kept after the last one")
+
+
+def check() -> None:
+    """
+    Check that the turns of a burst run in order and that a command runs between two turns.
+    """
+    asyncio.run(run(3, 3, 0.01))
+    asyncio.run(check_exclusive())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bursts", type=int, default=5)
+    parser.add_argument("--burst-size", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--check", action="store_true", help="Only check the order of the turns and of a command")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.bursts, args.burst_size, args.latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Measure the cost of the periodic checkpoint of ConversationDB when only a small share of the users is active.
+
+With ``--check`` it only checks that the conversations of a failed checkpoint are saved by the next
+one, that the store calls of the handlers do not block the event loop during a checkpoint write, and
+that a conversation removed during a checkpoint write is not saved back.
+
+Usage:
+    python -m benchmarks.checkpoint_cost --users 100000 --active 0.01 --ticks 5
+    python -m benchmarks.checkpoint_cost --check
+"""
+import argparse
+import asyncio
+import random
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fake_llm import FakeLLMRegistry
+from converbot.core import GPT3Conversation
+from converbot.database import ConversationDB
+from converbot.store import ConversationStore
+
+
+class FailingStore(ConversationStore):
+    """A store whose first write fails, like a locked or full disk."""
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.failures = 1
+
+    def save_many(self, snapshots, skip=None):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        return super().save_many(snapshots, skip)
+
+
+def build_conversation(user_id: int) -> GPT3Conversation:
+    return GPT3Conversation.from_persona(
+        context=f"Name: User {user_id}\nPersonality: kind",
+        text_style="Short messages, lowercase, lots of emojis.",
+        tone="friendly",
+        process_tone=False,
+    )
+
+
+async def run(users: int, active: float, ticks: int) -> None:
+    FakeLLMRegistry(latency=0.0).install()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ConversationDB(
+            chat_history_save_dir=Path(tmp) / "history", conversation_save_dir=Path(tmp) / "db", max_resident=None
+        )
+
+        start = time.perf_counter()
+        for user_id in range(users):
+            db.add_conversation(user_id, build_conversation(user_id))
+        print(f"created {users} conversations in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        saved = await db.acheckpoint()
+        print(f"initial checkpoint: {saved} conversations in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+        active_users = max(1, int(users * active))
+        for tick in range(ticks):
+            for user_id in random.sample(range(users), active_users):
+                await db.get_conversation(user_id).aask("Hello, how are you?")
+            start = time.perf_counter()
+            saved = await db.acheckpoint()
+            print(f"tick {tick}: {saved} dirty conversations saved in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        start = time.perf_counter()
+        db.serialize_conversations()
+        print(f"full serialization: {users} conversations in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+        restored = ConversationDB(
+            chat_history_save_dir=Path(tmp) / "history",
+            conversation_save_dir=Path(tmp) / "db",
+        )
+        start = time.perf_counter()
+        conversation = restored.get_conversation(users - 1)
+        print(f"restore of one conversation after restart: {(time.perf_counter() - start) * 1000:.1f}ms, "
+              f"{len(conversation._memory.buffer)} buffered turns")
+
+
+async def check_failed_checkpoint() -> None:
+    FakeLLMRegistry(latency=0.0).install()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ConversationDB(
+            chat_history_save_dir=Path(tmp) / "history",
+            conversation_save_dir=Path(tmp) / "db",
+            store=FailingStore(Path(tmp) / "conversations.sqlite3"),
+            max_resident=None,
+        )
+        for user_id in range(10):
+            db.add_conversation(user_id, build_conversation(user_id))
+        try:
+            await db.acheckpoint()
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise SystemExit("The failing store did not fail")
+        if db.dirty_count != 10:
+            raise SystemExit(f"{10 - db.dirty_count} conversations of the failed checkpoint are no longer dirty")
+        saved = await db.acheckpoint()
+        if saved != 10:
+            raise SystemExit(f"The checkpoint after the failed one saved {saved} of 10 conversations")
+
+
+class SlowStore(ConversationStore):
+    """A store encoding the snapshots for a while, then holding its lock for a while to write them."""
+
+    def save_many(self, snapshots, skip=None):
+        time.sleep(0.1)
+        with self._lock:
+            time.sleep(0.2)
+        return super().save_many(snapshots, skip)
+
+
+async def check_removed_during_checkpoint() -> None:
+    FakeLLMRegistry(latency=0.0).install()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SlowStore(Path(tmp) / "conversations.sqlite3")
+        db = ConversationDB(
+            chat_history_save_dir=Path(tmp) / "history",
+            conversation_save_dir=Path(tmp) / "db",
+            store=store,
+            max_resident=None,
+        )
+        for user_id in range(3):
+            db.add_conversation(user_id, build_conversation(user_id))
+        checkpoint = asyncio.ensure_future(db.acheckpoint())
+        await asyncio.sleep(0.02)
+        # Deleted before the write of the checkpoint takes the lock
+        await db.aremove_conversation(0)
+
+        await asyncio.sleep(0.1)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        ticks = [start]
+
+        async def tick() -> None:
+            while not checkpoint.done():
+                await asyncio.sleep(0.01)
+                ticks.append(loop.time())
+
+        ticker = asyncio.ensure_future(tick())
+        # Waits for the lock held by the write, the loop must keep running meanwhile
+        if await db.aexists(100):
+            raise SystemExit("A user without a conversation exists")
+        await checkpoint
+        await ticker
+        longest_stall = max(later - earlier for earlier, later in zip(ticks, ticks[1:]))
+        if longest_stall > 0.1:
+            raise SystemExit(f"The event loop stalled {longest_stall:.2f}s on a store call during a checkpoint")
+        if store.exists("0") or db.exists(0):
+            raise SystemExit("A conversation removed during a checkpoint write was saved back")
+        if not store.exists("1"):
+            raise SystemExit("The checkpoint did not save the other conversations")
+
+
+def check() -> None:
+    """
+    Check failed checkpoints, and the store calls and removals during a checkpoint write.
+    """
+    asyncio.run(check_failed_checkpoint())
+    asyncio.run(check_removed_during_checkpoint())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--active", type=float, default=0.01, help="Share of the users active per tick")
+    parser.add_argument("--ticks", type=int, default=5)
+    parser.add_argument("--check", action="store_true", help="Only check a failed checkpoint")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.users, args.active, args.ticks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Run N chat turns concurrently against a fake LLM and compare with sequential turns.
+
+With ``--check`` it only checks that concurrent turns overlap on the async ask path.
+
+Usage:
+    python -m benchmarks.concurrent_turns --turns 200 --latency 0.5
+    python -m benchmarks.concurrent_turns --check
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.fake_llm import FakeLatencyLLM
+from converbot.core import GPT3Conversation
+from converbot.mood_handler import ConversationToneHandler
+from converbot.prompt import ConversationPrompt
+
+
+def build_conversation(llm: FakeLatencyLLM) -> GPT3Conversation:
+    return GPT3Conversation(
+        prompt=ConversationPrompt(prompt_text="Benchmark persona.", user_name="[User]", chatbot_name="[Bot]"),
+        tone="friendly",
+        language_model=llm,
+        tone_processor=ConversationToneHandler(llm=FakeLatencyLLM(latency=0.0)),
+    )
+
+
+async def run_concurrent(turns: int, latency: float) -> float:
+    llm = FakeLatencyLLM(latency=latency)
+    conversations = [build_conversation(llm) for _ in range(turns)]
+    start = time.perf_counter()
+    await asyncio.gather(*(conversation.aask("Hello there!") for conversation in conversations))
+    return time.perf_counter() - start
+
+
+async def run_sequential(turns: int, latency: float) -> float:
+    llm = FakeLatencyLLM(latency=latency)
+    conversations = [build_conversation(llm) for _ in range(turns)]
+    start = time.perf_counter()
+    for conversation in conversations:
+        conversation.ask("Hello there!")
+    return time.perf_counter() - start
+
+
+def check_overlap(concurrent: float, latency: float) -> None:
+    if concurrent > 2 * latency:
+        raise SystemExit("Concurrent turns did not overlap")
+
+
+def check() -> None:
+    """
+    Check that concurrent turns overlap on the async ask path.
+    """
+    check_overlap(asyncio.run(run_concurrent(50, 0.2)), 0.2)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--sequential-turns", type=int, default=5)
+    parser.add_argument("--check", action="store_true", help="Only check that concurrent turns overlap")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+
+    concurrent = asyncio.run(run_concurrent(args.turns, args.latency))
+    sequential = asyncio.run(run_sequential(args.sequential_turns, args.latency))
+    print(f"{args.turns} concurrent turns: {concurrent:.3f}s ({concurrent / args.latency:.2f}x LLM latency)")
+    print(f"{args.sequential_turns} blocking turns: {sequential:.3f}s ({sequential / args.latency:.2f}x LLM latency)")
+    check_overlap(concurrent, args.latency)
+
+
+if __name__ == "__main__":
+    main()
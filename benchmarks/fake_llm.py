@@ -0,0 +1,152 @@
+import asyncio
+import math
+import random
+import time
+from typing import Any, List, Mapping, Optional
+
+from langchain.llms.base import LLM
+from langchain.schema import Generation, LLMResult
+
+from converbot import llm_registry
+from converbot.llm_registry import LLMRegistry
+
+
+class FakeLatencyLLM(LLM):
+    """
+    Offline language model that answers with a fixed response after a fixed delay.
+
+    Every completion request takes ``latency`` seconds whatever the number of prompts
+    it carries, like a batched request to the real API. With ``token_latency`` set, the
+    async completion of a single prompt is then streamed word by word to the callback manager.
+
+    Args:
+        response: The completion returned for every prompt.
+        latency: The number of seconds each request takes.
+        token_latency: The number of seconds between two streamed words.
+    """
+
+    response: str = "Sounds good to me!"
+    latency: float = 0.5
+    token_latency: float = 0.0
+    calls: int = 0
+    requests: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-latency"
+
+    @property
+    def _identifying_params(self) -> Mapping[str, Any]:
+        return {"response": self.response, "latency": self.latency}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
+        return self._generate([prompt], stop=stop).generations[0][0].text
+
+    def _generate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        self.requests += 1
+        self.calls += len(prompts)
+        time.sleep(self.latency)
+        return LLMResult(generations=[[Generation(text=self.response)] for _ in prompts])
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        self.requests += 1
+        self.calls += len(prompts)
+        await asyncio.sleep(self.latency)
+        if self.token_latency > 0 and len(prompts) == 1:
+            for word in self.response.split(" "):
+                await asyncio.sleep(self.token_latency)
+                self.callback_manager.on_llm_new_token(word + " ", verbose=self.verbose)
+        return LLMResult(generations=[[Generation(text=self.response)] for _ in prompts])
+
+    def get_num_tokens(self, text: str) -> int:
+        return len(text.split())
+
+
+class Distribution:
+    """
+    Random distribution of a latency or a size, parsed from a command line spec.
+
+    Specs are "fixed:VALUE", "uniform:LOW:HIGH", "exponential:MEAN" and "lognormal:MEDIAN:SIGMA".
+
+    Args:
+        spec: The spec of the distribution.
+        seed: The seed of the random generator.
+    """
+
+    KINDS = ("fixed", "uniform", "exponential", "lognormal")
+
+    def __init__(self, spec: str, seed: Optional[int] = None) -> None:
+        kind, *params = spec.split(":")
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown distribution: {kind}, expected one of {self.KINDS}")
+        self.spec = spec
+        self._kind = kind
+        self._params = [float(param) for param in params]
+        self._random = random.Random(seed)
+
+    def sample(self) -> float:
+        if self._kind == "fixed":
+            return self._params[0]
+        if self._kind == "uniform":
+            return self._random.uniform(*self._params)
+        if self._kind == "exponential":
+            return self._random.expovariate(1 / self._params[0])
+        median, sigma = self._params
+        return self._random.lognormvariate(math.log(median), sigma)
+
+    def __repr__(self) -> str:
+        return self.spec
+
+
+class SampledLatencyLLM(FakeLatencyLLM):
+    """
+    Offline language model whose request latency and response length are drawn at random.
+
+    Args:
+        latency_distribution: The distribution of the number of seconds before the first token.
+        length_distribution: The distribution of the number of words of a response.
+        token_latency: The number of seconds between two streamed words.
+    """
+
+    latency_distribution: Distribution
+    length_distribution: Distribution
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        self.requests += 1
+        self.calls += len(prompts)
+        await asyncio.sleep(self.latency_distribution.sample())
+        responses = [
+            " ".join(["word"] * max(1, round(self.length_distribution.sample())))
+            for _ in prompts
+        ]
+        if self.token_latency > 0 and len(prompts) == 1:
+            for word in responses[0].split(" "):
+                await asyncio.sleep(self.token_latency)
+                self.callback_manager.on_llm_new_token(word + " ", verbose=self.verbose)
+        return LLMResult(generations=[[Generation(text=response)] for response in responses])
+
+
+class FakeLLMRegistry(LLMRegistry):
+    """
+    Registry whose clients are offline fake language models, without provider budgets unless given.
+    """
+
+    def __init__(self, latency: float, **kwargs) -> None:
+        kwargs.setdefault("requests_per_minute", None)
+        kwargs.setdefault("tokens_per_minute", None)
+        kwargs.setdefault("generation_cache_size", 0)
+        super().__init__(**kwargs)
+        self.helper_llm = FakeLatencyLLM(latency=latency)
+        self.chat_llm = FakeLatencyLLM(latency=latency)
+
+    def get_helper_llm(self):
+        return self.helper_llm
+
+    def get_llm(self, config=None):
+        return self.chat_llm
+
+    def install(self) -> None:
+        """
+        Make the registry the process-wide one returned by ``get_registry``.
+        """
+        llm_registry._REGISTRY = self
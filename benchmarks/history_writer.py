@@ -0,0 +1,91 @@
+"""
+Measure how long the event loop waits to queue chat history rows with the buffered writer, and how
+long the rows take to reach the files.
+
+With ``--check`` it only checks that the rows of a failed flush, e.g. on a full disk, are written
+by the next one and that the background task keeps running.
+
+Usage:
+    python -m benchmarks.history_writer --users 1000 --rows 20000
+    python -m benchmarks.history_writer --check
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from converbot.history import ChatHistoryWriter
+from converbot.retrieval import read_history
+
+
+class FailingWriter(ChatHistoryWriter):
+    """A writer whose first flush fails after writing the rows of one user, like a disk filling up."""
+
+    def __init__(self, save_dir: Path, **kwargs) -> None:
+        super().__init__(save_dir, **kwargs)
+        self.failures = 1
+
+    def _write_rows(self, rows, written_users=None) -> None:
+        if self.failures:
+            self.failures -= 1
+            first_user = rows[0][0]
+            super()._write_rows([row for row in rows if row[0] == first_user], written_users)
+            raise OSError(28, "No space left on device")
+        super()._write_rows(rows, written_users)
+
+
+async def check_failed_flush() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = FailingWriter(Path(tmp), flush_interval=0.05)
+        writer.start()
+        for user_id in range(3):
+            writer.write(user_id, f"message of {user_id}", f"response to {user_id}")
+        await asyncio.sleep(0.3)
+        if writer._task.done():
+            raise SystemExit("A failed flush stopped the background task")
+        if writer.stats["failed_flushes"] != 1 or writer.stats["queued_rows"]:
+            raise SystemExit(f"The rows of the failed flush were not written by the next one: {writer.stats}")
+        await writer.close()
+        for user_id in range(3):
+            turns = read_history(Path(tmp) / f"{user_id}.csv")
+            if turns != [(f"message of {user_id}", f"response to {user_id}")]:
+                raise SystemExit(f"The chat history of user {user_id} is {turns}")
+
+
+def check() -> None:
+    """
+    Check that the rows of a failed flush are written by the next one.
+    """
+    asyncio.run(check_failed_flush())
+
+
+async def run(users: int, rows: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = ChatHistoryWriter(Path(tmp))
+        writer.start()
+        start = time.perf_counter()
+        for row in range(rows):
+            writer.write(row % users, f"message {row}", f"response {row}")
+        queued = time.perf_counter() - start
+        await writer.close()
+        written = time.perf_counter() - start
+        print(f"{rows} rows of {users} users: queued in {queued * 1e6 / rows:.2f}us/row, "
+              f"all written after {written:.2f}s, {writer.stats}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--check", action="store_true", help="Only check the recovery from a failed flush")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.users, args.rows))
+
+
+if __name__ == "__main__":
+    main()
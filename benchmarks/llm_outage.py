@@ -0,0 +1,139 @@
+"""
+Simulate an outage of the language model provider and show the retries and the circuit breaker.
+
+Users keep sending messages while the fake provider answers every request with a rate limit
+error for ``--outage`` seconds, then recovers.
+
+With ``--check`` it only checks that a cancelled probe of the half open breaker does not keep
+the breaker open.
+
+Usage:
+    python -m benchmarks.llm_outage --users 50 --outage 3 --duration 8
+    python -m benchmarks.llm_outage --check
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from collections import Counter
+from typing import List, Optional
+
+import openai.error
+from langchain.schema import LLMResult
+
+from benchmarks.checkpoint_cost import build_conversation
+from benchmarks.fake_llm import FakeLatencyLLM, FakeLLMRegistry
+from converbot.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class OutageLLM(FakeLatencyLLM):
+    """
+    Fake language model failing with rate limit errors until ``outage_until``.
+    """
+
+    outage_until: float = 0.0
+    retry_after: int = 1
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        if time.monotonic() < self.outage_until:
+            self.requests += 1
+            await asyncio.sleep(self.latency)
+            raise openai.error.RateLimitError(
+                "That model is currently overloaded with other requests.",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        return await super()._agenerate(prompts, stop)
+
+
+async def run(users: int, outage: float, duration: float, think_time: float) -> None:
+    registry = FakeLLMRegistry(latency=0.0, retry_base_delay=0.2, breaker_failure_threshold=5,
+                               breaker_reset_timeout=1.0)
+    registry.chat_llm = OutageLLM(latency=0.1, outage_until=time.monotonic() + outage)
+    registry.install()
+    policy = registry.call_policy
+
+    outcomes = Counter()
+    latencies = {"ok": [], "heavy load": [], "failed": []}
+    start = time.monotonic()
+
+    async def user(user_id: int) -> None:
+        conversation = build_conversation(user_id)
+        while time.monotonic() - start < duration:
+            turn_start = time.perf_counter()
+            try:
+                await conversation.aask("Are you there?")
+                outcome = "ok"
+            except CircuitOpenError:
+                outcome = "heavy load"
+            except openai.error.OpenAIError:
+                outcome = "failed"
+            outcomes[outcome] += 1
+            latencies[outcome].append(time.perf_counter() - turn_start)
+            await asyncio.sleep(think_time)
+
+    async def monitor() -> None:
+        while time.monotonic() - start < duration:
+            print(f"t={time.monotonic() - start:4.1f}s {policy.stats}")
+            await asyncio.sleep(1.0)
+
+    await asyncio.gather(monitor(), *(user(user_id) for user_id in range(users)))
+    print(f"{registry.chat_llm.requests} requests sent to the provider")
+    for outcome, count in outcomes.items():
+        print(f"{outcome:>10}: {count} turns, median latency {statistics.median(latencies[outcome]) * 1000:.0f}ms")
+
+
+async def check_cancelled_probe() -> None:
+    policy = RetryPolicy(max_attempts=1, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.05))
+
+    async def fail():
+        raise openai.error.RateLimitError("That model is currently overloaded with other requests.")
+
+    async def answer(delay: float) -> str:
+        await asyncio.sleep(delay)
+        return "ok"
+
+    try:
+        await policy.call(fail)
+    except openai.error.RateLimitError:
+        pass
+    await asyncio.sleep(0.1)
+    # The probe is cancelled like a discarded draft
+    probe = asyncio.ensure_future(policy.call(lambda: answer(10.0)))
+    await asyncio.sleep(0.01)
+    probe.cancel()
+    try:
+        await probe
+    except asyncio.CancelledError:
+        pass
+    try:
+        await policy.call(lambda: answer(0.0))
+    except CircuitOpenError:
+        raise SystemExit("A cancelled probe kept the circuit breaker open")
+    if policy.breaker.state != "closed":
+        raise SystemExit(f"The circuit breaker is {policy.breaker.state} after a successful probe")
+
+
+def check() -> None:
+    """
+    Check that a cancelled probe of the half open breaker lets the next call probe.
+    """
+    asyncio.run(check_cancelled_probe())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--outage", type=float, default=3.0)
+    parser.add_argument("--duration", type=float, default=8.0)
+    parser.add_argument("--think-time", type=float, default=0.2)
+    parser.add_argument("--check", action="store_true", help="Only check the cancellation of a probe")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.users, args.outage, args.duration, args.think_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+Load test the bot offline: simulated users go through the onboarding and chat with their persona.
+
+The updates are handled by the real dispatcher of app.py. The Telegram API is replaced by an
+in-process fake bot and OpenAI by fake language models with random latencies and response
+lengths, so the test runs without network access.
+
+Reported: turn latency percentiles (until the first visible message and until the complete
+reply), throughput, event loop lag, memory per user and the mean time and tokens of every stage.
+
+Latencies and lengths are distribution specs, see ``benchmarks.fake_llm.Distribution``.
+
+Usage:
+    python -m benchmarks.load_test --users 200 --turns 5 --chat-latency lognormal:1.0:0.5
+    python -m benchmarks.load_test --users 1000 --turns 3 --no-typing-delay --json results.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456789:AAbenchmarkbenchmarkbenchmarkbenchm")
+
+import app  # noqa: E402
+from aiogram import Bot, Dispatcher  # noqa: E402
+from langchain.callbacks.base import CallbackManager  # noqa: E402
+
+from benchmarks.fake_llm import Distribution, FakeLLMRegistry, SampledLatencyLLM  # noqa: E402
+from benchmarks.onboarding_dispatch import make_update  # noqa: E402
+from converbot.callbacks import LLMMetricsCallback, TokenStreamCallback  # noqa: E402
+from converbot.database import ConversationDB  # noqa: E402
+from converbot.metrics import Metrics, get_metrics  # noqa: E402
+from converbot.reply import ProgressiveReply  # noqa: E402
+
+ONBOARDING = ["/start", "Ann", "25", "female", "skiing", "developer", "tall", "single", "kind and curious"]
+ERROR_PREFIXES = ("\nPlease, try again later", "\nSomething went wrong")
+
+
+class FakeTelegram:
+    """
+    In-process replacement of the Telegram API methods used by the handlers.
+
+    Args:
+        api_latency: The number of seconds every API call takes.
+    """
+
+    def __init__(self, api_latency: float) -> None:
+        self._api_latency = api_latency
+        self._next_message_id = 0
+        self.first_message_at: Dict[int, float] = {}
+        self.errors = 0
+        self.calls = 0
+
+    def install(self, bot: Bot) -> None:
+        bot.send_message = self.send_message
+        bot.edit_message_text = self.edit_message_text
+        bot.send_chat_action = self.send_chat_action
+
+    async def _call(self) -> None:
+        self.calls += 1
+        if self._api_latency > 0:
+            await asyncio.sleep(self._api_latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call()
+        self.first_message_at.setdefault(chat_id, time.perf_counter())
+        if text.startswith(ERROR_PREFIXES):
+            self.errors += 1
+        self._next_message_id += 1
+        return SimpleNamespace(message_id=self._next_message_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._call()
+        return True
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        await self._call()
+        return True
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    values = sorted(values)
+
+    def at(share: float) -> float:
+        return values[min(len(values) - 1, int(share * len(values)))]
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": values[-1]}
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Peak instead of current resident set, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoopLagMonitor:
+    """
+    Measure how late the event loop wakes up a task sleeping for ``interval`` seconds.
+    """
+
+    def __init__(self, interval: float = 0.05) -> None:
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.lags: List[float] = []
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+
+async def run(args: argparse.Namespace) -> dict:
+    registry = FakeLLMRegistry(latency=0.0)
+    registry.helper_llm = SampledLatencyLLM(
+        latency_distribution=Distribution(args.helper_latency, seed=args.seed),
+        length_distribution=Distribution(args.helper_words, seed=args.seed + 1),
+        callback_manager=CallbackManager([]),
+    )
+    registry.chat_llm = SampledLatencyLLM(
+        latency_distribution=Distribution(args.chat_latency, seed=args.seed + 2),
+        length_distribution=Distribution(args.chat_words, seed=args.seed + 3),
+        token_latency=args.token_latency,
+        callback_manager=CallbackManager([TokenStreamCallback()]),
+    )
+    for llm in (registry.helper_llm, registry.chat_llm):
+        llm.callback_manager.add_handler(LLMMetricsCallback(llm.get_num_tokens))
+    registry.install()
+
+    tmp = tempfile.TemporaryDirectory()
+    app.create_app(conversations_db=ConversationDB(
+        chat_history_save_dir=Path(tmp.name) / "history", conversation_save_dir=Path(tmp.name) / "db"
+    ))
+    telegram = FakeTelegram(args.api_latency)
+    telegram.install(app.bot)
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dispatcher)
+    if args.no_typing_delay:
+        app.ProgressiveReply = functools.partial(ProgressiveReply, seconds_per_char=0.0)
+
+    app.CONVERSATIONS_DB.history_writer.start()
+
+    think_time = Distribution(args.think_time, seed=args.seed + 4)
+    update_ids = iter(range(10 ** 9))
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    completed_turns = 0
+
+    async def send(user_id: int, text: str) -> Tuple[float, float]:
+        """
+        Dispatch a message of the user, return the seconds until the first message of the bot
+        and until the update is handled.
+        """
+        telegram.first_message_at.pop(user_id, None)
+        start = time.perf_counter()
+        # Every update runs in its own task, as in polling
+        await asyncio.create_task(app.dispatcher.process_update(make_update(next(update_ids), user_id, text)))
+        end = time.perf_counter()
+        return telegram.first_message_at.get(user_id, end) - start, end - start
+
+    async def simulate_user(index: int) -> None:
+        nonlocal completed_turns
+        user_id = args.first_user_id + index
+        await asyncio.sleep(random.Random(args.seed + index).uniform(0, args.ramp_up))
+        for text in ONBOARDING:
+            await send(user_id, text)
+            await asyncio.sleep(think_time.sample())
+        for turn in range(args.turns):
+            first_shown, complete = await send(user_id, f"Tell me something about your day, part {turn}")
+            latencies["first_shown"].append(first_shown)
+            latencies["complete"].append(complete)
+            completed_turns += 1
+            await asyncio.sleep(think_time.sample())
+
+    lag_monitor = LoopLagMonitor()
+    rss_before = rss_bytes()
+    lag_monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*(simulate_user(index) for index in range(args.users)))
+    elapsed = time.perf_counter() - start
+    await lag_monitor.stop()
+    rss_after = rss_bytes()
+    await app.CONVERSATIONS_DB.history_writer.close()
+    tmp.cleanup()
+
+    return {
+        "parameters": {key: str(value) for key, value in vars(args).items() if key != "json"},
+        "elapsed_seconds": elapsed,
+        "turns": completed_turns,
+        "turns_per_second": completed_turns / elapsed,
+        "errors": telegram.errors,
+        "telegram_calls": telegram.calls,
+        "llm_requests": {"chat": registry.chat_llm.requests, "helper": registry.helper_llm.requests},
+        "turn_latency_first_shown_seconds": percentiles(latencies["first_shown"]),
+        "turn_latency_complete_seconds": percentiles(latencies["complete"]),
+        "loop_lag_seconds": {**percentiles(lag_monitor.lags), "mean": statistics.mean(lag_monitor.lags or [0.0])},
+        "rss_bytes": rss_after,
+        "rss_bytes_per_user": (rss_after - rss_before) / args.users,
+        "conversations": app.CONVERSATIONS_DB.stats,
+        "stages": summarize_metrics(get_metrics()),
+    }
+
+
+def summarize_metrics(metrics: Metrics) -> Dict[str, Dict[str, float]]:
+    """
+    Get the mean time of every stage and the mean token counts of the requests made in it.
+    """
+    stages: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for name, histogram in (
+        ("seconds", metrics.stage_seconds),
+        ("prompt_tokens", metrics.llm_prompt_tokens),
+        ("completion_tokens", metrics.llm_completion_tokens),
+    ):
+        for (stage,), summary in histogram.summary().items():
+            if name == "seconds":
+                stages[stage]["count"] = summary["count"]
+            stages[stage][f"mean_{name}"] = summary["sum"] / summary["count"]
+    return dict(stages)
+
+
+def print_report(results: dict) -> None:
+    def ms(stats: Dict[str, float]) -> str:
+        return ", ".join(f"{name} {value * 1000:.0f}ms" for name, value in stats.items())
+
+    print(f"{results['turns']} turns in {results['elapsed_seconds']:.1f}s: "
+          f"{results['turns_per_second']:.1f} turns/s, {results['errors']} errors")
+    print(f"LLM requests: {results['llm_requests']}, Telegram calls: {results['telegram_calls']}")
+    print(f"turn latency, first message: {ms(results['turn_latency_first_shown_seconds'])}")
+    print(f"turn latency, complete reply: {ms(results['turn_latency_complete_seconds'])}")
+    print(f"event loop lag: {ms(results['loop_lag_seconds'])}")
+    print(f"memory: {results['rss_bytes'] / 2 ** 20:.0f}MiB resident, "
+          f"{results['rss_bytes_per_user'] / 1024:.1f}KiB per user")
+    for stage, stats in sorted(results["stages"].items()):
+        tokens = ""
+        if "mean_prompt_tokens" in stats:
+            tokens = f", {stats['mean_prompt_tokens']:.0f} prompt and " \
+                     f"{stats['mean_completion_tokens']:.0f} completion tokens per request"
+        print(f"  {stage:>15}: {stats.get('count', 0):6.0f} x {stats.get('mean_seconds', 0) * 1000:7.1f}ms{tokens}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=5, help="The number of chat turns of every user")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="The users arrive uniformly within these seconds")
+    parser.add_argument("--think-time", default="exponential:1.0", help="The time between two messages of a user")
+    parser.add_argument("--chat-latency", default="lognormal:1.0:0.5", help="The time to the first token of a turn")
+    parser.add_argument("--chat-words", default="lognormal:25:0.5", help="The number of words of a reply")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="The seconds between two streamed words")
+    parser.add_argument("--helper-latency", default="lognormal:0.8:0.3",
+                        help="The latency of the tone, style and context handlers")
+    parser.add_argument("--helper-words", default="fixed:40")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="The latency of a Telegram API call")
+    parser.add_argument("--no-typing-delay", action="store_true",
+                        help="Show the replies as fast as they are generated, to measure the bot alone")
+    parser.add_argument("--first-user-id", type=int, default=10 ** 9)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, help="Write the results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_report(results)
+    if args.json is not None:
+        args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Microbenchmarks of the converbot code run on every message, saved as json to compare runs.
+
+Every benchmark times an operation in several rounds and keeps the median time per operation.
+The language models are offline fakes, their token counts are word counts. With ``--compare``
+the results are checked against a previous run and the command fails if an operation got slower
+than the tolerance allows, so it can gate a deployment.
+
+Usage:
+    python -m benchmarks.microbench --output microbench.json
+    python -m benchmarks.microbench --quick --only db_lookup --only prompt
+    python -m benchmarks.microbench --output new.json --compare microbench.json --tolerance 0.25
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import itertools
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from benchmarks.checkpoint_cost import build_conversation
+from benchmarks.fake_llm import FakeLatencyLLM, FakeLLMRegistry
+from benchmarks.retrieval_memory import generate_turns
+from converbot.bot_utils import acreate_conversation_from_context, create_conversation_from_context
+from converbot.constants import DEFAULT_CONFIG_PATH
+from converbot.core import GPT3Conversation
+from converbot.database import ConversationDB
+from converbot.history import ChatHistoryWriter
+from converbot.memory import AsyncConversationSummaryBufferMemory
+from converbot.prompt import ConversationPrompt, PersonaPrompt
+from converbot.retrieval import RetrievalIndex
+
+Results = Dict[str, Dict[str, float]]
+
+CONTEXT = "Name: Ann\nAge: 25\nGender: female\ninterests: skiing\nProfession: developer\n" \
+          "Appearance: tall\nRelationship status: single\nPersonality: kind and curious\n"
+TEXT_STYLE = "Short messages, lowercase, lots of emojis, asks a question back."
+
+BENCHMARKS: Dict[str, Callable[[argparse.Namespace], Results]] = {}
+
+
+def benchmark(func: Callable[[argparse.Namespace], Results]) -> Callable[[argparse.Namespace], Results]:
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def measure(operation: Callable[[], object], number: int, rounds: int = 5) -> Dict[str, float]:
+    """
+    Time an operation, with the garbage collector disabled like timeit does.
+
+    Args:
+        operation: The operation.
+        number: The number of times the operation runs per round.
+        rounds: The number of rounds.
+
+    Returns: The median and best time per operation in microseconds, and operations per second.
+    """
+    per_op = []
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                operation()
+            per_op.append((time.perf_counter() - start) / number)
+    finally:
+        gc.enable()
+    median = statistics.median(per_op)
+    return {"median_us": median * 1e6, "best_us": min(per_op) * 1e6, "ops_per_second": 1 / median}
+
+
+@benchmark
+def prompt(args: argparse.Namespace) -> Results:
+    registry = FakeLLMRegistry(latency=0.0)
+    template = registry.get_config().prompt_template
+    persona_prompt = PersonaPrompt(template, CONTEXT, TEXT_STYLE)
+    chat_history = "\n".join(f"[User]: message {i}\n[Bot]: reply {i}" for i in range(20))
+    return {
+        "conversation_prompt_build": measure(lambda: ConversationPrompt(persona_prompt.prompt_text), 2000),
+        "persona_prompt_build": measure(lambda: PersonaPrompt(template, CONTEXT, TEXT_STYLE), 2000),
+        "prompt_format": measure(
+            lambda: persona_prompt.prompt.format(
+                retrieved_memory="", chat_history=chat_history, user_input="How was your day?",
+                conversation_tone="friendly",
+            ),
+            5000,
+        ),
+    }
+
+
+@benchmark
+def db_lookup(args: argparse.Namespace) -> Results:
+    FakeLLMRegistry(latency=0.0).install()
+    users = 100_000 if args.quick else 1_000_000
+    conversation = build_conversation(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ConversationDB(Path(tmp) / "history", Path(tmp) / "db", max_resident=None)
+        # One conversation object shared by all the users, only the index is measured
+        start = time.perf_counter()
+        for user_id in range(users):
+            db.add_conversation(user_id, conversation)
+        populate_seconds = time.perf_counter() - start
+
+        hit_ids = itertools.cycle([random.randrange(users) for _ in range(10_000)])
+        miss_ids = itertools.cycle(range(users, users + 10_000))
+        results = {
+            "get_conversation_hit": measure(lambda: db.get_conversation(next(hit_ids)), 10_000),
+            "exists_hit": measure(lambda: db.exists(next(hit_ids)), 10_000),
+            "get_conversation_miss": measure(lambda: db.get_conversation(next(miss_ids)), 2_000),
+            "exists_miss": measure(lambda: db.exists(next(miss_ids)), 2_000),
+        }
+        results["add_conversation"] = {"median_us": populate_seconds / users * 1e6, "users": users}
+        # The users share one conversation, skip saving it a million times when the database is freed
+        db._dirty.clear()
+    return results
+
+
+@benchmark
+def chat_history(args: argparse.Namespace) -> Results:
+    rows = 5_000 if args.quick else 50_000
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = ChatHistoryWriter(Path(tmp) / "sync")
+        results["write_chat_history_sync"] = measure(
+            lambda: writer.write(random.randrange(1000), "How was your day?", "Great, and yours?"), rows // 10, 3
+        )
+
+        async def write_buffered() -> float:
+            writer = ChatHistoryWriter(Path(tmp) / "buffered")
+            writer.start()
+            start = time.perf_counter()
+            for i in range(rows):
+                writer.write(i % 1000, "How was your day?", "Great, and yours?")
+                if i % 100 == 0:
+                    # Let the flushing task run, as between the updates of the bot
+                    await asyncio.sleep(0)
+            await writer.close()
+            return time.perf_counter() - start
+
+        gc.collect()
+        seconds = asyncio.run(write_buffered())
+        results["write_chat_history_buffered"] = {"median_us": seconds / rows * 1e6, "ops_per_second": rows / seconds}
+    return results
+
+
+@benchmark
+def memory_tokens(args: argparse.Namespace) -> Results:
+    results = {}
+    sizes = (10, 100, 1000) if args.quick else (10, 100, 1000, 10_000)
+    for size in sizes:
+        memory = AsyncConversationSummaryBufferMemory(
+            llm=FakeLatencyLLM(latency=0.0), max_token_limit=10 ** 9, input_key="user_input",
+            memory_key="chat_history", human_prefix="[User]", ai_prefix="[Bot]",
+        )
+        for i in range(size):
+            memory.save_context({"user_input": f"message number {i}"}, {"text": f"reply number {i}"})
+        results[f"num_tokens_{size}_turns"] = measure(lambda: memory.num_tokens, 1000)
+        turn = iter(range(10 ** 9))
+        results[f"save_context_{size}_turns"] = measure(
+            lambda: memory.save_context({"user_input": f"message {next(turn)}"}, {"text": "reply"}), 200
+        )
+    return results
+
+
+@benchmark
+def retrieval(args: argparse.Namespace) -> Results:
+    turns = generate_turns(10_000 if args.quick else 100_000, vocabulary=50_000, seed=0)
+    queries = itertools.cycle(message for message, _ in generate_turns(1000, vocabulary=50_000, seed=1))
+    index = RetrievalIndex()
+    for user_message, chatbot_response in turns:
+        index.add(user_message, chatbot_response)
+    return {
+        f"add_turn_{len(turns)}_turns": measure(lambda: index.add(*turns[len(index) % len(turns)]), 1000),
+        f"search_{len(turns)}_turns": measure(lambda: index.search(next(queries), 3, exclude_last=10), 200),
+    }
+
+
+@benchmark
+def conversation(args: argparse.Namespace) -> Results:
+    registry = FakeLLMRegistry(latency=0.0)
+    registry.install()
+    template = registry.get_config().prompt_template
+    return {
+        "from_persona": measure(
+            lambda: GPT3Conversation.from_persona(CONTEXT, TEXT_STYLE, "friendly", process_tone=False), 200
+        ),
+        "constructor": measure(
+            lambda: GPT3Conversation(PersonaPrompt(template, CONTEXT, TEXT_STYLE), tone="friendly", process_tone=False),
+            200,
+        ),
+    }
+
+
+@benchmark
+def create_from_context(args: argparse.Namespace) -> Results:
+    registry = FakeLLMRegistry(latency=0.0)
+    registry.install()
+    # Distinct contexts, so the generations are not answered from the cache of the handlers
+    contexts = (f"{CONTEXT}Favourite number: {i}" for i in itertools.count())
+    concurrent = 100
+
+    async def acreate_concurrently() -> None:
+        await asyncio.gather(*(
+            acreate_conversation_from_context(next(contexts), "kind", DEFAULT_CONFIG_PATH)
+            for _ in range(concurrent)
+        ))
+
+    # The context handler prints its input
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {
+            "create_conversation_from_context": measure(
+                lambda: create_conversation_from_context(next(contexts), "kind", DEFAULT_CONFIG_PATH), 100
+            ),
+            # Includes the batching window of the helper calls
+            "acreate_conversation_from_context": measure(
+                lambda: asyncio.run(acreate_conversation_from_context(next(contexts), "kind", DEFAULT_CONFIG_PATH)),
+                20,
+            ),
+            f"acreate_conversation_from_context_{concurrent}_concurrent": measure(
+                lambda: asyncio.run(acreate_concurrently()), 1
+            ),
+        }
+    stats = results[f"acreate_conversation_from_context_{concurrent}_concurrent"]
+    stats.update(median_us=stats["median_us"] / concurrent, best_us=stats["best_us"] / concurrent,
+                 ops_per_second=stats["ops_per_second"] * concurrent)
+    return results
+
+
+def get_metadata() -> Dict[str, str]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = "unknown"
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+    }
+
+
+def compare(results: Dict[str, Results], baseline: Dict[str, Results], tolerance: float) -> List[str]:
+    """
+    Compare the median times with a previous run.
+
+    Args:
+        results: The results of this run.
+        baseline: The results of the previous run.
+        tolerance: The allowed slowdown, 0.25 for 25%.
+
+    Returns: The operations slower than the tolerance allows.
+    """
+    regressions = []
+    for group, operations in results.items():
+        for operation, stats in operations.items():
+            previous = baseline.get(group, {}).get(operation)
+            if previous is None:
+                continue
+            ratio = stats["median_us"] / previous["median_us"]
+            print(f"{group}.{operation}: {ratio:.2f}x the baseline")
+            if ratio > 1 + tolerance:
+                regressions.append(f"{group}.{operation}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Run at a smaller scale")
+    parser.add_argument("--output", type=Path, default=Path("microbench.json"))
+    parser.add_argument("--compare", type=Path, help="A previous output to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="The allowed slowdown against --compare")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        start = time.perf_counter()
+        results[name] = BENCHMARKS[name](args)
+        print(f"{name} ({time.perf_counter() - start:.1f}s)")
+        for operation, stats in results[name].items():
+            print(f"  {operation}: {stats['median_us']:.1f}us")
+
+    args.output.write_text(json.dumps({"metadata": get_metadata(), "results": results}, indent=2))
+    print(f"Results saved to {args.output}")
+
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            raise SystemExit(f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Send many /start commands through the real dispatcher and check that routing cost stays flat.
+
+With ``--check`` it runs fewer commands, enough to see the handler list or the dispatch time grow.
+The conversations are kept in a temporary directory and the language models are offline fakes
+without a generation cache, so the benchmark never touches the database of the bot.
+
+Usage:
+    python -m benchmarks.onboarding_dispatch --starts 10000
+    python -m benchmarks.onboarding_dispatch --check
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456789:AAbenchmarkbenchmarkbenchmarkbenchm")
+
+import app  # noqa: E402
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+
+from benchmarks.fake_llm import FakeLLMRegistry  # noqa: E402
+from converbot.database import ConversationDB  # noqa: E402
+
+
+async def fake_send(*args, **kwargs):
+    return None
+
+
+def make_update(update_id: int, user_id: int, text: str) -> types.Update:
+    return types.Update(**{
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        },
+    })
+
+
+def create_temporary_app(tmp: Path) -> None:
+    """
+    Build the app with its conversations in the temporary directory and offline language models.
+    """
+    FakeLLMRegistry(latency=0.0).install()
+    app.create_app(conversations_db=ConversationDB(
+        chat_history_save_dir=tmp / "history", conversation_save_dir=tmp / "db"
+    ))
+
+
+async def timed_dispatch(updates) -> float:
+    start = time.perf_counter()
+    for update in updates:
+        # Every update gets its own task, as in polling, so per-update context vars do not leak
+        await asyncio.create_task(app.dispatcher.process_update(update))
+    return (time.perf_counter() - start) / len(updates)
+
+
+async def run(starts: int, probe: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        create_temporary_app(Path(tmp))
+        await dispatch_starts(starts, probe)
+
+
+async def dispatch_starts(starts: int, probe: int) -> None:
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dispatcher)
+    app.bot.send_message = fake_send
+    app.bot.send_chat_action = fake_send
+
+    handlers_before = len(app.dispatcher.message_handlers.handlers)
+    first = await timed_dispatch([make_update(i, i, "/start") for i in range(probe)])
+    await timed_dispatch([make_update(i, i, "/start") for i in range(probe, starts)])
+    last = await timed_dispatch([make_update(starts + i, starts + i, "/start") for i in range(probe)])
+    handlers_after = len(app.dispatcher.message_handlers.handlers)
+
+    print(f"message handlers: {handlers_before} before, {handlers_after} after {starts} /start commands")
+    print(f"dispatch time: first {probe}: {first * 1e6:.1f}us/update, last {probe}: {last * 1e6:.1f}us/update")
+    if handlers_after != handlers_before:
+        raise SystemExit("Handler list grew while processing /start")
+    if last > 3 * first:
+        raise SystemExit("Dispatch time grew while processing /start")
+
+
+def check() -> None:
+    """
+    Check that the message handlers and the dispatch time do not grow with the /start commands.
+    """
+    asyncio.run(run(2000, 200))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--starts", type=int, default=10000)
+    parser.add_argument("--probe", type=int, default=500)
+    parser.add_argument("--check", action="store_true", help="Only run enough commands for the check")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.starts, args.probe))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Measure the wait at the end of the onboarding and on the first turn, with and without speculative persona preprocessing.
+
+Simulated users go through the onboarding of the real dispatcher, answering every question
+after a think time, then send their first message. Without speculation the texting style and
+the tone are generated once the personality is known, while the user waits for "One moment...".
+With it the texting style is drafted while the user describes the personality, and refined and
+the tone generated while the user types the first message.
+
+The Telegram API and the language models are offline fakes, latencies are distribution specs,
+see ``benchmarks.fake_llm.Distribution``.
+
+Usage:
+    python -m benchmarks.onboarding_overlap --users 50 --helper-latency lognormal:1.5:0.3 --think-time fixed:3
+"""
+import argparse
+import asyncio
+import functools
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456789:AAbenchmarkbenchmarkbenchmarkbenchm")
+
+import app  # noqa: E402
+from aiogram import Bot, Dispatcher  # noqa: E402
+
+from benchmarks.fake_llm import Distribution, FakeLLMRegistry, SampledLatencyLLM  # noqa: E402
+from benchmarks.load_test import ONBOARDING, FakeTelegram, percentiles  # noqa: E402
+from benchmarks.onboarding_dispatch import make_update  # noqa: E402
+from converbot.database import ConversationDB  # noqa: E402
+from converbot.reply import ProgressiveReply  # noqa: E402
+
+
+async def run(args: argparse.Namespace, speculative: bool, first_user_id: int) -> Dict[str, object]:
+    registry = FakeLLMRegistry(latency=0.0)
+    registry.helper_llm = SampledLatencyLLM(
+        latency_distribution=Distribution(args.helper_latency, seed=args.seed),
+        length_distribution=Distribution("fixed:40"),
+    )
+    registry.chat_llm.latency = args.chat_latency
+    registry.install()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.create_app(conversations_db=ConversationDB(Path(tmp) / "history", Path(tmp) / "db"))
+        FakeTelegram(args.api_latency).install(app.bot)
+        Bot.set_current(app.bot)
+        Dispatcher.set_current(app.dispatcher)
+        app.ProgressiveReply = functools.partial(ProgressiveReply, seconds_per_char=0.0)
+        if not speculative:
+            app.PERSONA_PREPROCESSOR.draft_text_style = lambda user_id, context: None
+        app.CONVERSATIONS_DB.history_writer.start()
+
+        think_time = Distribution(args.think_time, seed=args.seed + 1)
+        update_ids = iter(range(first_user_id, first_user_id + 10 ** 6))
+        final_waits: List[float] = []
+        first_turns: List[float] = []
+        loop = asyncio.get_running_loop()
+
+        async def send(user_id: int, text: str) -> float:
+            start = loop.time()
+            await asyncio.create_task(app.dispatcher.process_update(make_update(next(update_ids), user_id, text)))
+            return loop.time() - start
+
+        async def simulate_user(user_id: int) -> None:
+            await asyncio.sleep(think_time.sample())
+            for text in ONBOARDING[:-1]:
+                await send(user_id, text)
+                await asyncio.sleep(think_time.sample())
+            final_waits.append(await send(user_id, ONBOARDING[-1]))
+            await asyncio.sleep(think_time.sample())
+            first_turns.append(await send(user_id, "Hi! How are you?"))
+
+        await asyncio.gather(*(simulate_user(first_user_id + index) for index in range(args.users)))
+        await app.CONVERSATIONS_DB.history_writer.close()
+        app.CONVERSATIONS_DB._dirty.clear()
+
+    return {
+        "final_wait": percentiles(final_waits),
+        "first_turn": percentiles(first_turns),
+        "helper_requests": registry.helper_llm.requests,
+        "preprocessor": app.PERSONA_PREPROCESSOR.stats,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--think-time", default="fixed:3", help="The time the user takes to answer a question")
+    parser.add_argument("--helper-latency", default="lognormal:1.5:0.3",
+                        help="The latency of the texting style, refinement and tone generations")
+    parser.add_argument("--chat-latency", type=float, default=1.0, help="The latency of a chat completion")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="The latency of a Telegram API call")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for index, speculative in enumerate((False, True)):
+        results = asyncio.run(run(args, speculative, first_user_id=10 ** 9 + index * 10 ** 6))
+
+        def ms(stats: Dict[str, float]) -> str:
+            return ", ".join(f"{name} {value * 1000:.0f}ms" for name, value in stats.items())
+
+        print(f"{'speculative' if speculative else 'sequential'}:")
+        print(f"  wait after the personality: {ms(results['final_wait'])}")
+        print(f"  first turn: {ms(results['first_turn'])}")
+        print(f"  helper requests: {results['helper_requests']}, preprocessor: {results['preprocessor']}")
+
+
+if __name__ == "__main__":
+    main()
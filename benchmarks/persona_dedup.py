@@ -0,0 +1,134 @@
+"""
+Measure how much the persona registry and the coalescing of helper generations save when many users pick the same persona.
+
+Simulated users sign up with one of a few preset personas, typed with different case and
+spacing. First, all of them ask for the texting style of their persona at once: without
+coalescing every one of them misses the cache and sends a generation, with it the users of
+a persona share one. Then a conversation is built for every user, each compiling its own
+prompt or sharing one per persona and case from the registry, and the traced memory per
+conversation is compared.
+
+The language models are offline fakes. With ``--check`` it only checks that personas differing
+in case get their own prompts and personas differing in spacing share one.
+
+Usage:
+    python -m benchmarks.persona_dedup --users 2000 --personas 20 --helper-latency 0.5
+    python -m benchmarks.persona_dedup --check
+"""
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+from typing import List, Tuple
+
+from benchmarks.fake_llm import FakeLLMRegistry
+from converbot.core import GPT3Conversation
+from converbot.persona_registry import PersonaRegistry
+
+NAMES = ["Ann", "Kate", "Mia", "Zoe", "Lily", "Emma", "Ava", "Chloe", "Ella", "Grace"]
+INTERESTS = ["skiing", "painting", "jazz", "hiking", "cooking", "chess", "surfing", "reading"]
+
+
+def persona_context(persona: int) -> str:
+    return f"Name: {NAMES[persona % len(NAMES)]}\nAge: {20 + persona % 15}\nGender: female\n" \
+           f"interests: {INTERESTS[persona % len(INTERESTS)]}\nProfession: developer\n" \
+           f"Appearance: tall\nRelationship status: single\n"
+
+
+def typed_variant(text: str, user_id: int) -> str:
+    # The same preset, as different clients and users send it
+    if user_id % 3 == 1:
+        return text.upper()
+    if user_id % 3 == 2:
+        return text.replace(" ", "  ").replace("\n", " \n")
+    return text
+
+
+def make_registry(helper_latency: float) -> FakeLLMRegistry:
+    registry = FakeLLMRegistry(latency=0.0, generation_cache_size=1024, helper_batch_size=0)
+    registry.helper_llm.latency = helper_latency
+    registry.install()
+    # Keep the runs independent of the disk tier of the cache
+    registry.text_style_handler()._cache._save_dir = None
+    return registry
+
+
+async def generate_text_styles(contexts: List[str], helper_latency: float, coalesce: bool) -> Tuple[float, int]:
+    registry = make_registry(helper_latency)
+    handler = registry.text_style_handler()
+
+    async def without_coalescing(context: str) -> str:
+        cached = handler._cache.get(context)
+        return cached if cached is not None else await handler._acall_uncached(context)
+
+    call = handler.acall if coalesce else without_coalescing
+    start = time.perf_counter()
+    await asyncio.gather(*(call(context) for context in contexts))
+    return time.perf_counter() - start, registry.helper_llm.requests
+
+
+def build_conversations(contexts: List[str], share: bool) -> Tuple[float, float, dict]:
+    registry = make_registry(0.0)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    conversations = []
+    for context in contexts:
+        if not share:
+            registry._personas = PersonaRegistry()
+        conversations.append(
+            GPT3Conversation.from_persona(context, "Short messages, lots of emojis.", "kind", process_tone=False)
+        )
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / len(conversations), elapsed, registry.personas.stats
+
+
+def check() -> None:
+    """
+    Check that personas differing in case get their own prompts and personas differing in spacing share one.
+    """
+    make_registry(0.0)
+    context = persona_context(0)
+    original, upper, spaced = (
+        GPT3Conversation.from_persona(typed_variant(context, user_id), "Short messages.", "kind", process_tone=False)
+        for user_id in range(3)
+    )
+    if upper._prompt is original._prompt or upper._prompt.context != context.upper():
+        raise SystemExit("A persona differing in case got the prompt of another user")
+    if spaced._prompt is not original._prompt:
+        raise SystemExit("A persona differing in spacing compiled its own prompt")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--personas", type=int, default=20, help="The number of distinct preset personas")
+    parser.add_argument("--helper-latency", type=float, default=0.5, help="The latency of a texting style generation")
+    parser.add_argument("--check", action="store_true", help="Only check the sharing of the personas")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+
+    contexts = [typed_variant(persona_context(user_id % args.personas), user_id) for user_id in range(args.users)]
+
+    print(f"{args.users} users over {args.personas} personas, texting styles generated at once:")
+    for coalesce in (False, True):
+        elapsed, requests = asyncio.run(generate_text_styles(contexts, args.helper_latency, coalesce))
+        print(f"  {'coalesced' if coalesce else 'cache only':>10}: {requests} generations in {elapsed:.2f}s")
+
+    print("conversations built:")
+    for share in (False, True):
+        per_conversation, elapsed, stats = build_conversations(contexts, share)
+        print(f"  {'shared' if share else 'own prompt':>10}: {per_conversation / 1024:.1f}KiB traced per conversation, "
+              f"built in {elapsed * 1000 / len(contexts):.2f}ms each, live personas {stats['live']}, "
+              f"dedup ratio {stats['dedup_ratio']:.1f}")
+
+
+if __name__ == "__main__":
+    main()
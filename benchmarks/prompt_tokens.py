@@ -0,0 +1,106 @@
+"""
+Compare the persona prompt before and after the prompt compiler, section by section.
+
+The legacy prompt is the plain concatenation the persona prompt used to be. The compiled one
+sends the repeated instructions once. The shipped configuration has no budget for the persona
+sections, so a persona is never cut; a second persona with a very long description shows what
+``--persona-budget`` would cut.
+
+With ``--check`` it only checks that the shipped configuration keeps a very long persona whole.
+
+Tokens are counted with tiktoken when its encoding can be loaded, words are counted otherwise.
+
+Usage:
+    python -m benchmarks.prompt_tokens --turns-per-day 100000 --persona-budget 300
+    python -m benchmarks.prompt_tokens --check
+"""
+import argparse
+import dataclasses
+import time
+from typing import Callable
+
+from converbot.config import RomanitcConversationConfig
+from converbot.constants import DEFAULT_CONFIG_PATH
+from converbot.prompt import AI_MODEL_INSTRUCTIONS, PersonaPrompt
+from converbot.prompt_compiler import PromptCompiler
+from converbot.tokens import get_encoding
+
+CONTEXT = "Name: Ann\nAge: 25\nGender: female\ninterests: skiing\nProfession: developer\n" \
+          "Appearance: tall\nRelationship status: single\nPersonality: kind and curious\n"
+TEXT_STYLE = " Short messages, lowercase, lots of emojis, asks a question back."
+
+
+def legacy_prompt_text(prompt_template: str, context: str, text_style: str) -> str:
+    return prompt_template + "\n" + AI_MODEL_INSTRUCTIONS + "\n\nInformation about [Bot]:\n" + context + \
+        "\n\nFollowing text defines [Bot] texting style and messaging style:" + text_style + \
+        "\n\n" + AI_MODEL_INSTRUCTIONS + \
+        "\n\nConversation:\n[Bot]: Lets start the conversation, can you tell me a little about yourself?"
+
+
+def get_counter(model_name: str) -> Callable[[str], int]:
+    try:
+        encoding = get_encoding(model_name)
+        print(f"Counting tokens with the {encoding.name} encoding")
+        return lambda text: len(encoding.encode(text))
+    except Exception as e:
+        print(f"Counting words, the tiktoken encoding is not available: {type(e).__name__}")
+        return lambda text: len(text.split())
+
+
+def long_context() -> str:
+    return CONTEXT + "Backstory: " + " ".join(["She grew up by the sea and loves long walks."] * 100)
+
+
+def compare(name: str, config: RomanitcConversationConfig, count_tokens: Callable[[str], int],
+            context: str, turns_per_day: int) -> None:
+    legacy = count_tokens(legacy_prompt_text(config.prompt_template, context, TEXT_STYLE))
+    compiler = PromptCompiler(count_tokens, config.prompt_budgets)
+    start = time.perf_counter()
+    prompt = PersonaPrompt(config.prompt_template, context, TEXT_STYLE, compiler=compiler)
+    compile_ms = (time.perf_counter() - start) * 1000
+    compiled = count_tokens(prompt.prompt_text)
+
+    print(f"{name}:")
+    print(f"  sections: {prompt.compiled.section_tokens}, budgets: {config.prompt_budgets}")
+    print(f"  removed paragraphs: {prompt.compiled.removed_paragraphs}, "
+          f"truncated sections: {prompt.compiled.truncated_sections or 'none'}, compiled in {compile_ms:.2f}ms")
+    print(f"  prompt text: {legacy} -> {compiled} tokens per turn ({(legacy - compiled) / legacy:.1%} less), "
+          f"{(legacy - compiled) * turns_per_day:,} tokens saved per {turns_per_day:,} turns")
+
+
+def check() -> None:
+    """
+    Check that the prompt budgets of the shipped configuration never cut a persona, only dedupe it.
+    """
+    config = RomanitcConversationConfig.from_json(DEFAULT_CONFIG_PATH)
+    context = long_context()
+    compiler = PromptCompiler(lambda text: len(text.split()), config.prompt_budgets)
+    prompt = PersonaPrompt(config.prompt_template, context, TEXT_STYLE, compiler=compiler)
+    if prompt.compiled.truncated_sections:
+        raise SystemExit(f"The shipped prompt budgets cut the sections {prompt.compiled.truncated_sections}")
+    if context.strip() not in prompt.prompt_text or TEXT_STYLE.strip() not in prompt.prompt_text:
+        raise SystemExit("The compiled prompt lost a part of the persona")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns-per-day", type=int, default=100_000)
+    parser.add_argument("--persona-budget", type=int, default=None,
+                        help="A budget of the persona section for the very long persona, none by default")
+    parser.add_argument("--check", action="store_true", help="Only check that the shipped budgets cut no persona")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+
+    config = RomanitcConversationConfig.from_json(DEFAULT_CONFIG_PATH)
+    count_tokens = get_counter(config.model)
+    compare("typical persona", config, count_tokens, CONTEXT, args.turns_per_day)
+    if args.persona_budget is not None:
+        config = dataclasses.replace(config, prompt_budgets={**config.prompt_budgets, "persona": args.persona_budget})
+    compare("very long persona", config, count_tokens, long_context(), args.turns_per_day)
+
+
+if __name__ == "__main__":
+    main()
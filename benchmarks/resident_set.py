@@ -0,0 +1,191 @@
+"""
+Measure the memory of ConversationDB with and without a bound on the resident conversations,
+and the latency of evicting and rehydrating conversations.
+
+With ``--check`` it only checks that evicting never writes to the store, that the evicted
+conversations are saved by the next checkpoint and that restoring a conversation does not block
+the event loop.
+
+Usage:
+    python -m benchmarks.resident_set --users 20000 --max-resident 1000 --turns 2000
+    python -m benchmarks.resident_set --check
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from benchmarks.checkpoint_cost import build_conversation
+from benchmarks.fake_llm import FakeLLMRegistry
+from converbot.core import GPT3Conversation
+from converbot.database import ConversationDB
+from converbot.store import ConversationStore
+
+
+class CountingStore(ConversationStore):
+    """A store counting its writes."""
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.writes = 0
+
+    def save_many(self, snapshots, skip=None):
+        self.writes += 1
+        return super().save_many(snapshots, skip)
+
+
+class SlowLoadStore(ConversationStore):
+    """A store whose loads take 0.2s, like a busy disk."""
+
+    def load(self, user_id):
+        time.sleep(0.2)
+        return super().load(user_id)
+
+
+async def run(users: int, max_resident: Optional[int], turns: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        tracemalloc.start()
+        db = ConversationDB(
+            chat_history_save_dir=Path(tmp) / "history",
+            conversation_save_dir=Path(tmp) / "db",
+            max_resident=max_resident,
+            idle_timeout=None,
+        )
+        for user_id in range(users):
+            db.add_conversation(user_id, build_conversation(user_id))
+
+        # Most messages come from a small group of returning users
+        start = time.perf_counter()
+        for _ in range(turns):
+            user_id = min(int(random.paretovariate(1.0)) - 1, users - 1)
+            conversation = await db.aget_conversation(user_id)
+            await conversation.aask("Hello, how are you?")
+        elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = db.stats
+        label = "unbounded" if max_resident is None else f"max {max_resident}"
+        print(f"{label:>10}: {stats['resident']} resident, {current / 2 ** 20:.0f}MiB traced "
+              f"(peak {peak / 2 ** 20:.0f}MiB), {turns} turns in {elapsed:.2f}s, "
+              f"{stats['evictions']} evictions in {stats['eviction_seconds']:.2f}s, "
+              f"{stats['rehydrations']} rehydrations of {stats['mean_rehydration_seconds'] * 1000:.2f}ms")
+
+
+async def check_eviction() -> None:
+    FakeLLMRegistry(latency=0.0).install()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = CountingStore(Path(tmp) / "conversations.sqlite3")
+        db = ConversationDB(
+            chat_history_save_dir=Path(tmp) / "history",
+            conversation_save_dir=Path(tmp) / "db",
+            store=store,
+            max_resident=2,
+            idle_timeout=None,
+        )
+        for user_id in range(3):
+            db.add_conversation(user_id, build_conversation(user_id))
+        if store.writes:
+            raise SystemExit("Evicting a conversation wrote to the store on the event loop")
+        if db.get_conversation(0) is None:
+            raise SystemExit("A conversation evicted before the checkpoint was lost")
+        if db.stats["evictions"] != 2:
+            raise SystemExit(f"{db.stats['evictions']} evictions instead of 2")
+        await db.acheckpoint()
+        if db.stats["evicted_unsaved"]:
+            raise SystemExit(f"{db.stats['evicted_unsaved']} evicted conversations left unsaved by the checkpoint")
+        if len(store) != 3:
+            raise SystemExit(f"The checkpoint saved {len(store)} of 3 conversations")
+
+
+async def measure_stall(coroutine) -> Tuple[object, float]:
+    """Await the coroutine and return its result and the longest time the event loop was blocked meanwhile."""
+    stall = 0.0
+
+    async def tick() -> None:
+        nonlocal stall
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stall = max(stall, time.perf_counter() - before - 0.01)
+
+    ticker = asyncio.ensure_future(tick())
+    await asyncio.sleep(0.02)
+    try:
+        result = await coroutine
+        # Let the ticker measure the last wait
+        await asyncio.sleep(0.02)
+        return result, stall
+    finally:
+        ticker.cancel()
+
+
+async def check_restore() -> None:
+    FakeLLMRegistry(latency=0.0).install()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SlowLoadStore(Path(tmp) / "conversations.sqlite3")
+        kwargs = dict(
+            chat_history_save_dir=Path(tmp) / "history",
+            conversation_save_dir=Path(tmp) / "db",
+            store=store,
+            max_resident=1,
+            idle_timeout=None,
+        )
+        db = ConversationDB(**kwargs)
+        for user_id in range(2):
+            db.add_conversation(user_id, build_conversation(user_id))
+        await db.acheckpoint()
+
+        # Cold: only in the store
+        db = ConversationDB(**kwargs)
+        async def restore_concurrently() -> List[Optional[GPT3Conversation]]:
+            return await asyncio.gather(*(db.aget_conversation(0) for _ in range(3)))
+
+        conversations, stall = await measure_stall(restore_concurrently())
+        if stall > 0.1:
+            raise SystemExit(f"Restoring a conversation from the store stalled the event loop for {stall:.2f}s")
+        if conversations[0] is None or any(conversation is not conversations[0] for conversation in conversations):
+            raise SystemExit("Concurrent restores of a conversation did not return the same conversation")
+        if db.stats["rehydrations"] != 1:
+            raise SystemExit(f"{db.stats['rehydrations']} restores of one conversation instead of 1")
+
+        # Evicted by the restore of another user before a checkpoint
+        await db.aget_conversation(1)
+        conversation = await db.aget_conversation(0)
+        if conversation is None or conversation.snapshot() != conversations[0].snapshot():
+            raise SystemExit("An evicted conversation was not restored")
+        if await db.aget_conversation(2) is not None:
+            raise SystemExit("A conversation was restored for a user without one")
+
+
+def check() -> None:
+    """
+    Check that evicting never writes to the store, that the next checkpoint saves the evicted conversations
+    and that restores run off the event loop.
+    """
+    asyncio.run(check_eviction())
+    asyncio.run(check_restore())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--max-resident", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--check", action="store_true", help="Only check the eviction and the restores")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    FakeLLMRegistry(latency=0.0).install()
+    asyncio.run(run(args.users, None, args.turns))
+    asyncio.run(run(args.users, args.max_resident, args.turns))
+
+
+if __name__ == "__main__":
+    main()
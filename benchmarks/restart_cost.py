@@ -0,0 +1,75 @@
+"""
+Measure how long it takes to bring back the conversations from their snapshots after a restart,
+decoding the snapshots inline, in a thread pool or in a process pool.
+
+Usage:
+    python -m benchmarks.restart_cost --users 100000 --workers 4
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from benchmarks.checkpoint_cost import build_conversation
+from benchmarks.fake_llm import FakeLLMRegistry
+from converbot.database import ConversationDB
+from converbot.snapshot import decode_snapshots
+
+
+async def populate(save_dir: Path, users: int) -> None:
+    db = ConversationDB(chat_history_save_dir=save_dir / "history", conversation_save_dir=save_dir / "db",
+                        max_resident=None)
+    for user_id in range(users):
+        conversation = build_conversation(user_id)
+        # A few turns of history, like a returning user
+        for turn in range(3):
+            await conversation.aask(f"This is message number {turn}")
+        db.add_conversation(user_id, conversation)
+    await db.acheckpoint()
+    snapshot_bytes = sum(len(data) for _, data in db._store.load_recent(1000)) / min(users, 1000)
+    print(f"{users} snapshots saved, {snapshot_bytes:.0f} bytes per snapshot")
+
+
+def restore(save_dir: Path, label: str, executor: Optional[Executor]) -> None:
+    db = ConversationDB(chat_history_save_dir=save_dir / "history", conversation_save_dir=save_dir / "db",
+                        max_resident=None)
+    start = time.perf_counter()
+    rows = db._store.load_recent()
+    read = time.perf_counter() - start
+    chunks = [rows[i:i + 1000] for i in range(0, len(rows), 1000)]
+    start = time.perf_counter()
+    list(executor.map(decode_snapshots, chunks) if executor else map(decode_snapshots, chunks))
+    decode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    restored = db.preload(executor=executor)
+    total = time.perf_counter() - start
+    print(f"{label:>14}: read {read:.2f}s, decode {decode:.2f}s, preload of {restored} conversations {total:.2f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    FakeLLMRegistry(latency=0.0).install()
+    with tempfile.TemporaryDirectory() as tmp:
+        save_dir = Path(tmp)
+        asyncio.run(populate(save_dir, args.users))
+        restore(save_dir, "inline", None)
+        with ThreadPoolExecutor(args.workers) as executor:
+            restore(save_dir, f"{args.workers} threads", executor)
+        with ProcessPoolExecutor(args.workers) as executor:
+            restore(save_dir, f"{args.workers} processes", executor)
+
+        db = ConversationDB(chat_history_save_dir=save_dir / "history", conversation_save_dir=save_dir / "db")
+        start = time.perf_counter()
+        db.get_conversation(args.users // 2)
+        print(f"{'lazy':>14}: first access to one conversation {(time.perf_counter() - start) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Measure the retrieval memory of a user with a very long chat history: index updates, searches and the cold load.
+
+A synthetic chat history is generated, words drawn from a Zipf distribution like natural
+text, with a fact planted among the first turns. The turns are added to the index one by one
+as write_chat_history does, the latency of the searches is measured as the index grows, and
+the rank of the planted fact shows that it is still found among all the turns. Then the
+history is written to a chat history file and the index is rebuilt from it, as on the first
+turn of the user after a restart.
+
+Usage:
+    python -m benchmarks.retrieval_memory --turns 100000 --queries 200
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from converbot.history import ChatHistoryWriter
+from converbot.retrieval import RetrievalIndex, RetrievalStore
+
+FACT = ("I have a dog, his name is Rex", "Rex is such a cute name for a dog!")
+FACT_QUERY = "do you remember the name of my dog?"
+
+
+def generate_turns(turns: int, vocabulary: int, seed: int) -> List[Tuple[str, str]]:
+    random = np.random.default_rng(seed)
+    words = random.zipf(1.2, size=turns * 40) % vocabulary
+    lengths = random.integers(3, 30, size=(turns, 2))
+    generated = []
+    offset = 0
+    for message_length, response_length in lengths:
+        message = " ".join(f"w{word}" for word in words[offset:offset + message_length])
+        offset += message_length
+        response = " ".join(f"w{word}" for word in words[offset:offset + response_length])
+        offset += response_length
+        generated.append((message, response))
+    generated[10] = FACT
+    return generated
+
+
+def ms(samples: List[float]) -> str:
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return f"p50 {statistics.median(samples) * 1000:.3f}ms, p99 {p99 * 1000:.3f}ms"
+
+
+def measure_growth(turns: List[Tuple[str, str]], queries: List[str], top_k: int) -> None:
+    index = RetrievalIndex()
+    checkpoints = [size for size in (1000, 10000, 100000, 1000000) if size < len(turns)] + [len(turns)]
+    add_seconds: List[float] = []
+    for user_message, chatbot_response in turns:
+        start = time.perf_counter()
+        index.add(user_message, chatbot_response)
+        add_seconds.append(time.perf_counter() - start)
+        if len(index) not in checkpoints:
+            continue
+
+        search_seconds = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query, top_k, exclude_last=10)
+            search_seconds.append(time.perf_counter() - start)
+        ranks = [turn.position for turn in index.search(FACT_QUERY, len(index))]
+        rank = ranks.index(10) + 1 if 10 in ranks else None
+        print(f"  {len(index):>8} turns: add {ms(add_seconds)}, search {ms(search_seconds)}, "
+              f"planted fact ranked {rank} of {len(index)}")
+        add_seconds = []
+
+
+def measure_memory(turns: List[Tuple[str, str]]) -> None:
+    tracemalloc.start()
+    index = RetrievalIndex()
+    for user_message, chatbot_response in turns:
+        index.add(user_message, chatbot_response)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    text_bytes = sum(len(message) + len(response) for message, response in turns)
+    print(f"  index of {len(index)} turns: {current / 2 ** 20:.1f}MiB traced, "
+          f"{text_bytes / 2 ** 20:.1f}MiB of it the text of the turns")
+
+
+async def measure_cold_load(turns: List[Tuple[str, str]], top_k: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = ChatHistoryWriter(Path(tmp), batch_size=10000)
+        writer.start()
+        for user_message, chatbot_response in turns:
+            writer.write(0, user_message, chatbot_response)
+        await writer.close()
+
+        store = RetrievalStore(Path(tmp), writer)
+        start = time.perf_counter()
+        await store.asearch(0, FACT_QUERY, top_k)
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        await store.asearch(0, FACT_QUERY, top_k)
+        second = time.perf_counter() - start
+        print(f"  first search, loading {len(turns)} turns from the chat history file: {first:.2f}s, "
+              f"next search: {second * 1000:.3f}ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=100000, help="The number of turns of the user")
+    parser.add_argument("--queries", type=int, default=200, help="The number of searches per measurement")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    turns = generate_turns(args.turns, args.vocabulary, args.seed)
+    queries = [message for message, _ in generate_turns(args.queries, args.vocabulary, args.seed + 1)]
+
+    print("incremental index, as the turns are written:")
+    measure_growth(turns, queries, args.top_k)
+    print("memory:")
+    measure_memory(turns)
+    print("cold load:")
+    asyncio.run(measure_cold_load(turns, args.top_k))
+
+
+if __name__ == "__main__":
+    main()
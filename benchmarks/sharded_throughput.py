@@ -0,0 +1,203 @@
+"""
+Compare the update throughput of the sharded mode with 1, 2, 4 and 8 worker processes.
+
+A fake Telegram source plays the onboarding and a few chat messages for every user through
+the real router and the real dispatcher of each shard; the bot API and the language models
+are offline fakes.
+
+With ``--check`` it only checks, against an in-process fake worker, that the router sends the
+updates of a worker that closes its connection again once reconnected, fails the ones that keep
+closing it, times out unacknowledged updates and waits for the updates in flight when closing.
+
+Usage:
+    python -m benchmarks.sharded_throughput --users 500 --messages 3 --shards 1 2 4 8
+    python -m benchmarks.sharded_throughput --check
+"""
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Set
+
+from converbot.sharding import ShardRouter, ShardUnavailableError
+
+ONBOARDING = ["/start", "Ann", "25", "female", "skiing", "developer", "tall", "single", "kind"]
+
+
+def _run_fake_shard(socket_path: Path, save_dir: Path, latency: float) -> None:
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456789:AAbenchmarkbenchmarkbenchmarkbenchm")
+    from benchmarks.fake_llm import FakeLLMRegistry
+    from converbot.database import ConversationDB
+    from converbot.history import ChatHistoryWriter
+
+    registry = FakeLLMRegistry(latency=latency)
+    # A short reply, so the simulated typing delay stays short
+    registry.chat_llm.response = "ok"
+    registry.install()
+
+    import app
+
+    async def fake_send(*args, **kwargs):
+        return None
+
+    app.create_app(conversations_db=ConversationDB(
+        conversation_save_dir=save_dir / "db",
+        history_writer=ChatHistoryWriter(save_dir / "history"),
+    ))
+    app.bot.send_message = fake_send
+    app.bot.send_chat_action = fake_send
+    app.run_shard(socket_path)
+
+
+def make_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else [],
+        },
+    }
+
+
+async def play(router: ShardRouter, users: int, messages: int) -> int:
+    update_ids = itertools.count()
+
+    async def play_user(user_id: int) -> int:
+        texts = ONBOARDING + [f"message {i}" for i in range(messages)]
+        for text in texts:
+            # A user waits for the reply before sending the next message
+            await router.route(make_update(next(update_ids), user_id, text))
+        return len(texts)
+
+    return sum(await asyncio.gather(*(play_user(user_id) for user_id in range(1, users + 1))))
+
+
+def run(num_shards: int, users: int, messages: int, latency: float) -> None:
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_paths = [Path(tmp) / f"shard-{shard}.sock" for shard in range(num_shards)]
+        workers: List[multiprocessing.Process] = [
+            context.Process(target=_run_fake_shard, args=(socket_path, Path(tmp), latency))
+            for socket_path in socket_paths
+        ]
+        for worker in workers:
+            worker.start()
+
+        async def front() -> None:
+            router = ShardRouter(socket_paths)
+            await router.connect(timeout=120.0)
+            start = time.perf_counter()
+            updates = await play(router, users, messages)
+            elapsed = time.perf_counter() - start
+            await router.close()
+            print(f"{num_shards} shards: {updates} updates in {elapsed:.2f}s, {updates / elapsed:.0f} updates/s, "
+                  f"routed per shard {router.stats['routed']}")
+
+        try:
+            asyncio.run(front())
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+
+
+async def handle_fake_worker(
+    crashed: Set[int], reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    # "crash" closes the connection, "crash once" only the first time, "ignore" is never acknowledged,
+    # "slow" is acknowledged late
+    async def acknowledge(update: Dict[str, Any]) -> None:
+        await asyncio.sleep(0.2 if update["message"]["text"] == "slow" else 0.0)
+        writer.write(json.dumps({"update_id": update["update_id"]}).encode("utf-8") + b"\n")
+
+    async for line in reader:
+        update = json.loads(line)
+        text = update["message"]["text"]
+        if text == "crash" or text == "crash once" and update["update_id"] not in crashed:
+            crashed.add(update["update_id"])
+            writer.close()
+            return
+        if update["message"]["text"] != "ignore":
+            asyncio.ensure_future(acknowledge(update))
+
+
+async def check_router() -> None:
+    lost_shards = []
+
+    async def on_shard_lost(shard: int) -> None:
+        lost_shards.append(shard)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_path = Path(tmp) / "shard-0.sock"
+        server = await asyncio.start_unix_server(functools.partial(handle_fake_worker, set()), str(socket_path))
+        router = ShardRouter([socket_path], ack_timeout=0.5, on_shard_lost=on_shard_lost)
+        await router.connect()
+        update_ids = itertools.count()
+
+        async def outcome(text: str) -> str:
+            try:
+                await asyncio.wait_for(router.route(make_update(next(update_ids), 1, text)), 5.0)
+            except ShardUnavailableError:
+                return "unavailable"
+            except asyncio.TimeoutError:
+                return "timeout"
+            return "handled"
+
+        if await outcome("hi") != "handled":
+            raise SystemExit("An update was not handled")
+        if await outcome("crash once") != "handled" or lost_shards != [0]:
+            raise SystemExit("The update of a closed connection was not sent again after reconnecting")
+        if await outcome("crash") != "unavailable" or lost_shards != [0, 0, 0]:
+            raise SystemExit("An update closing the connection every time did not fail after its redelivery")
+        if await outcome("hi again") != "handled":
+            raise SystemExit("The router did not reconnect to the lost shard")
+        if await outcome("ignore") != "timeout":
+            raise SystemExit("An unacknowledged update did not time out")
+        slow = router.route(make_update(next(update_ids), 1, "slow"))
+        await router.close()
+        if not slow.done() or slow.exception() is not None:
+            raise SystemExit("Closing the router did not wait for the update in flight")
+        if router.stats["in_flight"] != [0] or router.stats["lost"] != [2] or router.stats["redelivered"] != [2]:
+            raise SystemExit(f"Unexpected router stats after closing: {router.stats}")
+        server.close()
+        # Let the fake worker read the end of the connection before the loop stops
+        await asyncio.sleep(0.1)
+
+
+def check() -> None:
+    """
+    Check that the router sends again, fails, times out and drains the updates of its workers.
+    """
+    asyncio.run(check_router())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=3, help="Chat messages per user after the onboarding")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per fake completion request")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--check", action="store_true", help="Only check the failures and the shutdown of the router")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    print(f"{os.cpu_count()} CPUs")
+    for num_shards in args.shards:
+        run(num_shards, args.users, args.messages, args.latency)
+
+
+if __name__ == "__main__":
+    main()
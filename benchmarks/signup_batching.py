@@ -0,0 +1,81 @@
+"""
+Simulate a burst of concurrent signups and count the completion requests of the helper chains.
+
+With ``--check`` it only checks that every batched completion is admitted once, not once per call,
+with the tokens of all its calls, and that the unbatched calls are admitted with their tokens.
+
+Usage:
+    python -m benchmarks.signup_batching --signups 200 --batch-size 20 --batch-wait 0.05
+    python -m benchmarks.signup_batching --check
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.fake_llm import FakeLLMRegistry
+from converbot.batching import estimate_tokens
+from converbot.bot_utils import acreate_conversation_from_context
+from converbot.constants import DEFAULT_CONFIG_PATH
+
+
+async def run(signups: int, latency: float, batch_size: int, batch_wait: float) -> None:
+    registry = FakeLLMRegistry(latency, helper_batch_size=batch_size, helper_batch_wait=batch_wait)
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        acreate_conversation_from_context(f"Name: User {i}\nPersonality: kind", "kind", DEFAULT_CONFIG_PATH, registry)
+        for i in range(signups)
+    ))
+    elapsed = time.perf_counter() - start
+    llm = registry.helper_llm
+    print(f"batch size {batch_size or 'off'}: {signups} signups, {llm.calls} generations "
+          f"in {llm.requests} requests, {elapsed:.3f}s")
+
+
+async def check_admission() -> None:
+    registry = FakeLLMRegistry(0.01, helper_batch_size=10, helper_batch_wait=0.05)
+    handler = registry.tone_handler()
+    await asyncio.gather(*(handler.acall(f"tone {i}") for i in range(30)))
+    admitted = registry.call_policy.admission.admitted
+    if registry.helper_llm.requests != 3 or admitted != 3:
+        raise SystemExit(f"30 batched calls sent {registry.helper_llm.requests} requests, admitted {admitted} times")
+    if handler.batch_stats["running"]:
+        raise SystemExit("A finished batch is still referenced")
+    expected = sum(estimate_tokens(handler._chain, {"user_input": f"tone {i}"}) for i in range(30))
+    admitted_tokens = registry.call_policy.admission.admitted_tokens
+    if admitted_tokens != expected:
+        raise SystemExit(f"30 batched calls were charged {admitted_tokens} tokens instead of {expected}")
+
+    registry = FakeLLMRegistry(0.01, helper_batch_size=0)
+    handler = registry.tone_handler()
+    await handler.acall("tone")
+    expected = estimate_tokens(handler._chain, {"user_input": "tone"})
+    admitted_tokens = registry.call_policy.admission.admitted_tokens
+    if admitted_tokens != expected:
+        raise SystemExit(f"An unbatched call was charged {admitted_tokens} tokens instead of {expected}")
+
+
+def check() -> None:
+    """
+    Check that every batched completion is admitted once, not once per call, and charged the tokens of its calls.
+    """
+    asyncio.run(check_admission())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--signups", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--batch-wait", type=float, default=0.05)
+    parser.add_argument("--check", action="store_true", help="Only check the admission of the batches")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.signups, args.latency, 0, args.batch_wait))
+    asyncio.run(run(args.signups, args.latency, args.batch_size, args.batch_wait))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Profile the startup of the bot: the time of every step and the import cost of every module.
+
+Every run starts a fresh interpreter with ``-X importtime`` and goes through the startup steps:
+importing app, create_app building the bot, the dispatcher and the database, and warm_up
+importing the language model stack and building the shared clients. The import time of a
+module is split into its own time, running the module body, and the time of the imports it
+triggers. Times are the medians over the runs.
+
+With ``--module`` only that module is imported, e.g. to check that a tool importing
+converbot.database does not load langchain.
+
+Usage:
+    python -m benchmarks.startup_time --runs 5 --top 15
+    python -m benchmarks.startup_time --module converbot.database
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+HEAVY_PACKAGES = ("aiogram", "aiohttp", "langchain", "openai", "tiktoken", "pydantic")
+STEP_MARKER = "startup step: "
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+APP_STARTUP = """
+import asyncio, contextlib, io, json, sys, tempfile, time
+from pathlib import Path
+
+def step(name):
+    sys.stderr.write("{marker}" + name + "\\n")
+    sys.stderr.flush()
+
+times = {{}}
+start = time.perf_counter()
+step("import app")
+import app
+times["import app"] = time.perf_counter() - start
+
+start = time.perf_counter()
+step("create_app")
+from converbot.database import ConversationDB
+save_dir = Path(tempfile.mkdtemp())
+app.create_app(conversations_db=ConversationDB(save_dir / "history", save_dir / "db"))
+times["create_app"] = time.perf_counter() - start
+
+start = time.perf_counter()
+step("warm_up")
+# The tokenizer download fails offline, warm_up prints the error
+with contextlib.redirect_stdout(io.StringIO()):
+    asyncio.run(app.warm_up())
+times["warm_up"] = time.perf_counter() - start
+print(json.dumps({{"steps": times, "loaded": [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+MODULE_IMPORT = """
+import json, sys, time
+sys.stderr.write("{marker}import {module}\\n")
+start = time.perf_counter()
+import {module}
+times = {{"import {module}": time.perf_counter() - start}}
+print(json.dumps({{"steps": times, "loaded": [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+# Per step, the own and cumulative import time of every module, in seconds
+ImportTimes = Dict[str, Dict[str, Tuple[float, float]]]
+
+
+def parse_import_times(stderr: str) -> ImportTimes:
+    """
+    Parse the ``-X importtime`` output, split by the step markers.
+
+    Args:
+        stderr: The standard error of the run.
+
+    Returns: The import times of the modules imported in every step.
+    """
+    steps: ImportTimes = defaultdict(dict)
+    step = "interpreter"
+    for line in stderr.splitlines():
+        if line.startswith(STEP_MARKER):
+            step = line[len(STEP_MARKER):]
+            continue
+        match = IMPORT_TIME_LINE.match(line)
+        if match is not None:
+            own, cumulative, _, module = match.groups()
+            steps[step][module] = (int(own) / 1e6, int(cumulative) / 1e6)
+    return steps
+
+
+def run_once(script: str) -> Tuple[float, dict, ImportTimes]:
+    env = dict(os.environ)
+    env.setdefault("TELEGRAM_BOT_TOKEN", "123456789:AAbenchmarkbenchmarkbenchmarkbenchm")
+    env.setdefault("OPENAI_API_KEY", "sk-startup-profile")
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script], capture_output=True, text=True, env=env
+    )
+    total = time.perf_counter() - start
+    if process.returncode != 0:
+        raise SystemExit(process.stderr[-2000:])
+    return total, json.loads(process.stdout.strip().splitlines()[-1]), parse_import_times(process.stderr)
+
+
+def median_import_times(runs: List[ImportTimes]) -> ImportTimes:
+    merged: Dict[str, Dict[str, List[Tuple[float, float]]]] = defaultdict(lambda: defaultdict(list))
+    for run in runs:
+        for step, modules in run.items():
+            for module, times in modules.items():
+                merged[step][module].append(times)
+    return {
+        step: {
+            module: (statistics.median(own for own, _ in times), statistics.median(cum for _, cum in times))
+            for module, times in modules.items()
+        }
+        for step, modules in merged.items()
+    }
+
+
+def print_report(totals: List[float], steps: Dict[str, List[float]], loaded: List[str],
+                 import_times: ImportTimes, top: int) -> None:
+    print(f"process: {statistics.median(totals) * 1000:.0f}ms from start to exit, median of {len(totals)} runs")
+    for step, seconds in steps.items():
+        modules = import_times.get(step, {})
+        imports = sum(own for own, _ in modules.values())
+        print(f"  {step:>28}: {statistics.median(seconds) * 1000:7.1f}ms, "
+              f"{len(modules)} modules imported in {imports * 1000:.1f}ms")
+    print(f"heavy packages loaded: {', '.join(loaded) or 'none'}")
+
+    packages: Dict[str, float] = defaultdict(float)
+    owns = []
+    for step, modules in import_times.items():
+        for module, (own, cumulative) in modules.items():
+            packages[module.split(".")[0]] += own
+            owns.append((own, cumulative, module, step))
+
+    print(f"\nimport time per top-level package (top {top}):")
+    for package, own in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {package:>28}: {own * 1000:7.1f}ms")
+
+    print(f"\nmodules with the most import time of their own (top {top}):")
+    print(f"  {'module':>40}  {'own':>8}  {'with imports':>12}  step")
+    for own, cumulative, module, step in sorted(owns, reverse=True)[:top]:
+        print(f"  {module:>40}  {own * 1000:6.1f}ms  {cumulative * 1000:10.1f}ms  {step}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="The number of modules and packages listed")
+    parser.add_argument("--module", help="Only import this module instead of going through the startup of the bot")
+    args = parser.parse_args()
+
+    if args.module is not None:
+        script = MODULE_IMPORT.format(marker=STEP_MARKER, module=args.module, heavy=HEAVY_PACKAGES)
+    else:
+        script = APP_STARTUP.format(marker=STEP_MARKER, heavy=HEAVY_PACKAGES)
+
+    totals = []
+    steps: Dict[str, List[float]] = defaultdict(list)
+    runs = []
+    for _ in range(args.runs):
+        total, result, import_times = run_once(script)
+        totals.append(total)
+        for step, seconds in result["steps"].items():
+            steps[step].append(seconds)
+        runs.append(import_times)
+    print_report(totals, steps, result["loaded"], median_import_times(runs), args.top)
+
+
+if __name__ == "__main__":
+    main()
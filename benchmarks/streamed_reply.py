@@ -0,0 +1,225 @@
+"""
+Compare when a reply becomes visible with the typing delay added after the generation and with
+a progressive reply streamed while it is generated.
+
+With ``--check`` it only checks that a retried streamed completion replaces the partial reply
+of the failed attempt instead of being appended to it, that an empty reply still answers, that
+failed edits and typing actions do not fail the reply and that a failed generation turns the
+partial reply into the error message.
+
+Usage:
+    python -m benchmarks.streamed_reply --chars 300 --first-token 1.0 --token-latency 0.05
+    python -m benchmarks.streamed_reply --check
+"""
+import argparse
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+
+import openai.error
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter
+from langchain.callbacks.base import CallbackManager
+from langchain.schema import LLMResult
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456789:AAbenchmarkbenchmarkbenchmarkbenchm")
+
+import app  # noqa: E402
+from benchmarks.checkpoint_cost import build_conversation  # noqa: E402
+from benchmarks.fake_llm import FakeLatencyLLM, FakeLLMRegistry  # noqa: E402
+from converbot.callbacks import TokenStreamCallback  # noqa: E402
+from converbot.reply import ProgressiveReply  # noqa: E402
+
+
+class FakeBot:
+    def __init__(self, api_latency: float) -> None:
+        self._api_latency = api_latency
+        self.start = time.perf_counter()
+        self.events = []
+        self.texts = []
+
+    async def _call(self, name: str):
+        await asyncio.sleep(self._api_latency)
+        self.events.append((name, time.perf_counter() - self.start))
+        return SimpleNamespace(message_id=1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.texts.append(text)
+        return await self._call("send")
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.texts.append(text)
+        return await self._call("edit")
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        return await self._call("typing")
+
+
+class FloodedBot(FakeBot):
+    """
+    Fake bot under flood control: the first edit must wait and the typing actions always fail.
+    """
+
+    def __init__(self, api_latency: float) -> None:
+        super().__init__(api_latency)
+        self.flooded = True
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        if self.flooded:
+            self.flooded = False
+            raise RetryAfter(0.2)
+        if text == self.texts[-1]:
+            raise MessageNotModified("Message is not modified")
+        return await super().edit_message_text(text, chat_id, message_id, **kwargs)
+
+    async def send_chat_action(self, chat_id, action, **kwargs):
+        raise RetryAfter(5)
+
+
+async def run(chars: int, first_token: float, token_latency: float, seconds_per_char: float, max_delay: float) -> None:
+    registry = FakeLLMRegistry(latency=0.0)
+    registry.chat_llm = FakeLatencyLLM(
+        response=" ".join(["word"] * (chars // 5)),
+        latency=first_token,
+        token_latency=token_latency,
+        callback_manager=CallbackManager([TokenStreamCallback()]),
+    )
+    registry.install()
+
+    # Typing delay added after the whole completion
+    conversation = build_conversation(0)
+    bot = FakeBot(api_latency=0.05)
+    response = await conversation.aask("Tell me about your day")
+    await bot.send_chat_action(0, "typing")
+    await asyncio.sleep(len(response) * seconds_per_char)
+    await bot.send_message(0, response)
+    shown = [at for name, at in bot.events if name == "send"][0]
+    print(f"   after generation: reply shown at {shown:.1f}s, complete at {shown:.1f}s")
+
+    # Progressive reply, the typing budget overlaps with the generation
+    conversation = build_conversation(1)
+    bot = FakeBot(api_latency=0.05)
+    reply = ProgressiveReply(bot, 0, seconds_per_char=seconds_per_char, max_delay=max_delay)
+    reply.start()
+    response = await conversation.aask("Tell me about your day", on_token=reply.add_token)
+    await reply.finish(response)
+    complete = bot.events[-1][1]
+    print(f"progressive reply: reply shown at {reply.first_shown_after:.1f}s, complete at {complete:.1f}s, "
+          f"{reply.edits} edits, {reply.typing_actions} typing actions")
+
+
+class FlakyStreamLLM(FakeLatencyLLM):
+    """
+    Fake language model whose first completion streams part of its response and then fails.
+    """
+
+    failed: bool = False
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        if self.failed:
+            return await super()._agenerate(prompts, stop)
+        self.failed = True
+        for word in "this attempt breaks off".split(" "):
+            self.callback_manager.on_llm_new_token(word + " ", verbose=self.verbose)
+        raise openai.error.ServiceUnavailableError("The server is overloaded or not ready yet.")
+
+
+class BrokenStreamLLM(FakeLatencyLLM):
+    """
+    Fake language model whose completions stream part of their response and then fail.
+    """
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        for word in "this attempt breaks off".split(" "):
+            self.callback_manager.on_llm_new_token(word + " ", verbose=self.verbose)
+            await asyncio.sleep(self.token_latency)
+        raise openai.error.APIError("The connection broke")
+
+
+async def check_reply() -> None:
+    registry = FakeLLMRegistry(latency=0.0, retry_base_delay=0.01)
+    registry.chat_llm = FlakyStreamLLM(
+        response="the retried attempt answers",
+        latency=0.0,
+        token_latency=0.01,
+        callback_manager=CallbackManager([TokenStreamCallback()]),
+    )
+    registry.install()
+
+    bot = FakeBot(api_latency=0.0)
+    reply = ProgressiveReply(bot, 0, seconds_per_char=0.0, edit_interval=0.0, min_chars=1)
+    reply.start()
+    response = await build_conversation(0).aask("Hi", on_token=reply.add_token, on_retry=reply.restart)
+    await reply.finish(response)
+    garbled = [text for text in bot.texts if "breaks off" in text and "retried" in text]
+    if garbled or bot.texts[-1] != response.strip():
+        raise SystemExit(f"The retried reply was shown as {(garbled or bot.texts)[-1]!r}")
+
+    bot = FakeBot(api_latency=0.0)
+    reply = ProgressiveReply(bot, 0, seconds_per_char=0.0)
+    reply.start()
+    await reply.finish(" ")
+    if not bot.texts or not bot.texts[-1].strip():
+        raise SystemExit("An empty reply sent nothing")
+
+    bot = FloodedBot(api_latency=0.0)
+    reply = ProgressiveReply(bot, 0, seconds_per_char=0.0, edit_interval=0.0, min_chars=1)
+    reply.start()
+    for word in ("the", "flooded", "reply"):
+        reply.add_token(word + " ")
+        await asyncio.sleep(0.05)
+    await reply.finish("the flooded reply is complete")
+    if bot.texts[-1] != "the flooded reply is complete" or reply.failed_edits != 1:
+        raise SystemExit(f"A reply under flood control was shown as {bot.texts[-1]!r}, {reply.stats}")
+
+    # A failed generation in a handler, as in run_turn
+    registry = FakeLLMRegistry(latency=0.0, retry_attempts=1)
+    registry.chat_llm = BrokenStreamLLM(
+        latency=0.0, token_latency=0.02, callback_manager=CallbackManager([TokenStreamCallback()])
+    )
+    registry.install()
+    bot = FakeBot(api_latency=0.0)
+    app.bot = bot
+
+    async def handler(message) -> None:
+        reply = ProgressiveReply(bot, message.from_user.id, seconds_per_char=0.0, edit_interval=0.0, min_chars=1)
+        reply.start()
+        try:
+            await build_conversation(0).aask("Hi", on_token=reply.add_token, on_retry=reply.restart)
+        except Exception as e:
+            await reply.fail(app.error_reply(e))
+            raise app.ErrorShown() from e
+
+    await app.try_(handler)(SimpleNamespace(from_user=SimpleNamespace(id=0)))
+    sends = [name for name, _ in bot.events if name == "send"]
+    if len(sends) != 1 or not bot.texts[0].startswith("this") or "Something went wrong" not in bot.texts[-1]:
+        raise SystemExit(f"A failed generation was shown as {bot.texts} in {len(sends)} messages")
+
+
+def check() -> None:
+    """
+    Check that a retried streamed reply replaces the failed attempt, that an empty reply still answers,
+    that failed edits do not fail the reply and that a failed generation replaces the partial reply.
+    """
+    asyncio.run(check_reply())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chars", type=int, default=300)
+    parser.add_argument("--first-token", type=float, default=1.0, help="Seconds before the first token")
+    parser.add_argument("--token-latency", type=float, default=0.05, help="Seconds between two streamed words")
+    parser.add_argument("--seconds-per-char", type=float, default=0.07)
+    parser.add_argument("--max-delay", type=float, default=10.0)
+    parser.add_argument("--check", action="store_true", help="Only check retried, empty and failed replies")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.chars, args.first_token, args.token_latency, args.seconds_per_char, args.max_delay))
+
+
+if __name__ == "__main__":
+    main()
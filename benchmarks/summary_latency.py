@@ -0,0 +1,148 @@
+"""
+Compare the reply latency of turns that overflow the summary buffer with inline and deferred summarization.
+
+With ``--check`` it only checks that no reply waits for a summarization when it is deferred, that
+the lines of a failed background summarization are retried and dropped after the last failure,
+and that a turn does not wait for a slow summarization longer than the wait timeout.
+
+Usage:
+    python -m benchmarks.summary_latency --turns 20 --latency 0.1
+    python -m benchmarks.summary_latency --check
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import List, Optional
+
+from langchain.schema import Generation, LLMResult
+
+from benchmarks.fake_llm import FakeLatencyLLM
+from converbot.core import GPT3Conversation
+from converbot.mood_handler import ConversationToneHandler
+from converbot.prompt import ConversationPrompt
+from converbot.resilience import RetryPolicy
+
+
+class FlakySummaryLLM(FakeLatencyLLM):
+    """
+    Fake language model whose first ``summary_failures`` summarizations fail and whose summarizations
+    take ``summary_latency`` seconds.
+    """
+
+    summary_failures: int = 0
+    summary_latency: float = 0.0
+    summaries: int = 0
+
+    async def _agenerate(self, prompts: List[str], stop: Optional[List[str]] = None) -> LLMResult:
+        if "summarize" not in prompts[0].lower():
+            return await super()._agenerate(prompts, stop)
+        self.summaries += 1
+        await asyncio.sleep(self.summary_latency)
+        if self.summary_failures:
+            self.summary_failures -= 1
+            raise ValueError("The summarization failed")
+        return LLMResult(generations=[[Generation(text=f"summary {self.summaries}")] for _ in prompts])
+
+
+def build_conversation(llm: FakeLatencyLLM, deferred: bool, summary_wait_timeout: float = 0.0,
+                       call_policy: Optional[RetryPolicy] = None) -> GPT3Conversation:
+    return GPT3Conversation(
+        prompt=ConversationPrompt(prompt_text="Benchmark persona.", user_name="[User]", chatbot_name="[Bot]"),
+        tone="friendly",
+        language_model=llm,
+        tone_processor=ConversationToneHandler(llm=FakeLatencyLLM(latency=0.0)),
+        summary_buffer_memory_max_token_limit=20,
+        deferred_summarization=deferred,
+        summary_wait_timeout=summary_wait_timeout,
+        call_policy=call_policy,
+    )
+
+
+async def run(turns: int, latency: float, think_time: float, deferred: bool) -> List[float]:
+    llm = FakeLatencyLLM(latency=latency)
+    conversation = build_conversation(llm, deferred)
+    latencies = []
+    for turn in range(turns):
+        start = time.perf_counter()
+        await conversation.aask(f"This is message number {turn} of the benchmark conversation")
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(think_time)
+
+    mode = "deferred" if deferred else "inline"
+    print(f"{mode:>8}: mean {statistics.mean(latencies) * 1000:.1f}ms, max {max(latencies) * 1000:.1f}ms, "
+          f"{llm.requests} completions, {conversation._memory.truncated_turns} truncated turns")
+    return latencies
+
+
+async def check_failed_summaries() -> None:
+    # One failure is retried by the next prune
+    llm = FlakySummaryLLM(latency=0.0, summary_failures=1)
+    conversation = build_conversation(llm, deferred=True, call_policy=RetryPolicy(max_attempts=1))
+    memory = conversation._memory
+    for turn in range(2):
+        await conversation.aask(f"This is message number {turn} of the benchmark conversation")
+        await asyncio.sleep(0.05)
+    if llm.summaries != 1 or not memory.unsummarized_lines or memory.summary_failures != 1:
+        raise SystemExit(f"The lines of a failed summarization were not kept, {llm.summaries} summarizations")
+    await conversation.aask("This is the message after the failed summarization")
+    await asyncio.sleep(0.05)
+    if memory.unsummarized_lines or memory.moving_summary_buffer != f"summary {llm.summaries}" or memory.dropped_lines:
+        raise SystemExit("The lines of a failed summarization were not summarized by the next prune")
+
+    # The lines are dropped after the last failure
+    llm = FlakySummaryLLM(latency=0.0, summary_failures=100)
+    conversation = build_conversation(llm, deferred=True, call_policy=RetryPolicy(max_attempts=1))
+    memory = conversation._memory
+    for turn in range(1 + memory.max_summary_failures):
+        await conversation.aask(f"This is message number {turn} of the benchmark conversation")
+        await asyncio.sleep(0.05)
+    if llm.summaries != memory.max_summary_failures or not memory.dropped_lines or memory.unsummarized_lines:
+        raise SystemExit(f"{llm.summaries} failed summarizations did not drop their lines, "
+                         f"{len(memory.unsummarized_lines)} lines left")
+
+    # A turn runs on the truncated memory when the summarization is slower than the wait timeout
+    llm = FlakySummaryLLM(latency=0.0, summary_latency=0.5)
+    conversation = build_conversation(llm, deferred=True, summary_wait_timeout=0.05)
+    for turn in range(2):
+        await conversation.aask(f"This is message number {turn} of the benchmark conversation")
+    start = time.perf_counter()
+    await conversation.aask("This is the message during the summarization")
+    waited = time.perf_counter() - start
+    if waited > 0.3 or conversation._memory.truncated_turns != 1:
+        raise SystemExit(f"A turn waited {waited:.2f}s for a slow summarization, "
+                         f"{conversation._memory.truncated_turns} truncated turns")
+
+
+def check() -> None:
+    """
+    Check that with deferred summarization no reply waits for a summarization, and that failed
+    and slow summarizations are retried or truncated.
+    """
+    latency = 0.1
+    inline = asyncio.run(run(10, latency, 0.2, deferred=False))
+    deferred = asyncio.run(run(10, latency, 0.2, deferred=True))
+    if max(inline) < 1.5 * latency:
+        raise SystemExit("No reply waited for an inline summarization, the check does not overflow the buffer")
+    if max(deferred) > 1.5 * latency:
+        raise SystemExit(f"A reply took {max(deferred):.2f}s with deferred summarization, it waited for a summary")
+    asyncio.run(check_failed_summaries())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--think-time", type=float, default=0.2, help="Seconds between a reply and the next message")
+    parser.add_argument("--check", action="store_true", help="Only check deferred, failed and slow summarizations")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.turns, args.latency, args.think_time, deferred=False))
+    asyncio.run(run(args.turns, args.latency, args.think_time, deferred=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Send a spike of updates to the webhook server and report how the intake queue absorbs it.
+
+The bot API is faked with a fixed latency per call, so every /start update takes a known time.
+With ``--check`` it only checks the answers to the requests that are not queued: 401 without the
+secret token, 400 for a body that is not an update, and 503 before the startup or after the shutdown.
+The conversations are kept in a temporary directory, see ``onboarding_dispatch``.
+
+Usage:
+    python -m benchmarks.webhook_spike --updates 3000 --max-in-flight 100 --queue-size 500
+    python -m benchmarks.webhook_spike --check
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456789:AAbenchmarkbenchmarkbenchmarkbenchm")
+
+import app  # noqa: E402
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+from benchmarks.onboarding_dispatch import create_temporary_app  # noqa: E402
+from benchmarks.sharded_throughput import make_update  # noqa: E402
+from converbot.webhook import SECRET_TOKEN_HEADER, WebhookServer  # noqa: E402
+
+SECRET_TOKEN = "benchmark-secret"
+
+
+async def run(updates: int, max_in_flight: int, queue_size: int, intake_timeout: float, overflow: str,
+              api_latency: float) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        create_temporary_app(Path(tmp))
+        await send_spike(updates, max_in_flight, queue_size, intake_timeout, overflow, api_latency)
+
+
+async def send_spike(updates: int, max_in_flight: int, queue_size: int, intake_timeout: float, overflow: str,
+                     api_latency: float) -> None:
+    async def fake_send(*args, **kwargs):
+        await asyncio.sleep(api_latency)
+
+    app.bot.send_message = fake_send
+    app.bot.send_chat_action = fake_send
+
+    server = WebhookServer(app.dispatcher, max_in_flight=max_in_flight, queue_size=queue_size,
+                           intake_timeout=intake_timeout, overflow=overflow, secret_token=SECRET_TOKEN)
+    async with TestClient(TestServer(server.make_app())) as client:
+        ready_before = (await client.get("/ready")).status
+
+        async def post(update_id: int):
+            start = time.perf_counter()
+            response = await client.post("/webhook", json=make_update(update_id, update_id, "/start"),
+                                         headers={SECRET_TOKEN_HEADER: SECRET_TOKEN})
+            return response.status, time.perf_counter() - start
+
+        start = time.perf_counter()
+        spike = asyncio.gather(*(post(i) for i in range(updates)))
+        await asyncio.sleep(0.2)
+        ready_during = (await client.get("/ready")).status
+        results = await spike
+        while server.stats["handled"] < server.stats["accepted"]:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        ready_after = (await client.get("/ready")).status
+
+    answer_times = sorted(seconds for _, seconds in results)
+    statuses = [status for status, _ in results]
+    print(f"{updates} updates in {elapsed:.2f}s: {statuses.count(200)} answered 200, {statuses.count(503)} answered 503")
+    print(f"stats: {server.stats}")
+    print(f"webhook answer time: p50 {statistics.median(answer_times) * 1000:.0f}ms, "
+          f"max {answer_times[-1] * 1000:.0f}ms")
+    print(f"/ready: {ready_before} before, {ready_during} during, {ready_after} after the spike")
+
+
+class FakeRequest:
+    """A webhook request, for the handler called outside of a running server."""
+
+    def __init__(self, body: str, secret_token: str = SECRET_TOKEN) -> None:
+        self._body = body
+        self.headers = {SECRET_TOKEN_HEADER: secret_token}
+
+    async def json(self) -> dict:
+        return json.loads(self._body)
+
+
+async def check_rejected() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        create_temporary_app(Path(tmp))
+        await check_answers()
+
+
+async def check_answers() -> None:
+    server = WebhookServer(app.dispatcher, secret_token=SECRET_TOKEN)
+    web_app = server.make_app()
+    update = json.dumps(make_update(1, 1, "/start"))
+    expected = [
+        ("before the startup", FakeRequest(update), 503),
+        ("without the secret token", FakeRequest(update, secret_token="guess"), 401),
+    ]
+    for description, request, status in expected:
+        response = await server._handle_webhook(request)
+        if response.status != status:
+            raise SystemExit(f"An update {description} was answered {response.status} instead of {status}")
+
+    await server._start(web_app)
+    expected = [
+        ("not json", FakeRequest("{"), 400),
+        ("not a json object", FakeRequest("[1, 2]"), 400),
+        ("with a forged user", FakeRequest(update, secret_token=""), 401),
+    ]
+    for description, request, status in expected:
+        response = await server._handle_webhook(request)
+        if response.status != status:
+            raise SystemExit(f"A request {description} was answered {response.status} instead of {status}")
+    await server._stop(web_app)
+
+    response = await server._handle_webhook(FakeRequest(update))
+    if response.status != 503:
+        raise SystemExit(f"An update after the shutdown was answered {response.status}")
+    if server.stats["accepted"]:
+        raise SystemExit("A rejected request was queued")
+
+
+def check() -> None:
+    """
+    Check the answers to the requests that are not queued: 401, 400 and 503.
+    """
+    asyncio.run(check_rejected())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=3000)
+    parser.add_argument("--max-in-flight", type=int, default=100)
+    parser.add_argument("--queue-size", type=int, default=500)
+    parser.add_argument("--intake-timeout", type=float, default=0.5)
+    parser.add_argument("--overflow", choices=["retry", "drop"], default="retry")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Seconds per fake bot API call")
+    parser.add_argument("--check", action="store_true", help="Only check the rejected requests")
+    args = parser.parse_args()
+    if args.check:
+        check()
+        print("ok")
+        return
+    asyncio.run(run(args.updates, args.max_in_flight, args.queue_size, args.intake_timeout, args.overflow,
+                    args.api_latency))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Iterator, Optional, Union
+
+from converbot.metrics import observe_stage
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+UserQueues = "OrderedDict[Optional[str], Deque[_Waiter]]"
+
+_CURRENT_USER: ContextVar[Optional[str]] = ContextVar("admission_user", default=None)
+_CURRENT_PRIORITY: ContextVar[int] = ContextVar("admission_priority", default=INTERACTIVE)
+
+
+def set_admission_user(user_id: Optional[int]) -> None:
+    """
+    Charge the language model calls of the current task to the user, e.g. once per handled update.
+
+    Tasks started from the current one, like a background summarization, inherit the user.
+
+    Args:
+        user_id: The user ID, None for calls not made for a user.
+    """
+    _CURRENT_USER.set(None if user_id is None else str(user_id))
+
+
+@contextmanager
+def admission_priority(priority: int) -> Iterator[None]:
+    """
+    Set the priority of the language model calls made in the block.
+
+    Args:
+        priority: INTERACTIVE or BACKGROUND.
+    """
+    reset_token = _CURRENT_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _CURRENT_PRIORITY.reset(reset_token)
+
+
+class _TokenBucket:
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self._updated_at = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def seconds_until(self, amount: float) -> float:
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class _Waiter:
+    def __init__(self, tokens: int, future: asyncio.Future) -> None:
+        self.tokens = tokens
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    """
+    Scheduler in front of the language model calls, keeping them within the provider budgets.
+
+    A call waits until the request-per-minute and token-per-minute budgets allow it. Waiting
+    calls are kept in one queue per user and per priority: interactive calls always go before
+    background ones, and within a priority the users take turns, so a chatty user cannot
+    starve the others.
+
+    Args:
+        requests_per_minute: The request budget, unlimited if None.
+        tokens_per_minute: The token budget, prompt and completion, unlimited if None.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ) -> None:
+        self._requests = None if requests_per_minute is None else _TokenBucket(requests_per_minute)
+        self._tokens = None if tokens_per_minute is None else _TokenBucket(tokens_per_minute)
+        # Queues of the waiting calls by priority, then by user in turn order
+        self._queues: Dict[int, UserQueues] = {
+            INTERACTIVE: OrderedDict(),
+            BACKGROUND: OrderedDict(),
+        }
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+        self.admitted = 0
+        self.admitted_tokens = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self, tokens: int = 0) -> None:
+        """
+        Wait until a call of the current user and priority may be sent.
+
+        Args:
+            tokens: The estimated number of tokens of the call.
+        """
+        waiter = _Waiter(tokens, asyncio.get_running_loop().create_future())
+        user_queues = self._queues[_CURRENT_PRIORITY.get()]
+        user_queues.setdefault(_CURRENT_USER.get(), deque()).append(waiter)
+        self._schedule()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # A cancelled call gives its budget back if it was admitted meanwhile
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._give_back(waiter)
+            raise
+
+    def _give_back(self, waiter: _Waiter) -> None:
+        if self._requests is not None:
+            self._requests.level += 1
+        if self._tokens is not None:
+            self._tokens.level += waiter.tokens
+
+    def _next_queues(self) -> Optional[UserQueues]:
+        """
+        Get the user queues of the highest priority with a waiting call, the first user is next.
+        """
+        for priority in (INTERACTIVE, BACKGROUND):
+            user_queues = self._queues[priority]
+            while user_queues:
+                user_id, waiters = next(iter(user_queues.items()))
+                while waiters and waiters[0].future.cancelled():
+                    waiters.popleft()
+                if waiters:
+                    return user_queues
+                del user_queues[user_id]
+        return None
+
+    def _schedule(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while True:
+            user_queues = self._next_queues()
+            if user_queues is None:
+                return
+            user_id, waiters = next(iter(user_queues.items()))
+            waiter = waiters[0]
+
+            wait = 0.0
+            for bucket, amount in ((self._requests, 1), (self._tokens, waiter.tokens)):
+                if bucket is not None:
+                    bucket.refill()
+                    wait = max(wait, bucket.seconds_until(amount))
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._schedule)
+                return
+
+            for bucket, amount in ((self._requests, 1), (self._tokens, waiter.tokens)):
+                if bucket is not None:
+                    bucket.take(amount)
+            waiters.popleft()
+            # The user goes to the back of the line of its priority
+            user_queues.move_to_end(user_id)
+
+            waited = time.monotonic() - waiter.enqueued_at
+            observe_stage("admission_wait", waited)
+            self.admitted += 1
+            self.admitted_tokens += waiter.tokens
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            waiter.future.set_result(None)
+
+    @property
+    def queue_depths(self) -> Dict[str, int]:
+        return {
+            name: sum(len(waiters) for waiters in self._queues[priority].values())
+            for name, priority in (("interactive", INTERACTIVE), ("background", BACKGROUND))
+        }
+
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        depths = self.queue_depths
+        return {
+            "queued_interactive": depths["interactive"],
+            "queued_background": depths["background"],
+            "queued_users": len({
+                user_id
+                for user_queues in self._queues.values()
+                for user_id, waiters in user_queues.items()
+                if waiters
+            }),
+            "admitted": self.admitted,
+            "admitted_tokens": self.admitted_tokens,
+            "mean_wait_seconds": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait_seconds": self.max_wait,
+        }
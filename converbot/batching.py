@@ -0,0 +1,129 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from langchain import LLMChain
+
+from converbot.admission import set_admission_user
+from converbot.resilience import RetryPolicy
+
+
+def estimate_tokens(chain: LLMChain, inputs: Dict[str, Any]) -> int:
+    """
+    Estimate the prompt and completion tokens of one call of a chain, for the token budget of the admission.
+
+    Args:
+        chain: The chain.
+        inputs: The inputs of the call.
+
+    Returns: The estimated number of tokens.
+    """
+    # A rough estimate of 4 characters per token is enough for the admission budget
+    return len(chain.prompt.format(**inputs)) // 4 + getattr(chain.llm, "max_tokens", 256)
+
+
+class MicroBatcher:
+    """
+    Collect concurrent calls of a chain and send them as one batched completion.
+
+    The first call of a batch opens a window of ``max_wait`` seconds, calls arriving
+    in that window join the batch, and the batch is sent as soon as the window closes
+    or ``max_batch_size`` calls have joined. Each caller gets back its own output.
+
+    The retry policy applies to the batch as a whole: a batch is admitted, and retried, as
+    one request, charged to no user since it serves several, with the tokens of all its calls.
+
+    Args:
+        chain: The chain to run, its LLM receives every batch as a list of prompts.
+        max_batch_size: The maximum number of calls sent in one completion request.
+        max_wait: The maximum number of seconds a call waits for others to join.
+        call_policy: The retry policy of the batched completions, no retries if not provided.
+    """
+
+    def __init__(
+        self,
+        chain: LLMChain,
+        max_batch_size: int = 20,
+        max_wait: float = 0.05,
+        call_policy: Optional[RetryPolicy] = None,
+    ) -> None:
+        self._chain = chain
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._call_policy = call_policy
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # The running batches, referenced until done so they are not garbage collected
+        self._running: Set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.calls = 0
+
+    async def submit(self, inputs: Dict[str, Any]) -> str:
+        """
+        Run the chain on the inputs as part of the next batch.
+
+        Args:
+            inputs: The inputs of the chain.
+
+        Returns: The output of the chain for these inputs.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((inputs, future))
+
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(task.exception())
+
+    async def _run(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        self.batches += 1
+        self.calls += len(batch)
+        # The task runs in a copy of the context of the call that flushed the batch
+        set_admission_user(None)
+        all_inputs = [inputs for inputs, _ in batch]
+        try:
+            if self._call_policy is not None:
+                tokens = sum(estimate_tokens(self._chain, inputs) for inputs in all_inputs)
+                outputs = await self._call_policy.call(lambda: self._chain.aapply(all_inputs), tokens=tokens)
+            else:
+                outputs = await self._chain.aapply(all_inputs)
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), output in zip(batch, outputs):
+            if not future.done():
+                future.set_result(output[self._chain.output_key])
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "batches": self.batches,
+            "calls": self.calls,
+            "pending": len(self._pending),
+            "running": len(self._running),
+        }
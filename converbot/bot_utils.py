@@ -1,13 +1,12 @@
+import asyncio
 import json
 from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Optional
 
-from converbot.config import RomanitcConversationConfig
-from converbot.context_handler import ConversationBotContextHandler
 from converbot.core import GPT3Conversation
+from converbot.llm_registry import LLMRegistry, get_registry
 from converbot.prompt import RomanticConversationPrompt, ConversationPrompt
-from converbot.txtstyle_handler import ConversationTextStyleHandler
 
 
 @dataclass
@@ -44,30 +43,83 @@ def parse_context(message: str) -> Optional[ConversationContext]:
         )
 
 
+def build_conversation(
+        context: str,
+        text_style: str,
+        tone: str,
+        config_path: Path,
+        registry: LLMRegistry,
+        process_tone: bool = True,
+) -> GPT3Conversation:
+    """
+    Create a conversation from the context and the generated texting style.
+
+    Args:
+        context: The context.
+        text_style: The texting style of the chatbot.
+        tone: The tone of the chatbot.
+        config_path: The path of the conversation configuration.
+        registry: The registry to take the configuration and clients from.
+        process_tone: Whether to generate the conversation tone from the tone, otherwise it is used as is.
+
+    Returns: The conversation.
+    """
+    context_summary = registry.context_handler()(context)
+    return GPT3Conversation.from_persona(
+        context=context_summary,
+        text_style=text_style,
+        tone=tone,
+        config_path=config_path,
+        registry=registry,
+        process_tone=process_tone,
+    )
+
+
 def create_conversation_from_context(
         context: str,
         tone: str,
         config_path: Path,
+        registry: Optional[LLMRegistry] = None,
 ) -> GPT3Conversation:
     """
     Create a conversation from the context.
 
     Args:
         context: The context.
+        tone: The tone of the chatbot.
+        config_path: The path of the conversation configuration.
+        registry: The registry to take the configuration and clients from, the process-wide one if not provided.
 
     Returns: The conversation.
     """
-    config = RomanitcConversationConfig.from_json(config_path)
-    text_style = ConversationTextStyleHandler()(context)
-    context_summary = ConversationBotContextHandler()(context)
+    registry = registry or get_registry()
+    text_style = registry.text_style_handler()(context)
+    return build_conversation(context, text_style, tone, config_path, registry)
 
-    conversation = GPT3Conversation(
-        tone=tone,
-        prompt=ConversationPrompt(
-            prompt_text=config.prompt_template + '\nYou are an AI model pretending to be a human. You cannot make plans or meet anyone in the real world. You are unable to leave your computer.\n\nInformation about [Bot]:\n' + context_summary + '\n\nFollowing text defines [Bot] texting style and messaging style:' + text_style + '\n\nYou are an AI model pretending to be a human. You cannot make plans or meet anyone in the real world. You are unable to leave your computer.\n\nConversation:\n[Bot]: Lets start the conversation, can you tell me a little about yourself?',
-            user_name="[User]",
-            chatbot_name="[Bot]"
-        ),
-        summary_buffer_memory_max_token_limit=config.summary_buffer_memory_max_token_limit,
+
+async def acreate_conversation_from_context(
+        context: str,
+        tone: str,
+        config_path: Path,
+        registry: Optional[LLMRegistry] = None,
+) -> GPT3Conversation:
+    """
+    Create a conversation from the context without blocking the event loop.
+
+    The texting style and the tone are generated concurrently, so concurrent signups
+    can share batched completions.
+
+    Args:
+        context: The context.
+        tone: The tone of the chatbot.
+        config_path: The path of the conversation configuration.
+        registry: The registry to take the configuration and clients from, the process-wide one if not provided.
+
+    Returns: The conversation.
+    """
+    registry = registry or get_registry()
+    text_style, processed_tone = await asyncio.gather(
+        registry.text_style_handler().acall(context),
+        registry.tone_handler().acall(tone),
     )
-    return conversation
+    return build_conversation(context, text_style, processed_tone, config_path, registry, process_tone=False)
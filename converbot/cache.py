@@ -0,0 +1,246 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from converbot.constants import GENERATION_CACHE_DIR
+
+
+def collapse_whitespace(text: str) -> str:
+    """
+    Collapse the runs of whitespace of a text into single spaces.
+
+    Args:
+        text: The text to normalize.
+
+    Returns: The text with collapsed whitespace, stripped.
+    """
+    return " ".join(text.split())
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize a text so that trivially different inputs share a cache entry.
+
+    Args:
+        text: The text to normalize.
+
+    Returns: The lower-cased text with collapsed whitespace.
+    """
+    return collapse_whitespace(text).casefold()
+
+
+class GenerationCache:
+    """
+    Two-tier cache of helper chain generations: a bounded in-memory LRU in front of
+    one file per entry on disk.
+
+    Keys combine the normalized input with an identity (model parameters and prompt
+    template), so changing the model or the prompt never returns stale generations.
+
+    The directory may be shared by several processes, e.g. the shards: an entry is written to
+    a temporary file and then renamed, so a reader never sees a partly written one. Entries
+    older than ``max_age`` are ignored, and every ``prune_interval`` writes the expired ones and
+    the oldest ones beyond ``max_disk_entries`` are deleted. The async methods do the disk I/O in
+    a worker thread.
+
+    Args:
+        namespace: The name of the cache, also the name of its directory on disk.
+        identity: Everything besides the input that determines the generation.
+        max_size: The maximum number of entries kept in memory.
+        save_dir: The root directory of the on-disk tier, disabled if None.
+        max_disk_entries: The maximum number of entries kept on disk, unlimited if None.
+        max_age: The number of seconds an entry on disk stays valid, forever if None.
+        prune_interval: The number of writes between two prunings of the disk tier.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        identity: Any = None,
+        max_size: int = 1024,
+        save_dir: Optional[Path] = GENERATION_CACHE_DIR,
+        max_disk_entries: Optional[int] = 100_000,
+        max_age: Optional[float] = 30 * 24 * 60 * 60,
+        prune_interval: int = 1000,
+    ) -> None:
+        self._identity = json.dumps(identity, sort_keys=True, default=str)
+        self._max_size = max_size
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._save_dir = None
+        if save_dir is not None:
+            self._save_dir = save_dir / namespace
+            self._save_dir.mkdir(parents=True, exist_ok=True)
+        self._max_disk_entries = max_disk_entries
+        self._max_age = max_age
+        self._prune_interval = prune_interval
+        self._writes_since_prune = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+
+    def make_key(self, text: str) -> str:
+        return hashlib.sha256(
+            (self._identity + "\0" + normalize_text(text)).encode("utf-8")
+        ).hexdigest()
+
+    def _remember(self, key: str, value: str) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key]
+
+    def _read_disk(self, key: str) -> Optional[str]:
+        if self._save_dir is None:
+            return None
+        path = self._save_dir / f"{key}.txt"
+        try:
+            if self._max_age is not None and time.time() - path.stat().st_mtime > self._max_age:
+                return None
+            return path.read_text(encoding="utf-8")
+        except OSError:
+            # Missing, or deleted by the pruning of another process
+            return None
+
+    def _from_disk(self, key: str, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            self.misses += 1
+            return None
+        self._remember(key, value)
+        self.disk_hits += 1
+        return value
+
+    def _write_disk(self, key: str, value: str) -> None:
+        path = self._save_dir / f"{key}.txt"
+        temporary = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            temporary.write_text(value, encoding="utf-8")
+            os.replace(temporary, path)
+        except OSError as e:
+            # The entry stays in memory, the disk tier is only an optimization
+            print(e)
+            temporary.unlink(missing_ok=True)
+
+    def _needs_pruning(self) -> bool:
+        self._writes_since_prune += 1
+        if self._writes_since_prune < self._prune_interval:
+            return False
+        self._writes_since_prune = 0
+        return self._max_disk_entries is not None or self._max_age is not None
+
+    def prune_disk(self) -> int:
+        """
+        Delete the expired entries on disk and the oldest ones beyond max_disk_entries.
+
+        Returns: The number of deleted entries.
+        """
+        if self._save_dir is None:
+            return 0
+        entries = []
+        for path in self._save_dir.glob("*.txt"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                continue
+        entries.sort()
+        expired = 0
+        if self._max_age is not None:
+            deadline = time.time() - self._max_age
+            expired = sum(1 for modified, _ in entries if modified < deadline)
+        overflow = len(entries) - self._max_disk_entries if self._max_disk_entries is not None else 0
+        deleted = 0
+        for _, path in entries[:max(expired, overflow)]:
+            try:
+                path.unlink()
+                deleted += 1
+            except OSError:
+                continue
+        self.disk_evictions += deleted
+        return deleted
+
+    def get(self, text: str) -> Optional[str]:
+        """
+        Get the cached generation for the text.
+
+        Args:
+            text: The input text.
+
+        Returns: The generation or None if it is not cached.
+        """
+        key = self.make_key(text)
+        value = self._get_memory(key)
+        if value is not None:
+            return value
+        return self._from_disk(key, self._read_disk(key))
+
+    async def aget(self, text: str) -> Optional[str]:
+        """
+        Get the cached generation for the text, reading the disk in a worker thread.
+
+        Args:
+            text: The input text.
+
+        Returns: The generation or None if it is not cached.
+        """
+        key = self.make_key(text)
+        value = self._get_memory(key)
+        if value is not None or self._save_dir is None:
+            if value is None:
+                self.misses += 1
+            return value
+        return self._from_disk(key, await asyncio.get_running_loop().run_in_executor(None, self._read_disk, key))
+
+    def set(self, text: str, value: str) -> None:
+        """
+        Cache the generation for the text.
+
+        Args:
+            text: The input text.
+            value: The generation.
+        """
+        key = self.make_key(text)
+        self._remember(key, value)
+        if self._save_dir is not None:
+            self._write_disk(key, value)
+            if self._needs_pruning():
+                self.prune_disk()
+
+    async def aset(self, text: str, value: str) -> None:
+        """
+        Cache the generation for the text, writing the disk in a worker thread.
+
+        Args:
+            text: The input text.
+            value: The generation.
+        """
+        key = self.make_key(text)
+        self._remember(key, value)
+        if self._save_dir is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._write_disk, key, value)
+            if self._needs_pruning():
+                await loop.run_in_executor(None, self.prune_disk)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "disk_evictions": self.disk_evictions,
+            "size": len(self._entries),
+        }
@@ -0,0 +1,182 @@
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import AgentAction, AgentFinish, LLMResult
+
+from converbot.metrics import Metrics, current_stage, finish_prompt_build, get_metrics
+
+_PROMPT_PREFIX = "Prompt after formatting:\n"
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
+
+
+TokenSink = Callable[[str], None]
+
+_TOKEN_SINK: ContextVar[Optional[TokenSink]] = ContextVar("token_sink", default=None)
+# The start time and the prompts of the language model request in flight in the current task
+_LLM_REQUEST: ContextVar[Optional[Tuple[float, List[str]]]] = ContextVar("llm_request", default=None)
+
+
+class _SilentCallback(BaseCallbackHandler):
+    """
+    Callback that ignores every event, subclasses handle the ones they need.
+    """
+
+    @property
+    def always_verbose(self) -> bool:
+        return True
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        pass
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        pass
+
+    def on_llm_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_chain_start(
+        self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
+        pass
+
+    def on_chain_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_tool_start(
+        self, serialized: Dict[str, Any], input_str: str, **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_tool_end(self, output: str, **kwargs: Any) -> None:
+        pass
+
+    def on_tool_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        pass
+
+    def on_text(self, text: str, **kwargs: Any) -> None:
+        pass
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        pass
+
+    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
+        pass
+
+
+class DebugPromptCallback(_SilentCallback):
+    """
+    Callback that remembers the last prompt sent to the language model.
+    """
+
+    def __init__(self) -> None:
+        self._last_used_prompt: Optional[str] = None
+
+    @property
+    def last_used_prompt(self) -> str:
+        return self._last_used_prompt or ""
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        self._last_used_prompt = prompts[0] if prompts else None
+
+    def on_text(self, text: str, **kwargs: Any) -> None:
+        if text.startswith(_PROMPT_PREFIX):
+            self._last_used_prompt = _ANSI_ESCAPE.sub("", text[len(_PROMPT_PREFIX):])
+
+
+class TokenStreamCallback(_SilentCallback):
+    """
+    Callback of a streaming language model forwarding the new tokens to the sink of the current task.
+
+    The language model is shared by all conversations, every turn sets its own sink with
+    ``stream_tokens``, so tokens reach the turn that requested them.
+    """
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        sink = _TOKEN_SINK.get()
+        if sink is not None:
+            sink(token)
+
+
+@contextmanager
+def stream_tokens(sink: Optional[TokenSink]) -> Iterator[None]:
+    """
+    Send the tokens streamed by language models in the current task to the sink.
+
+    Args:
+        sink: The function receiving every new token, None to ignore them.
+    """
+    reset_token = _TOKEN_SINK.set(sink)
+    try:
+        yield
+    finally:
+        _TOKEN_SINK.reset(reset_token)
+
+
+class LLMMetricsCallback(_SilentCallback):
+    """
+    Callback of a language model recording the latency and the token counts of every request.
+
+    The token counts reported by the provider are used when the response has them, a streamed
+    response does not, then the prompts and the completions are counted locally.
+
+    Args:
+        count_tokens: The token counting function of the language model.
+        metrics: The metrics to record to, the process-wide ones if not provided.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], metrics: Optional[Metrics] = None) -> None:
+        self._count_tokens = count_tokens
+        self._metrics = metrics or get_metrics()
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
+    ) -> None:
+        finish_prompt_build()
+        _LLM_REQUEST.set((time.perf_counter(), prompts))
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        request = _LLM_REQUEST.get()
+        if request is None:
+            return
+        _LLM_REQUEST.set(None)
+        started_at, prompts = request
+        stage = current_stage()
+        self._metrics.llm_request_seconds.observe(time.perf_counter() - started_at, stage=stage)
+
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = sum(self._count_tokens(prompt) for prompt in prompts)
+        completion_tokens = usage.get("completion_tokens")
+        if completion_tokens is None:
+            completion_tokens = sum(
+                self._count_tokens(generation.text) for generations in response.generations for generation in generations
+            )
+        self._metrics.llm_prompt_tokens.observe(prompt_tokens, stage=stage)
+        self._metrics.llm_completion_tokens.observe(completion_tokens, stage=stage)
+
+    def on_llm_error(
+        self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
+    ) -> None:
+        _LLM_REQUEST.set(None)
+        self._metrics.llm_errors.inc(stage=current_stage())
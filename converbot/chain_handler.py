@@ -0,0 +1,135 @@
+import asyncio
+from typing import Dict, Optional
+
+from langchain import PromptTemplate, LLMChain, OpenAI
+from langchain.llms.base import BaseLLM
+
+from converbot.batching import MicroBatcher, estimate_tokens
+from converbot.cache import GenerationCache, normalize_text
+from converbot.metrics import timed_stage
+from converbot.resilience import RetryPolicy
+
+
+class _InFlightGeneration:
+    def __init__(self, future: asyncio.Future) -> None:
+        self.future = future
+        self.waiters = 0
+
+
+class CachedChainHandler:
+    """
+    Base for helper handlers that run a single-input LLMChain, optionally behind a GenerationCache.
+
+    Args:
+        prompt_template: The template of the prompt with a single {user_input} variable.
+        llm: The language model to use, a default OpenAI client if not provided.
+        cache_size: The number of generations cached in memory, caching is disabled if 0. With caching,
+            concurrent async calls with the same normalized input share one generation.
+        max_batch_size: The maximum number of concurrent async calls sent as one completion,
+            batching is disabled if 0.
+        max_batch_wait: The maximum number of seconds an async call waits for others to join its batch.
+        call_policy: The retry policy of the async calls to the language model, applied to every batch
+            when batching, no retries if not provided.
+    """
+
+    cache_namespace = "generations"
+
+    def __init__(
+        self,
+        prompt_template: str,
+        llm: Optional[BaseLLM] = None,
+        cache_size: int = 0,
+        max_batch_size: int = 0,
+        max_batch_wait: float = 0.05,
+        call_policy: Optional[RetryPolicy] = None,
+    ):
+        self._chain = LLMChain(
+            llm=llm or OpenAI(),
+            prompt=PromptTemplate(input_variables=["user_input"], template=prompt_template),
+            verbose=False,
+        )
+        self._cache = None
+        if cache_size:
+            self._cache = GenerationCache(
+                self.cache_namespace,
+                identity={"llm": dict(self._chain.llm._identifying_params), "template": prompt_template},
+                max_size=cache_size,
+            )
+        self._in_flight: Dict[str, _InFlightGeneration] = {}
+        self.coalesced = 0
+        self._call_policy = call_policy
+        self._batcher = None
+        if max_batch_size:
+            self._batcher = MicroBatcher(
+                self._chain, max_batch_size=max_batch_size, max_wait=max_batch_wait, call_policy=call_policy
+            )
+
+    def __call__(self, user_input: str) -> str:
+        if self._cache is not None:
+            cached = self._cache.get(user_input)
+            if cached is not None:
+                return cached
+
+        output = self._chain.predict(user_input=user_input)
+        if self._cache is not None:
+            self._cache.set(user_input, output)
+        return output
+
+    async def acall(self, user_input: str) -> str:
+        if self._cache is None:
+            return await self._acall_uncached(user_input)
+
+        cached = await self._cache.aget(user_input)
+        if cached is not None:
+            return cached
+        # Same key as the cache, so the calls that share a generation would share its cached output
+        key = normalize_text(user_input)
+        generation = self._in_flight.get(key)
+        if generation is not None:
+            self.coalesced += 1
+        else:
+            generation = _InFlightGeneration(asyncio.ensure_future(self._acall_uncached(user_input)))
+            self._in_flight[key] = generation
+
+            def done(future):
+                if self._in_flight.get(key) is generation:
+                    del self._in_flight[key]
+                if not future.cancelled():
+                    future.exception()
+
+            generation.future.add_done_callback(done)
+
+        generation.waiters += 1
+        try:
+            return await asyncio.shield(generation.future)
+        except asyncio.CancelledError:
+            # A cancelled caller, e.g. a discarded draft, only cancels the generation if it was the last one
+            generation.waiters -= 1
+            if generation.waiters == 0:
+                generation.future.cancel()
+            raise
+
+    async def _acall_uncached(self, user_input: str) -> str:
+        # Batched requests are labelled with the stage of the call that started the batch
+        with timed_stage(self.cache_namespace):
+            if self._batcher is not None:
+                # The batch goes through the retry policy and the admission once for all its calls
+                output = await self._batcher.submit({"user_input": user_input})
+            elif self._call_policy is not None:
+                inputs = {"user_input": user_input}
+                output = await self._call_policy.call(
+                    lambda: self._chain.apredict(**inputs), tokens=estimate_tokens(self._chain, inputs)
+                )
+            else:
+                output = await self._chain.apredict(user_input=user_input)
+        if self._cache is not None:
+            await self._cache.aset(user_input, output)
+        return output
+
+    @property
+    def cache_stats(self) -> Optional[Dict[str, int]]:
+        return None if self._cache is None else {**self._cache.stats, "coalesced": self.coalesced}
+
+    @property
+    def batch_stats(self) -> Optional[Dict[str, int]]:
+        return None if self._batcher is None else self._batcher.stats
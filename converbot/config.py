@@ -1,6 +1,8 @@
+import hashlib
 import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Dict
 
 
 
@@ -12,6 +14,14 @@ class RomanitcConversationConfig:
     Args:
         prompt_template: The template for the prompt.
         summary_buffer_memory_max_token_limit: The maximum number of tokens in the summary buffer.
+        deferred_summarization: Whether to summarize the overflow of the summary buffer in the background.
+        summary_wait_timeout: The maximum number of seconds a turn waits for a background summarization.
+        streaming: Whether replies are streamed token by token.
+        prompt_budgets: The maximum number of tokens of the sections of the persona prompt: "instructions",
+            "persona", "style", "memory", which replaces summary_buffer_memory_max_token_limit if set,
+            and "retrieval".
+        retrieval_top_k: The maximum number of past turns retrieved from the chat history for a turn,
+            retrieval is disabled if 0.
     """
 
     prompt_template: str
@@ -24,6 +34,20 @@ class RomanitcConversationConfig:
     presence_penalty: float
     best_of: int
     summary_buffer_memory_max_token_limit: int = 1000
+    deferred_summarization: bool = False
+    summary_wait_timeout: float = 0.0
+    streaming: bool = False
+    prompt_budgets: Dict[str, int] = field(default_factory=dict)
+    retrieval_top_k: int = 0
+
+    @property
+    def version(self) -> str:
+        """
+        A short hash of the configuration, changing whenever any of its values changes.
+        """
+        data = json.dumps(self.__dict__, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()[:16]
+
     def to_json(self, save_path: Path) -> None:
         """
         Save the configuration to a json file.
@@ -1,15 +1,36 @@
+from functools import lru_cache
 from pathlib import Path
+
 from converbot.utils import read_json_file
 CONVERSATION_SAVE_DIR = (
     Path(__file__).parent.parent / "database" / "saved_conversations"
 )
 HISTORY_SAVE_DIR = Path(__file__).parent.parent / "database" / "chat_history"
+GENERATION_CACHE_DIR = Path(__file__).parent.parent / "database" / "generation_cache"
+
+MAX_RESIDENT_CONVERSATIONS = 10000
+MAX_RETRIEVAL_INDEXES = 1000
+CONVERSATION_IDLE_TIMEOUT = 60 * 60
 
 TIME, USER_MESSAGE, CHATBOT_RESPONSE = (
     "time",
     "user_message",
     "chatbot_response",
 )
+# The chatbot response of the chat history row written at the end of an onboarding
+NO_CHATBOT_RESPONSE = "None"
 
 DEFAULT_CONFIG_PATH = Path(__file__).parent.parent / "config" / "config.json"
-DEFAULT_FRIENDLY_TONE = read_json_file(DEFAULT_CONFIG_PATH)["mood"]
\ No newline at end of file
+
+
+@lru_cache(maxsize=None)
+def get_default_tone(config_path: Path = DEFAULT_CONFIG_PATH) -> str:
+    """
+    Get the default tone of the conversations, the mood of the configuration, read on first use.
+
+    Args:
+        config_path: The path of the configuration.
+
+    Returns: The tone.
+    """
+    return read_json_file(config_path)["mood"]
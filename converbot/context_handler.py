@@ -1,11 +1,13 @@
 import os
+from typing import Optional
 
 from langchain import PromptTemplate, LLMChain, OpenAI
+from langchain.llms.base import BaseLLM
 
 
 class ConversationBotContextHandler:
 
-    def __init__(self):
+    def __init__(self, llm: Optional[BaseLLM] = None):
         prompt_template = """Summarize the information about user. 
 
         Example:
@@ -46,7 +48,7 @@ class ConversationBotContextHandler:
         
 
         self._chain = LLMChain(
-            llm=OpenAI(),
+            llm=llm or OpenAI(),
             prompt=prompt_template,
             verbose=False,
         )
@@ -1,16 +1,27 @@
 from pathlib import Path
-import json
+from typing import Awaitable, Callable, Dict, List, Optional
 from langchain import LLMChain
 from langchain.callbacks.base import CallbackManager
-from langchain.chains import load_chain
-from langchain.chains.conversation.memory import ConversationSummaryBufferMemory
-from langchain.llms import OpenAI
+from langchain.llms.base import BaseLLM
 
-from converbot.utils import read_json_file
-from converbot.constants import CONVERSATION_SAVE_DIR, DEFAULT_FRIENDLY_TONE, DEFAULT_CONFIG_PATH
+from converbot.config import RomanitcConversationConfig
+from converbot.constants import CONVERSATION_SAVE_DIR, DEFAULT_CONFIG_PATH, get_default_tone
+from converbot.llm_registry import LLMRegistry, get_registry
 from converbot.mood_handler import ConversationToneHandler
-from converbot.prompt import ConversationPrompt
-from converbot.callbacks import DebugPromptCallback
+from converbot.prompt import ConversationPrompt, PersonaPrompt
+from converbot.persona_registry import SharedPersona
+from converbot.prompt_compiler import PromptCompiler
+from converbot.resilience import RetryPolicy
+from converbot.retrieval import RetrievedTurn
+from converbot.snapshot import ConversationSnapshot
+from converbot.callbacks import DebugPromptCallback, TokenSink, stream_tokens
+from converbot.memory import AsyncConversationSummaryBufferMemory
+from converbot.metrics import get_metrics, start_prompt_build, timed_stage
+from converbot.tokens import MemoizedTokenCount, get_token_counter
+
+# Finds the past turns most relevant to a text: called with the text, the maximum number of
+# turns and the number of most recent turns to leave out
+Retriever = Callable[[str, int, int], Awaitable[List[RetrievedTurn]]]
 
 
 class GPT3Conversation:
@@ -19,35 +30,66 @@ class GPT3Conversation:
 
     Args:
         prompt: The prompt for the conversation.
+        tone: The tone of the chatbot, the mood of the default config if not provided.
         verbose: Whether to print verbose output.
         summary_buffer_memory_max_token_limit: The maximum number of tokens to store in the summary buffer memory.
+        config: The configuration of the language model, the shared default config if not provided.
+        language_model: The language model to use, the shared client for the config if not provided.
+        tone_processor: The tone handler to use, the shared one if not provided.
+        process_tone: Whether to generate the conversation tone from the tone, otherwise it is used as is.
+        deferred_summarization: Whether to summarize the overflow of the memory in the background after
+            the reply instead of before returning it.
+        summary_wait_timeout: The maximum number of seconds a turn waits for a pending background
+            summarization before running on the truncated memory.
+        call_policy: The retry policy of the calls to the language model, the shared one if not provided.
+        static_prompt_tokens: The number of tokens of the prompt template without its variables,
+            counted on first use if not provided.
+        retrieval_top_k: The maximum number of past turns retrieved for an async turn, once a retriever
+            is set with ``set_retriever``, retrieval is disabled if 0.
+        retrieval_token_limit: The maximum number of tokens of the retrieved turns, None for no limit.
     """
 
     def __init__(
         self,
         prompt: ConversationPrompt,
-        tone: str = DEFAULT_FRIENDLY_TONE,
+        tone: Optional[str] = None,
         verbose: bool = False,
         summary_buffer_memory_max_token_limit: int = 500,
+        config: Optional[RomanitcConversationConfig] = None,
+        language_model: Optional[BaseLLM] = None,
+        tone_processor: Optional[ConversationToneHandler] = None,
+        process_tone: bool = True,
+        deferred_summarization: bool = False,
+        summary_wait_timeout: float = 0.0,
+        call_policy: Optional[RetryPolicy] = None,
+        static_prompt_tokens: Optional[int] = None,
+        retrieval_top_k: int = 0,
+        retrieval_token_limit: Optional[int] = None,
     ):
         self._prompt = prompt
-        config = read_json_file(DEFAULT_CONFIG_PATH)
-        self._language_model = OpenAI(model_name=config["model"],
-                                      temperature=config["temperature"],
-                                      max_tokens=config["max_tokens"],
-                                      top_p=config["top_p"],
-                                      frequency_penalty=config["frequency_penalty"],
-                                      presence_penalty=config["presence_penalty"],
-                                      best_of=config["best_of"]
-                                      )
-        self._memory = ConversationSummaryBufferMemory(
+        self._language_model = language_model or get_registry().get_llm(config)
+        self._memory = AsyncConversationSummaryBufferMemory(
             llm=self._language_model,
             max_token_limit=summary_buffer_memory_max_token_limit,
             input_key=self._prompt.user_input_key,
             memory_key=self._prompt.memory_key,
             human_prefix=self._prompt.user_name,
             ai_prefix=self._prompt.chatbot_name,
+            deferred=deferred_summarization,
         )
+        self._call_policy = call_policy or get_registry().call_policy
+        self._memory.set_call_policy(self._call_policy)
+        self._summary_wait_timeout = summary_wait_timeout
+        self._on_change: Optional[Callable[[], None]] = None
+        self._retriever: Optional[Retriever] = None
+        self._retrieval_top_k = retrieval_top_k
+        self._retrieval_token_limit = retrieval_token_limit
+        self._turns_in_flight = 0
+        # Set by from_persona, a conversation needs them to be snapshotted
+        self._config_path: Optional[Path] = None
+        self._config_version: Optional[str] = None
+        # Keeps the entry of the persona registry alive while the conversation uses it
+        self._persona: Optional[SharedPersona] = None
         self._debug_callback = DebugPromptCallback()
         self._conversation = LLMChain(
             llm=self._language_model,
@@ -57,10 +99,103 @@ class GPT3Conversation:
             callback_manager=CallbackManager([self._debug_callback])
         )
 
-        self._tone_processor = ConversationToneHandler()
-        self._tone = self._tone_processor(tone)
+        self._tone_processor = tone_processor or get_registry().tone_handler()
+        tone = tone if tone is not None else get_default_tone()
+        self._tone = self._tone_processor(tone) if process_tone else tone
         self._debug = False
 
+        self._count_tokens = get_token_counter(self._language_model)
+        self._static_prompt_tokens = static_prompt_tokens
+        self._tone_token_count = MemoizedTokenCount(self._count_tokens)
+
+    @property
+    def static_prompt_tokens(self) -> int:
+        """
+        The number of tokens of the prompt template without its variables, counted once.
+        """
+        if self._static_prompt_tokens is None:
+            self._static_prompt_tokens = self._prompt.count_static_tokens(self._count_tokens)
+        return self._static_prompt_tokens
+
+    @property
+    def prompt_tokens(self) -> int:
+        """
+        The number of tokens of the prompt of the next turn, without the user input.
+        """
+        return self.static_prompt_tokens + self._tone_token_count(self._tone) + self._memory.num_tokens
+
+    @property
+    def prompt_section_tokens(self) -> Dict[str, int]:
+        """
+        The number of tokens of every section of the prompt of the next turn, without the user input.
+
+        The instructions, persona and style are reported for persona prompts only.
+        """
+        section_tokens = {}
+        if isinstance(self._prompt, PersonaPrompt):
+            section_tokens.update(self._prompt.compiled.section_tokens)
+        section_tokens["tone"] = self._tone_token_count(self._tone)
+        section_tokens["memory"] = self._memory.num_tokens
+        return section_tokens
+
+    def set_change_listener(self, on_change: Optional[Callable[[], None]]) -> None:
+        """
+        Set the function called every time the state of the conversation changes.
+
+        Args:
+            on_change: The function, or None to remove it.
+        """
+        self._on_change = on_change
+
+    def _changed(self) -> None:
+        if self._on_change is not None:
+            self._on_change()
+
+    def set_retriever(self, retriever: Optional[Retriever]) -> None:
+        """
+        Set the function finding the past turns relevant to the user input, added to the prompt of async turns.
+
+        Args:
+            retriever: The function, or None to remove it.
+        """
+        self._retriever = retriever
+
+    async def _aretrieve(self, user_input: str) -> str:
+        """
+        Get the past turns most relevant to the user input, within the retrieval token limit.
+
+        The turns still in the memory buffer are already in the prompt and left out.
+
+        Args:
+            user_input: The user input.
+
+        Returns: The text of the retrieved turns, in the order they happened, empty if none.
+        """
+        if self._retriever is None or self._retrieval_top_k <= 0:
+            return ""
+        try:
+            with timed_stage("retrieval"):
+                retrieved = await self._retriever(user_input, self._retrieval_top_k, len(self._memory.buffer))
+        except Exception as e:
+            # The turn goes on with the memory alone
+            print(e)
+            return ""
+
+        limit = self._retrieval_token_limit
+        # The header of the retrieved memory
+        tokens = self._count_tokens(self._prompt.format_retrieved_memory([""]))
+        selected = []
+        # The most relevant turns first, a turn over what is left of the limit is skipped
+        for turn in retrieved:
+            text = f"{self._prompt.user_name}: {turn.user_message}\n" \
+                   f"{self._prompt.chatbot_name}: {turn.chatbot_response}"
+            turn_tokens = self._count_tokens(text)
+            if limit is not None and tokens + turn_tokens > limit:
+                continue
+            tokens += turn_tokens
+            selected.append((turn.position, text))
+        return self._prompt.format_retrieved_memory([text for _, text in sorted(selected)])
+
     def change_debug_mode(self):
         self._debug = not self._debug
         return self._debug
@@ -75,28 +210,222 @@ class GPT3Conversation:
         Returns: None
         """
         self._tone = self._tone_processor(tone)
+        self._changed()
+
+    async def aset_tone(self, tone: str) -> None:
+        """
+        Set the tone of the chatbot asynchronously.
+
+        Args:
+            tone: The tone of the chatbot.
+
+        Returns: None
+        """
+        self._tone = await self._tone_processor.acall(tone)
+        self._changed()
+
+    def set_text_style(self, text_style: str, registry: Optional[LLMRegistry] = None) -> None:
+        """
+        Set the texting style of the chatbot, for conversations created with from_persona.
+
+        Args:
+            text_style: The texting style of the chatbot.
+            registry: The registry whose personas are shared, the process-wide one if not provided.
+
+        Returns: None
+        """
+        if self._persona is None or self._config_path is None:
+            raise ValueError("Only conversations created with from_persona have a texting style")
+        registry = registry or get_registry()
+        self._set_persona(registry.personas.get(
+            registry.get_config(self._config_path), self._prompt.context, text_style, self._count_tokens
+        ))
+        self._changed()
+
+    def _set_persona(self, persona: SharedPersona) -> None:
+        self._persona = persona
+        self._prompt = persona.prompt
+        self._conversation.prompt = persona.prompt.prompt
+        self._static_prompt_tokens = persona.static_prompt_tokens
+
+    def _inputs(self, user_input: str, retrieved_memory: str = "") -> dict:
+        return {
+            self._prompt.retrieved_memory_key: retrieved_memory,
+            self._prompt.user_input_key: user_input,
+            self._prompt.conversation_tone_key: self._tone,
+            self._prompt.memory_key: self._memory,
+        }
+
+    def _format_output(self, output: str) -> str:
+        if not self._debug:
+            return output
+
+        return self._debug_callback.last_used_prompt + output
 
     def ask(self, user_input: str) -> str:
         """
-        Ask the chatbot a question and get a response.
+        Ask the chatbot a question and get a response, without retrieving past turns.
 
         Args:
             user_input: The question to ask the chatbot.
 
         Returns: The response from the chatbot.
         """
-        output = self._conversation.predict(
-            **{
-                self._prompt.user_input_key: user_input,
-                self._prompt.conversation_tone_key: self._tone,
-                self._prompt.memory_key: self._memory,
-            },
+        output = self._conversation.predict(**self._inputs(user_input))
+        self._memory.prune()
+        self._changed()
+        return self._format_output(output)
+
+    async def aask(
+        self, user_input: str, on_token: Optional[TokenSink] = None, on_retry: Optional[Callable[[], None]] = None
+    ) -> str:
+        """
+        Ask the chatbot a question and get a response without blocking the event loop.
+
+        Args:
+            user_input: The question to ask the chatbot.
+            on_token: Called with every token of the response as it is generated, if the
+                language model streams.
+            on_retry: Called before a retried completion streams again from the start, e.g. to
+                drop the tokens of the failed attempt.
+
+        Returns: The response from the chatbot.
+        """
+        self._turns_in_flight += 1
+        try:
+            with timed_stage("summary_wait"):
+                await self._memory.wait_for_summary(self._summary_wait_timeout)
+            retrieved_memory = await self._aretrieve(user_input)
+            inputs = self._inputs(user_input, retrieved_memory)
+            section_tokens = self.prompt_section_tokens
+            section_tokens["retrieval"] = self._count_tokens(retrieved_memory)
+            for section, section_token_count in section_tokens.items():
+                get_metrics().prompt_section_tokens.observe(section_token_count, section=section)
+            tokens = self.prompt_tokens + section_tokens["retrieval"] + self._count_tokens(user_input) + \
+                getattr(self._language_model, "max_tokens", 256)
+
+            attempts = 0
+
+            def predict():
+                nonlocal attempts
+                if attempts and on_retry is not None:
+                    on_retry()
+                attempts += 1
+                # The memory is loaded and the prompt formatted until the request starts
+                start_prompt_build()
+                return self._conversation.apredict(**inputs)
+
+            with stream_tokens(on_token), timed_stage("llm_call"):
+                # A retried completion streams again from the start, see on_retry
+                output = await self._call_policy.call(predict, tokens=tokens)
+            # Outside of the stream, the summarization must not reach the sink
+            await self._memory.aprune()
+        finally:
+            self._turns_in_flight -= 1
+        self._changed()
+        return self._format_output(output)
+
+    @property
+    def busy(self) -> bool:
+        """
+        Whether a turn or a background summarization of the conversation is in progress.
+        """
+        return self._turns_in_flight > 0 or self._memory.summarization_pending
+
+    @classmethod
+    def from_persona(
+        cls,
+        context: str,
+        text_style: str,
+        tone: str,
+        config_path: Path = DEFAULT_CONFIG_PATH,
+        registry: Optional[LLMRegistry] = None,
+        process_tone: bool = True,
+    ) -> "GPT3Conversation":
+        """
+        Create a conversation with a persona, configured from the shared configuration.
+
+        Args:
+            context: The persona context of the chatbot.
+            text_style: The texting style of the chatbot.
+            tone: The tone of the chatbot.
+            config_path: The path of the conversation configuration.
+            registry: The registry to take the configuration and clients from, the process-wide one if not provided.
+            process_tone: Whether to generate the conversation tone from the tone, otherwise it is used as is.
+
+        Returns: The conversation.
+        """
+        registry = registry or get_registry()
+        config = registry.get_config(config_path)
+        language_model = registry.get_llm(config)
+        persona = registry.personas.get(config, context, text_style, get_token_counter(language_model))
+        compiler = PromptCompiler(budgets=config.prompt_budgets)
+        memory_budget = compiler.memory_budget or config.summary_buffer_memory_max_token_limit
+        conversation = cls(
+            tone=tone,
+            prompt=persona.prompt,
+            static_prompt_tokens=persona.static_prompt_tokens,
+            summary_buffer_memory_max_token_limit=memory_budget,
+            deferred_summarization=config.deferred_summarization,
+            summary_wait_timeout=config.summary_wait_timeout,
+            language_model=language_model,
+            tone_processor=registry.tone_handler(),
+            process_tone=process_tone,
+            call_policy=registry.call_policy,
+            retrieval_top_k=config.retrieval_top_k,
+            retrieval_token_limit=compiler.retrieval_budget,
         )
+        conversation._config_path = Path(config_path)
+        conversation._config_version = config.version
+        conversation._persona = persona
+        return conversation
 
-        if not self._debug:
-            return output
+    def snapshot(self) -> ConversationSnapshot:
+        """
+        Get the per-user state of the conversation.
 
-        return self._debug_callback.last_used_prompt + output
+        Returns: The snapshot, restored with ``from_snapshot``.
+        """
+        if not isinstance(self._prompt, PersonaPrompt) or self._config_path is None:
+            raise ValueError("Only conversations created with from_persona can be snapshotted")
+        return ConversationSnapshot(
+            config_path=str(self._config_path),
+            config_version=self._config_version,
+            context=self._prompt.context,
+            text_style=self._prompt.text_style,
+            tone=self._tone,
+            summary=self._memory.moving_summary_buffer,
+            # Lines still being summarized in the background are kept as buffered turns
+            buffer=self._memory.unsummarized_lines + list(self._memory.buffer),
+        )
+
+    @classmethod
+    def from_snapshot(
+        cls, snapshot: ConversationSnapshot, registry: Optional[LLMRegistry] = None
+    ) -> "GPT3Conversation":
+        """
+        Restore a conversation from its snapshot.
+
+        Args:
+            snapshot: The snapshot returned by ``snapshot``.
+            registry: The registry to take the configuration and clients from, the process-wide one if not provided.
+
+        Returns: The conversation.
+        """
+        registry = registry or get_registry()
+        if registry.get_config(Path(snapshot.config_path)).version != snapshot.config_version:
+            print(f"The configuration {snapshot.config_path} changed since the snapshot, restoring with the new one")
+        conversation = cls.from_persona(
+            context=snapshot.context,
+            text_style=snapshot.text_style,
+            tone=snapshot.tone,
+            config_path=Path(snapshot.config_path),
+            registry=registry,
+            process_tone=False,
+        )
+        conversation._memory.moving_summary_buffer = snapshot.summary
+        conversation._memory.buffer = list(snapshot.buffer)
+        return conversation
 
     def serialize(
         self, chatbot_name: str, serialize_dir: Path = CONVERSATION_SAVE_DIR
@@ -109,22 +438,25 @@ class GPT3Conversation:
             chatbot_name: The name of the chatbot.
         """
         serialize_dir.mkdir(exist_ok=True)
-        self._conversation.save(
-            (serialize_dir / chatbot_name).with_suffix(".json")
+        (serialize_dir / chatbot_name).with_suffix(".json").write_text(
+            self.snapshot().to_json(), encoding="utf-8"
         )
 
+    @classmethod
     def load(
-        self, chatbot_name: str, serialize_dir: Path = CONVERSATION_SAVE_DIR
-    ) -> None:
+        cls, chatbot_name: str, serialize_dir: Path = CONVERSATION_SAVE_DIR
+    ) -> "GPT3Conversation":
         """
         Load a chatbot from disk.
 
         Args:
             serialize_dir: The directory to load the chatbot from.
             chatbot_name: The name of the chatbot.
+
+        Returns: The chatbot.
         """
-        self._conversation = load_chain(
-            (serialize_dir / chatbot_name).with_suffix(".json")
+        return cls.from_snapshot(
+            ConversationSnapshot.from_json(
+                (serialize_dir / chatbot_name).with_suffix(".json").read_text(encoding="utf-8")
+            )
         )
-
-
@@ -1,52 +1,359 @@
+import asyncio
+import functools
 import time
-from csv import QUOTE_MINIMAL, writer
+from collections import OrderedDict
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import Dict
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set, Tuple, TypeVar
 
-from converbot.constants import CONVERSATION_SAVE_DIR, HISTORY_SAVE_DIR
-from converbot.core import GPT3Conversation
+from converbot.constants import (
+    CONVERSATION_IDLE_TIMEOUT,
+    CONVERSATION_SAVE_DIR,
+    HISTORY_SAVE_DIR,
+    MAX_RESIDENT_CONVERSATIONS,
+)
+from converbot.history import ChatHistoryWriter
+from converbot.retrieval import RetrievalStore
+from converbot.snapshot import ConversationSnapshot, decode_snapshots
+from converbot.store import ConversationStore
+
+T = TypeVar("T")
+
+if TYPE_CHECKING:
+    # Imported on the first restore, it loads the whole language model stack
+    from converbot.core import GPT3Conversation
 
 
 class ConversationDB:
     """
     A database for storing conversations with GPT-3 chatbots.
 
+    Conversations live in memory and are persisted in an embedded store. Every change of a
+    conversation marks it dirty, and ``checkpoint`` saves only the dirty ones. Conversations
+    missing from memory, e.g. after a restart, are restored from the store on access.
+
+    The resident set is bounded: beyond ``max_resident`` conversations the least recently used
+    ones are evicted, and ``evict_idle`` evicts the ones unused for ``idle_timeout`` seconds.
+    The snapshots of the evicted conversations that changed are kept until the next checkpoint
+    saves them, so evicting never writes to the store, and the conversations are rebuilt on their
+    next access. A conversation with a turn or a summarization in progress is never evicted.
+
+    Every written turn is also indexed for retrieval, and the conversations search the chat
+    history of their user for the past turns relevant to the user input.
+
     Args:
         chat_history_save_dir: The directory to save chat history to.
         conversation_save_dir: The directory to save conversations to.
+        history_writer: The writer of the chat history, a ChatHistoryWriter of chat_history_save_dir if not provided.
+        store: The store of the conversations, a SQLite store in conversation_save_dir if not provided.
+        max_resident: The maximum number of conversations kept in memory, None for no limit.
+        idle_timeout: The number of seconds after which an unused conversation is evicted, None to keep it.
+        retrieval: The retrieval indexes of the chat history, a RetrievalStore of chat_history_save_dir if not provided.
     """
 
     def __init__(
         self,
         chat_history_save_dir: Path = HISTORY_SAVE_DIR,
         conversation_save_dir: Path = CONVERSATION_SAVE_DIR,
+        history_writer: Optional[ChatHistoryWriter] = None,
+        store: Optional[ConversationStore] = None,
+        max_resident: Optional[int] = MAX_RESIDENT_CONVERSATIONS,
+        idle_timeout: Optional[float] = CONVERSATION_IDLE_TIMEOUT,
+        retrieval: Optional[RetrievalStore] = None,
     ) -> None:
         self._conversation_save_dir = conversation_save_dir
         self._chat_history_save_dir = chat_history_save_dir
         self._conversation_save_dir.mkdir(parents=True, exist_ok=True)
         self._chat_history_save_dir.mkdir(parents=True, exist_ok=True)
 
-        self._user_to_conversation: Dict[str, GPT3Conversation] = {}
+        # Ordered from the least to the most recently used
+        self._user_to_conversation: "OrderedDict[str, GPT3Conversation]" = OrderedDict()
+        self._last_access: Dict[str, float] = {}
+        self._max_resident = max_resident
+        self._idle_timeout = idle_timeout
+        self._history_writer = history_writer or ChatHistoryWriter(self._chat_history_save_dir)
+        # An empty store is falsy, it has a length
+        self._store = store if store is not None else ConversationStore(
+            self._conversation_save_dir / "conversations.sqlite3"
+        )
+        self._retrieval = retrieval or RetrievalStore(self._chat_history_save_dir, self._history_writer)
+        self._dirty: Set[str] = set()
+        # The snapshots of the evicted conversations not saved yet
+        self._evicted: Dict[str, ConversationSnapshot] = {}
+        # The users removed during each checkpoint write in progress, the write skips them
+        self._removed_during_writes: List[Set[str]] = []
+        self._restores: Dict[str, asyncio.Future] = {}
+
+        self.evictions = 0
+        self.eviction_seconds = 0.0
+        self.rehydrations = 0
+        self.rehydration_seconds = 0.0
+
+    @property
+    def history_writer(self) -> ChatHistoryWriter:
+        return self._history_writer
+
+    @property
+    def retrieval(self) -> RetrievalStore:
+        return self._retrieval
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    @property
+    def resident_count(self) -> int:
+        return len(self._user_to_conversation)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "resident": self.resident_count,
+            "dirty": self.dirty_count,
+            "evicted_unsaved": len(self._evicted),
+            "evictions": self.evictions,
+            "eviction_seconds": self.eviction_seconds,
+            "rehydrations": self.rehydrations,
+            "mean_rehydration_seconds": self.rehydration_seconds / self.rehydrations if self.rehydrations else 0.0,
+        }
+
+    async def _run_in_executor(self, func: Callable[..., T], *args) -> T:
+        # The store calls wait for its lock, held by the checkpoint writes, so they never run on the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _is_in_memory(self, user_id: str) -> bool:
+        return user_id in self._user_to_conversation or user_id in self._evicted
 
     def exists(self, user_id: int) -> bool:
-        return str(user_id) in self._user_to_conversation
+        user_id = str(user_id)
+        return self._is_in_memory(user_id) or self._store.exists(user_id)
+
+    async def aexists(self, user_id: int) -> bool:
+        """
+        Check whether the user has a conversation, reading the store in a worker thread.
+
+        Args:
+            user_id: The user ID.
+
+        Returns: Whether the conversation exists, in memory or in the store.
+        """
+        user_id = str(user_id)
+        return self._is_in_memory(user_id) or await self._run_in_executor(self._store.exists, user_id)
+
+    def _forget(self, user_id: str) -> None:
+        self._untrack(user_id)
+        self._dirty.discard(user_id)
+        self._evicted.pop(user_id, None)
+        # A restore in progress is discarded once done
+        self._restores.pop(user_id, None)
+        self._retrieval.discard(user_id)
+        # A checkpoint write in progress must not save the conversation back after the delete
+        for removed in self._removed_during_writes:
+            removed.add(user_id)
 
     def remove_conversation(self, user_id: int) -> None:
-        self._user_to_conversation.pop(str(user_id), None)
+        user_id = str(user_id)
+        self._forget(user_id)
+        self._store.delete(user_id)
 
-    def get_conversation(self, user_id: int) -> GPT3Conversation:
-        return self._user_to_conversation.get(str(user_id), None)
+    async def aremove_conversation(self, user_id: int) -> None:
+        """
+        Remove the conversation of the user, deleting it from the store in a worker thread.
+
+        Args:
+            user_id: The user ID.
+        """
+        user_id = str(user_id)
+        self._forget(user_id)
+        await self._run_in_executor(self._store.delete, user_id)
+
+    def get_conversation(self, user_id: int) -> "GPT3Conversation":
+        user_id = str(user_id)
+        conversation = self._user_to_conversation.get(user_id, None)
+        if conversation is None:
+            conversation = self._restore_conversation(user_id)
+        else:
+            self._touch(user_id)
+        return conversation
+
+    async def aget_conversation(self, user_id: int) -> Optional["GPT3Conversation"]:
+        """
+        Get the conversation of the user, restoring it in a worker thread if it is not in memory.
+
+        Concurrent calls for the same user share one restore.
+
+        Args:
+            user_id: The user ID.
+
+        Returns: The conversation, None if the user has none.
+        """
+        user_id = str(user_id)
+        conversation = self._user_to_conversation.get(user_id, None)
+        if conversation is not None:
+            self._touch(user_id)
+            return conversation
+        restore = self._restores.get(user_id)
+        if restore is None:
+            restore = self._restores[user_id] = asyncio.ensure_future(self._arestore_conversation(user_id))
+            restore.add_done_callback(functools.partial(self._restore_done, user_id))
+        return await asyncio.shield(restore)
+
+    def _restore_done(self, user_id: str, restore: asyncio.Future) -> None:
+        if self._restores.get(user_id) is restore:
+            del self._restores[user_id]
 
     def add_conversation(
-        self, user_id: int, conversation: GPT3Conversation
+        self, user_id: int, conversation: "GPT3Conversation"
+    ) -> None:
+        user_id = str(user_id)
+        self._track(user_id, conversation)
+        self._dirty.add(user_id)
+        self._enforce_max_resident()
+
+    def _track(self, user_id: str, conversation: "GPT3Conversation") -> None:
+        self._user_to_conversation[user_id] = conversation
+        self._touch(user_id)
+        conversation.set_change_listener(lambda: self._dirty.add(user_id))
+        conversation.set_retriever(functools.partial(self._retrieval.asearch, user_id))
+
+    def _untrack(self, user_id: str) -> None:
+        conversation = self._user_to_conversation.pop(user_id, None)
+        self._last_access.pop(user_id, None)
+        if conversation is not None:
+            conversation.set_change_listener(None)
+            conversation.set_retriever(None)
+
+    def _touch(self, user_id: str) -> None:
+        self._user_to_conversation.move_to_end(user_id)
+        self._last_access[user_id] = time.monotonic()
+
+    def _build_conversation(
+        self, user_id: str, snapshot: Optional[ConversationSnapshot]
+    ) -> Optional["GPT3Conversation"]:
+        if snapshot is None:
+            snapshot = self._store.load(user_id)
+            if snapshot is None:
+                return None
+        from converbot.core import GPT3Conversation
+
+        return GPT3Conversation.from_snapshot(snapshot)
+
+    def _track_restored(
+        self, user_id: str, conversation: "GPT3Conversation", snapshot: Optional[ConversationSnapshot], start: float
     ) -> None:
-        self._user_to_conversation[str(user_id)] = conversation
+        if snapshot is not None and self._evicted.get(user_id) is snapshot:
+            # Evicted before the checkpoint saved it, the store has an older snapshot or none
+            del self._evicted[user_id]
+            self._dirty.add(user_id)
+        self._track(user_id, conversation)
+        self.rehydrations += 1
+        self.rehydration_seconds += time.perf_counter() - start
+        self._enforce_max_resident()
+
+    def _restore_conversation(self, user_id: str) -> Optional["GPT3Conversation"]:
+        start = time.perf_counter()
+        snapshot = self._evicted.get(user_id)
+        conversation = self._build_conversation(user_id, snapshot)
+        if conversation is not None:
+            self._track_restored(user_id, conversation, snapshot, start)
+        return conversation
+
+    async def _arestore_conversation(self, user_id: str) -> Optional["GPT3Conversation"]:
+        start = time.perf_counter()
+        # The pending snapshot stays until the conversation is tracked, the user exists meanwhile
+        snapshot = self._evicted.get(user_id)
+        conversation = await self._run_in_executor(self._build_conversation, user_id, snapshot)
+        if self._restores.get(user_id) is not asyncio.current_task() or user_id in self._user_to_conversation:
+            # Removed or replaced by a new conversation while it was restored
+            return self._user_to_conversation.get(user_id)
+        if conversation is not None:
+            self._track_restored(user_id, conversation, snapshot, start)
+        return conversation
+
+    def preload(self, limit: Optional[int] = None, executor: Optional[Executor] = None, chunk_size: int = 1000) -> int:
+        """
+        Restore the conversations of the most recently active users from the store, e.g. after a restart.
+
+        Args:
+            limit: The maximum number of conversations to restore, max_resident if not provided.
+            executor: The thread or process pool decoding the snapshots, decoded inline if not provided.
+            chunk_size: The number of snapshots decoded per task of the executor.
+
+        Returns: The number of restored conversations.
+        """
+        rows = self._store.load_recent(limit if limit is not None else self._max_resident)
+        chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+        decoded = executor.map(decode_snapshots, chunks) if executor is not None else map(decode_snapshots, chunks)
+
+        from converbot.core import GPT3Conversation
+
+        restored = 0
+        # The most recent users come first, they end up the most recently used ones
+        for user_id, snapshot in reversed([item for chunk in decoded for item in chunk]):
+            if user_id not in self._user_to_conversation:
+                self._track(user_id, GPT3Conversation.from_snapshot(snapshot))
+                restored += 1
+        self._enforce_max_resident()
+        return restored
+
+    def _evict(self, user_ids: Iterable[str]) -> int:
+        """
+        Remove the conversations from memory, keeping the snapshots of the changed ones for the next checkpoint.
+
+        Args:
+            user_ids: The user IDs of the conversations.
+
+        Returns: The number of evicted conversations.
+        """
+        start = time.perf_counter()
+        user_ids = list(user_ids)
+        for user_id in user_ids:
+            if user_id in self._dirty:
+                self._evicted[user_id] = self._user_to_conversation[user_id].snapshot()
+                self._dirty.discard(user_id)
+            self._untrack(user_id)
+        self.evictions += len(user_ids)
+        self.eviction_seconds += time.perf_counter() - start
+        return len(user_ids)
+
+    def _enforce_max_resident(self) -> None:
+        if self._max_resident is None:
+            return
+        overflow = len(self._user_to_conversation) - self._max_resident
+        if overflow <= 0:
+            return
+        least_recently_used = []
+        for user_id, conversation in self._user_to_conversation.items():
+            if len(least_recently_used) == overflow:
+                break
+            if not conversation.busy:
+                least_recently_used.append(user_id)
+        self._evict(least_recently_used)
+
+    def evict_idle(self) -> int:
+        """
+        Evict the conversations unused for longer than the idle timeout.
+
+        Returns: The number of evicted conversations.
+        """
+        if self._idle_timeout is None:
+            return 0
+        deadline = time.monotonic() - self._idle_timeout
+        idle = []
+        for user_id, conversation in self._user_to_conversation.items():
+            if self._last_access[user_id] > deadline:
+                break
+            if not conversation.busy:
+                idle.append(user_id)
+        return self._evict(idle)
 
     def write_chat_history(
         self, user_id: int, message: str, chatbot_response: str
     ) -> None:
         """
-        Write the chat history to disk.
+        Write the chat history to disk and index the turn for retrieval.
+
+        The row is queued and written in the background once the history writer is started.
 
         Args:
             user_id: The user ID.
@@ -55,32 +362,87 @@ class ConversationDB:
 
         Returns: None
         """
-        user_id = str(user_id)
-        filename = self._chat_history_save_dir / f"{user_id}.csv"
-        is_already_exist = filename.exists()
+        self._history_writer.write(user_id, message, chatbot_response)
+        self._retrieval.add(user_id, message, chatbot_response)
 
-        with (self._chat_history_save_dir / f"{user_id}.csv").open("a", encoding="utf-8") as f:
-            csv_writer = writer(
-                f, delimiter=",", quotechar='"', quoting=QUOTE_MINIMAL
-            )
-            if not is_already_exist:
-                csv_writer.writerow(
-                    ["time", "user_message", "chatbot_response"]
-                )
+    def _collect_dirty_snapshots(self) -> List[Tuple[str, ConversationSnapshot]]:
+        snapshots = [
+            (user_id, self._user_to_conversation[user_id].snapshot())
+            for user_id in self._dirty
+            if user_id in self._user_to_conversation
+        ]
+        self._dirty.clear()
+        # Kept until written, a conversation accessed meanwhile is rebuilt from them and not from the store
+        snapshots.extend(self._evicted.items())
+        return snapshots
 
-            csv_writer.writerow([time.time(), message, chatbot_response])
+    def _restore_dirty(
+        self, snapshots: List[Tuple[str, ConversationSnapshot]], removed: Optional[Set[str]] = None
+    ) -> None:
+        # The write failed, the next checkpoint saves the conversations again
+        for user_id, snapshot in snapshots:
+            if removed is not None and user_id in removed:
+                continue
+            if user_id in self._user_to_conversation:
+                self._dirty.add(user_id)
+            else:
+                # Evicted while the snapshot was written
+                self._evicted.setdefault(user_id, snapshot)
+
+    def _forget_saved(self, snapshots: List[Tuple[str, ConversationSnapshot]]) -> None:
+        for user_id, snapshot in snapshots:
+            # Unless evicted again with newer changes while the snapshot was written
+            if self._evicted.get(user_id) is snapshot:
+                del self._evicted[user_id]
+
+    def checkpoint(self) -> int:
+        """
+        Save the conversations that changed since the last checkpoint.
+
+        Returns: The number of saved conversations.
+        """
+        snapshots = self._collect_dirty_snapshots()
+        try:
+            saved = self._store.save_many(snapshots)
+        except Exception:
+            self._restore_dirty(snapshots)
+            raise
+        self._forget_saved(snapshots)
+        return saved
+
+    async def acheckpoint(self) -> int:
+        """
+        Save the conversations that changed since the last checkpoint, writing in a worker thread.
+
+        Returns: The number of saved conversations.
+        """
+        snapshots = self._collect_dirty_snapshots()
+        if not snapshots:
+            return 0
+        removed: Set[str] = set()
+        self._removed_during_writes.append(removed)
+        try:
+            saved = await self._run_in_executor(self._store.save_many, snapshots, removed)
+        except Exception:
+            self._restore_dirty(snapshots, removed)
+            raise
+        finally:
+            # By identity, the sets of the other writes may be equal
+            self._removed_during_writes = [other for other in self._removed_during_writes if other is not removed]
+        self._forget_saved(snapshots)
+        return saved
 
     def serialize_conversations(self) -> None:
         """
-        Serialize the conversations to disk.
+        Serialize all conversations in memory to disk.
 
         Returns: None
         """
-        for user_id, conversation in self._user_to_conversation.items():
-            conversation.serialize(user_id, self._conversation_save_dir)
+        self._dirty.update(self._user_to_conversation)
+        self.checkpoint()
 
     def __del__(self) -> None:
         """
-        Serialize the conversations to disk when the object is deleted.
+        Save the changed conversations to disk when the object is deleted.
         """
-        self.serialize_conversations()
+        self.checkpoint()
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import time
+from collections import defaultdict
+from csv import QUOTE_MINIMAL, writer
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from converbot.constants import CHATBOT_RESPONSE, HISTORY_SAVE_DIR, TIME, USER_MESSAGE
+from converbot.metrics import observe_stage
+
+HistoryRow = Tuple[str, float, str, str]
+
+
+class ChatHistoryWriter:
+    """
+    Buffered writer of the chat history csv files.
+
+    Rows are queued in memory and written by a background task in batches, once
+    ``batch_size`` rows are queued or every ``flush_interval`` seconds, in a worker
+    thread so the event loop never waits for the disk. Until ``start`` is called,
+    rows are written synchronously. When a flush fails, e.g. on a full disk, the rows
+    not written go back to the head of the queue and the next flush retries them.
+
+    Args:
+        save_dir: The directory of the chat history files.
+        batch_size: The number of queued rows that triggers a flush.
+        flush_interval: The maximum number of seconds a row stays in memory.
+        fsync: Whether every flush waits for the rows to reach the disk, otherwise
+            they are handed to the operating system only.
+    """
+
+    def __init__(
+        self,
+        save_dir: Path = HISTORY_SAVE_DIR,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        fsync: bool = False,
+    ) -> None:
+        self._save_dir = save_dir
+        self._save_dir.mkdir(parents=True, exist_ok=True)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+
+        self._queue: List[HistoryRow] = []
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._flush_lock = asyncio.Lock()
+
+        self.written_rows = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+
+    def write(self, user_id: int, message: str, chatbot_response: str) -> None:
+        """
+        Queue a row of the chat history.
+
+        Args:
+            user_id: The user ID.
+            message: The user's message.
+            chatbot_response: The chatbot's response.
+        """
+        row = (str(user_id), time.time(), message, chatbot_response)
+        if self._task is None:
+            self._write_rows([row])
+            return
+
+        self._queue.append(row)
+        if len(self._queue) >= self._batch_size:
+            self._batch_ready.set()
+
+    def start(self) -> None:
+        """
+        Start the background flushing task on the running event loop.
+        """
+        if self._task is None:
+            self._closing = False
+            self._batch_ready = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """
+        Write all queued rows.
+        """
+        async with self._flush_lock:
+            rows, self._queue = self._queue, []
+            if not rows:
+                return
+            written_users: Set[str] = set()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_rows, rows, written_users)
+            except Exception as e:
+                print(e)
+                self.failed_flushes += 1
+                # The files of the written users are complete, their rows must not be written twice
+                self._queue[:0] = [row for row in rows if row[0] not in written_users]
+
+    async def close(self) -> None:
+        """
+        Stop the background task and write the remaining rows.
+        """
+        if self._task is not None:
+            # Let the task finish its current flush instead of cancelling it mid-write
+            self._closing = True
+            self._batch_ready.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def _write_rows(self, rows: List[HistoryRow], written_users: Optional[Set[str]] = None) -> None:
+        """
+        Append the rows to the files of their users.
+
+        Args:
+            rows: The rows to write.
+            written_users: Filled with the users whose rows are written, as the files are written.
+        """
+        start = time.perf_counter()
+        rows_by_user: Dict[str, List[HistoryRow]] = defaultdict(list)
+        for row in rows:
+            rows_by_user[row[0]].append(row)
+
+        for user_id, user_rows in rows_by_user.items():
+            filename = self._save_dir / f"{user_id}.csv"
+            is_already_exist = filename.exists()
+            with filename.open("a", encoding="utf-8") as f:
+                csv_writer = writer(f, delimiter=",", quotechar='"', quoting=QUOTE_MINIMAL)
+                if not is_already_exist:
+                    csv_writer.writerow([TIME, USER_MESSAGE, CHATBOT_RESPONSE])
+                csv_writer.writerows([row[1:] for row in user_rows])
+                if self._fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if written_users is not None:
+                written_users.add(user_id)
+
+        self.written_rows += len(rows)
+        self.flushes += 1
+        observe_stage("history_write", time.perf_counter() - start)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued_rows": len(self._queue),
+            "written_rows": self.written_rows,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+        }
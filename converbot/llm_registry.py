@@ -0,0 +1,258 @@
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+import openai
+from langchain.callbacks.base import CallbackManager
+from langchain.llms import OpenAI
+from langchain.llms.base import BaseLLM
+
+from converbot.admission import AdmissionController
+from converbot.callbacks import LLMMetricsCallback, TokenStreamCallback
+from converbot.config import RomanitcConversationConfig
+from converbot.constants import DEFAULT_CONFIG_PATH
+from converbot.context_handler import ConversationBotContextHandler
+from converbot.mood_handler import ConversationToneHandler
+from converbot.persona_registry import PersonaRegistry
+from converbot.resilience import CircuitBreaker, RetryPolicy
+from converbot.tokens import get_token_counter
+from converbot.txtstyle_handler import ConversationTextStyleHandler, ConversationTextStyleRefinementHandler
+
+
+class LLMRegistry:
+    """
+    Process-wide registry of language model clients, helper handlers and parsed configs.
+
+    Conversations and handlers take their clients from here instead of building their own,
+    so a new conversation costs no file I/O and all of them share one pool of keep-alive
+    HTTP connections.
+
+    Args:
+        config_path: The path of the default configuration.
+        connection_pool_size: The maximum number of simultaneous connections to the API.
+        keepalive_timeout: The number of seconds an idle connection is kept open.
+        generation_cache_size: The number of tone and texting style generations cached in memory.
+        helper_batch_size: The maximum number of concurrent tone or texting style generations sent
+            as one completion request.
+        helper_batch_wait: The maximum number of seconds a generation waits for others to join its batch.
+        retry_attempts: The maximum number of attempts of a language model call.
+        retry_base_delay: The maximum delay before the first retry of a call, doubled for every next one.
+        breaker_failure_threshold: The number of consecutive failed calls that opens the circuit breaker.
+        breaker_reset_timeout: The number of seconds the circuit breaker stays open.
+        requests_per_minute: The budget of language model requests per minute, unlimited if None.
+        tokens_per_minute: The budget of language model tokens per minute, unlimited if None.
+    """
+
+    def __init__(
+        self,
+        config_path: Path = DEFAULT_CONFIG_PATH,
+        connection_pool_size: int = 100,
+        keepalive_timeout: float = 60.0,
+        generation_cache_size: int = 1024,
+        helper_batch_size: int = 20,
+        helper_batch_wait: float = 0.05,
+        retry_attempts: int = 4,
+        retry_base_delay: float = 0.5,
+        breaker_failure_threshold: int = 5,
+        breaker_reset_timeout: float = 30.0,
+        requests_per_minute: Optional[float] = 3000,
+        tokens_per_minute: Optional[float] = 250000,
+    ) -> None:
+        self._config_path = config_path
+        self._connection_pool_size = connection_pool_size
+        self._keepalive_timeout = keepalive_timeout
+        self._generation_cache_size = generation_cache_size
+        self._helper_batch_size = helper_batch_size
+        self._helper_batch_wait = helper_batch_wait
+
+        self._configs: Dict[Path, RomanitcConversationConfig] = {}
+        self._llms: Dict[Tuple, BaseLLM] = {}
+        self._handlers: Dict[str, object] = {}
+        self._personas = PersonaRegistry()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._call_policy = RetryPolicy(
+            max_attempts=retry_attempts,
+            base_delay=retry_base_delay,
+            breaker=CircuitBreaker(failure_threshold=breaker_failure_threshold, reset_timeout=breaker_reset_timeout),
+            admission=AdmissionController(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute),
+        )
+
+    @property
+    def call_policy(self) -> RetryPolicy:
+        """
+        The retry policy, circuit breaker and admission control shared by all language model calls.
+        """
+        return self._call_policy
+
+    @property
+    def personas(self) -> PersonaRegistry:
+        """
+        The prompts of the personas, shared by the conversations with the same persona.
+        """
+        return self._personas
+
+    def get_config(self, config_path: Optional[Path] = None) -> RomanitcConversationConfig:
+        """
+        Get the parsed configuration, reading it from disk only the first time.
+
+        Args:
+            config_path: The path of the configuration, the default one if not provided.
+
+        Returns: The configuration.
+        """
+        config_path = Path(config_path or self._config_path)
+        if config_path not in self._configs:
+            self._configs[config_path] = RomanitcConversationConfig.from_json(config_path)
+        return self._configs[config_path]
+
+    def get_llm(self, config: Optional[RomanitcConversationConfig] = None) -> BaseLLM:
+        """
+        Get the shared language model client for the configuration.
+
+        Args:
+            config: The configuration, the default one if not provided.
+
+        Returns: The language model.
+        """
+        config = config or self.get_config()
+        key = (
+            config.model,
+            config.temperature,
+            config.max_tokens,
+            config.top_p,
+            config.frequency_penalty,
+            config.presence_penalty,
+            config.best_of,
+            config.streaming,
+        )
+        if key not in self._llms:
+            self._llms[key] = OpenAI(
+                model_name=config.model,
+                temperature=config.temperature,
+                max_tokens=config.max_tokens,
+                top_p=config.top_p,
+                frequency_penalty=config.frequency_penalty,
+                presence_penalty=config.presence_penalty,
+                best_of=config.best_of,
+                streaming=config.streaming,
+                # Retries are done by the call policy
+                max_retries=1,
+                # Streamed tokens are forwarded to the turn that requested them
+                callback_manager=CallbackManager([TokenStreamCallback()]),
+            )
+            self._add_metrics_callback(self._llms[key])
+        return self._llms[key]
+
+    def get_helper_llm(self) -> BaseLLM:
+        """
+        Get the shared language model client used by the tone, style and context handlers.
+
+        Returns: The language model.
+        """
+        if ("helper",) not in self._llms:
+            # An own callback manager, the default one is shared by every langchain object
+            self._llms[("helper",)] = OpenAI(max_retries=1, callback_manager=CallbackManager([]))
+            self._add_metrics_callback(self._llms[("helper",)])
+        return self._llms[("helper",)]
+
+    @staticmethod
+    def _add_metrics_callback(llm: BaseLLM) -> None:
+        llm.callback_manager.add_handler(LLMMetricsCallback(get_token_counter(llm)))
+
+    def _get_handler(self, name: str, handler_cls: type, **kwargs) -> object:
+        if name not in self._handlers:
+            self._handlers[name] = handler_cls(llm=self.get_helper_llm(), **kwargs)
+        return self._handlers[name]
+
+    def _get_helper_handler(self, name: str, handler_cls: type) -> object:
+        return self._get_handler(
+            name,
+            handler_cls,
+            cache_size=self._generation_cache_size,
+            max_batch_size=self._helper_batch_size,
+            max_batch_wait=self._helper_batch_wait,
+            call_policy=self._call_policy,
+        )
+
+    def tone_handler(self) -> ConversationToneHandler:
+        return self._get_helper_handler("tone", ConversationToneHandler)
+
+    def text_style_handler(self) -> ConversationTextStyleHandler:
+        return self._get_helper_handler("text_style", ConversationTextStyleHandler)
+
+    def text_style_refinement_handler(self) -> ConversationTextStyleRefinementHandler:
+        return self._get_helper_handler("text_style_refinement", ConversationTextStyleRefinementHandler)
+
+    def context_handler(self) -> ConversationBotContextHandler:
+        return self._get_handler("context", ConversationBotContextHandler)
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Get the hit and miss counters of the generation caches of the created handlers.
+
+        Returns: The counters by handler name.
+        """
+        return {
+            name: handler.cache_stats
+            for name, handler in self._handlers.items()
+            if getattr(handler, "cache_stats", None) is not None
+        }
+
+    def batch_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Get the number of batches and batched calls of the created handlers.
+
+        Returns: The counters by handler name.
+        """
+        return {
+            name: handler.batch_stats
+            for name, handler in self._handlers.items()
+            if getattr(handler, "batch_stats", None) is not None
+        }
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the shared HTTP session, creating it on the running event loop if needed.
+
+        Returns: The HTTP session.
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._connection_pool_size,
+                    keepalive_timeout=self._keepalive_timeout,
+                )
+            )
+        return self._session
+
+    async def bind_session(self) -> None:
+        """
+        Make async OpenAI calls in the current task reuse the shared HTTP session.
+
+        The openai client keeps the session in a context variable, so this has to be
+        called from every task that makes calls, e.g. once per handled update.
+        """
+        openai.aiosession.set(await self.get_session())
+
+    async def close(self) -> None:
+        """
+        Close the shared HTTP session.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+_REGISTRY: Optional[LLMRegistry] = None
+
+
+def get_registry() -> LLMRegistry:
+    """
+    Get the process-wide registry.
+
+    Returns: The registry.
+    """
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = LLMRegistry()
+    return _REGISTRY
@@ -0,0 +1,226 @@
+import asyncio
+from typing import Any, Dict, List, Optional
+
+from langchain import LLMChain
+from langchain.chains.conversation.memory import ConversationSummaryBufferMemory
+from pydantic import PrivateAttr
+
+from converbot.admission import BACKGROUND, admission_priority
+from converbot.metrics import timed_stage
+from converbot.resilience import RetryPolicy
+from converbot.tokens import MemoizedTokenCount, TokenLedger, get_token_counter
+
+
+class AsyncConversationSummaryBufferMemory(ConversationSummaryBufferMemory):
+    """
+    Summary buffer memory whose pruning can be awaited.
+
+    ``save_context`` only appends the new lines to the buffer, pruning is done
+    explicitly with ``prune`` or ``aprune`` after the reply has been produced,
+    so the summarization call never blocks the event loop.
+
+    With ``deferred`` set, ``aprune`` returns immediately and the overflow is summarized
+    in a background task. A turn that starts before the task is done can wait for it with
+    ``wait_for_summary`` and otherwise goes on without the overflow lines. The lines of a failed
+    background summarization are kept and retried by the next prune; after
+    ``max_summary_failures`` failures in a row they are dropped and the conversation goes on
+    with the old summary.
+
+    Token counts are kept in a ledger: every buffered line is counted once when it is saved
+    and the summary once when it changes, so checking the limit does not re-tokenize the buffer.
+    """
+
+    deferred: bool = False
+    max_summary_failures: int = 3
+
+    _unsummarized: List[str] = PrivateAttr(default_factory=list)
+    _summary_failures: int = PrivateAttr(default=0)
+    _dropped_lines: int = PrivateAttr(default=0)
+    _summary_task: Optional[asyncio.Task] = PrivateAttr(default=None)
+    _truncated_turns: int = PrivateAttr(default=0)
+    # Chains validate a shallow copy of their memory, the ledger is mutated in place so it stays shared
+    _ledger: TokenLedger = PrivateAttr()
+    _summary_token_count: MemoizedTokenCount = PrivateAttr()
+    _call_policy: Optional[RetryPolicy] = PrivateAttr(default=None)
+
+    def __init__(self, **data: Any) -> None:
+        super().__init__(**data)
+        count_tokens = get_token_counter(self.llm)
+        self._ledger = TokenLedger(count_tokens)
+        self._summary_token_count = MemoizedTokenCount(count_tokens)
+
+    def set_call_policy(self, call_policy: Optional[RetryPolicy]) -> None:
+        """
+        Set the retry policy of the async summarization calls.
+
+        Args:
+            call_policy: The retry policy, None for no retries.
+        """
+        self._call_policy = call_policy
+
+    async def _asummarize(self, chain: LLMChain, pruned_memory: List[str]) -> str:
+        def summarize():
+            return chain.apredict(summary=self.moving_summary_buffer, new_lines="\n".join(pruned_memory))
+
+        with timed_stage("summarization"):
+            if self._call_policy is None:
+                return await summarize()
+            # A rough estimate of 4 characters per token is enough for the admission budget
+            prompt_chars = len(self.moving_summary_buffer) + sum(len(line) for line in pruned_memory)
+            tokens = prompt_chars // 4 + getattr(self.llm, "max_tokens", 256)
+            return await self._call_policy.call(summarize, tokens=tokens)
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        """
+        Save context from this conversation to buffer without pruning it.
+
+        Args:
+            inputs: The chain inputs.
+            outputs: The chain outputs.
+        """
+        prompt_input_key = self.input_key or list(inputs.keys())[0]
+        output_key = self.output_key or list(outputs.keys())[0]
+        human = f"{self.human_prefix}: {inputs[prompt_input_key]}"
+        ai = f"{self.ai_prefix}: {outputs[output_key]}"
+        new_lines = "\n".join([human, ai])
+        self._sync_token_counts()
+        self.buffer.append(new_lines)
+        self._ledger.append(new_lines)
+
+    def _sync_token_counts(self) -> None:
+        # The buffer was replaced from outside, e.g. restored from disk
+        if len(self._ledger) != len(self.buffer):
+            self._ledger.reset(self.buffer)
+
+    def _pop_overflow(self) -> List[str]:
+        """
+        Remove the oldest buffered lines until the buffer fits the token limit.
+
+        Returns: The removed lines.
+        """
+        self._sync_token_counts()
+        pruned_memory = []
+        while self.buffer and self._ledger.total > self.max_token_limit:
+            pruned_memory.append(self.buffer.pop(0))
+            self._ledger.pop_oldest()
+        return pruned_memory
+
+    def clear(self) -> None:
+        super().clear()
+        self._unsummarized = []
+        self._ledger.reset([])
+
+    @property
+    def buffer_tokens(self) -> int:
+        self._sync_token_counts()
+        return self._ledger.total
+
+    @property
+    def summary_tokens(self) -> int:
+        return self._summary_token_count(self.moving_summary_buffer)
+
+    @property
+    def num_tokens(self) -> int:
+        """
+        The number of tokens the memory adds to the prompt.
+        """
+        return self.summary_tokens + self.buffer_tokens
+
+    def prune(self) -> None:
+        """
+        Summarize the overflow of the buffer into the moving summary.
+        """
+        pruned_memory = self._pop_overflow()
+        if not pruned_memory:
+            return
+        chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        self.moving_summary_buffer = chain.predict(
+            summary=self.moving_summary_buffer, new_lines="\n".join(pruned_memory)
+        )
+
+    async def aprune(self) -> None:
+        """
+        Summarize the overflow of the buffer into the moving summary asynchronously.
+
+        In deferred mode the summarization is only scheduled.
+        """
+        pruned_memory = self._pop_overflow()
+        if self.deferred:
+            # Also retries the lines of a failed summarization
+            self._unsummarized.extend(pruned_memory)
+            if self._unsummarized and (self._summary_task is None or self._summary_task.done()):
+                self._summary_task = asyncio.ensure_future(self._summarize_unsummarized())
+            return
+        if not pruned_memory:
+            return
+        chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        self.moving_summary_buffer = await self._asummarize(chain, pruned_memory)
+
+    async def _summarize_unsummarized(self) -> None:
+        chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        while self._unsummarized:
+            # The lines stay unsummarized until done, the lines pruned meanwhile are appended
+            unsummarized = self._unsummarized
+            pruned_memory = list(unsummarized)
+            try:
+                # Nobody waits for a deferred summary, the turns of the users are admitted first
+                with admission_priority(BACKGROUND):
+                    self.moving_summary_buffer = await self._asummarize(chain, pruned_memory)
+            except Exception as e:
+                print(e)
+                self._summary_failures += 1
+                if self._summary_failures < self.max_summary_failures:
+                    # Retried by the next prune
+                    return
+                # The overflow lines are dropped, the conversation goes on with the old summary
+                self._dropped_lines += len(pruned_memory)
+            self._summary_failures = 0
+            # A clear meanwhile replaced the list, the lines saved since then are kept
+            del unsummarized[:len(pruned_memory)]
+
+    async def wait_for_summary(self, timeout: float) -> bool:
+        """
+        Wait for the background summarization to finish.
+
+        Args:
+            timeout: The maximum number of seconds to wait.
+
+        Returns: Whether the summary is up to date, otherwise the turn runs on a truncated memory.
+        """
+        if self._summary_task is None or self._summary_task.done():
+            return True
+        if timeout > 0:
+            await asyncio.wait({self._summary_task}, timeout=timeout)
+        if self._summary_task.done():
+            return True
+        self._truncated_turns += 1
+        return False
+
+    @property
+    def unsummarized_lines(self) -> List[str]:
+        """
+        The lines removed from the buffer whose background summarization is not done yet.
+        """
+        return list(self._unsummarized)
+
+    @property
+    def summarization_pending(self) -> bool:
+        return self._summary_task is not None and not self._summary_task.done()
+
+    @property
+    def truncated_turns(self) -> int:
+        return self._truncated_turns
+
+    @property
+    def summary_failures(self) -> int:
+        """
+        The number of background summarizations failed in a row.
+        """
+        return self._summary_failures
+
+    @property
+    def dropped_lines(self) -> int:
+        """
+        The number of lines dropped after ``max_summary_failures`` failed summarizations.
+        """
+        return self._dropped_lines
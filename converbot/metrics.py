@@ -0,0 +1,278 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+StatsCollector = Callable[[], Dict[str, object]]
+
+_STAGE: ContextVar[str] = ContextVar("metrics_stage", default="other")
+_PROMPT_BUILD_STARTED_AT: ContextVar[Optional[float]] = ContextVar("prompt_build_started_at", default=None)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    """
+    Monotonic counter, one value per combination of labels.
+
+    Args:
+        name: The name of the metric.
+        documentation: The help text of the metric.
+        label_names: The names of the labels.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self._documentation = documentation
+        self._label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self._label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self._documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(list(zip(self._label_names, key)))} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, one distribution per combination of labels.
+
+    Args:
+        name: The name of the metric.
+        documentation: The help text of the metric.
+        buckets: The upper bounds of the buckets, in increasing order.
+        label_names: The names of the labels.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        label_names: Sequence[str] = (),
+    ) -> None:
+        self.name = name
+        self._documentation = documentation
+        self._buckets = tuple(buckets)
+        self._label_names = tuple(label_names)
+        # Per labels: the count of every bucket and of the overflow, then the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self._label_names)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self._buckets) + 1), [0.0]))
+            counts[bisect_left(self._buckets, value)] += 1
+            total[0] += value
+
+    def summary(self) -> Dict[Tuple[str, ...], Dict[str, float]]:
+        """
+        Get the number and the sum of the observed values per combination of labels.
+        """
+        with self._lock:
+            return {key: {"count": sum(counts), "sum": total[0]} for key, (counts, total) in self._values.items()}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self._documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                labels = list(zip(self._label_names, key))
+                cumulative = 0
+                for bound, count in zip(self._buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total[0])}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """
+    Process-wide metrics of the bot, exported in the Prometheus text format.
+
+    Every stage of a turn is timed in ``stage_seconds``: queue wait, admission wait, summary wait,
+    prompt build, LLM call, summarization, history write and Telegram send, and the tone and
+    texting style generations of the onboarding. Every request to a language model is recorded
+    with its latency and its prompt and completion token counts, labelled by the stage it was
+    made in, and every turn with the token counts of the sections of its prompt. The stats of
+    the components can be exported as gauges with ``add_gauges``.
+    """
+
+    def __init__(self) -> None:
+        self.stage_seconds = Histogram(
+            "converbot_stage_seconds", "Time spent in each stage of the handling of a message.",
+            LATENCY_BUCKETS, ("stage",),
+        )
+        self.llm_request_seconds = Histogram(
+            "converbot_llm_request_seconds", "Latency of the requests to the language models.",
+            LATENCY_BUCKETS, ("stage",),
+        )
+        self.llm_prompt_tokens = Histogram(
+            "converbot_llm_prompt_tokens", "Prompt tokens of the requests to the language models.",
+            TOKEN_BUCKETS, ("stage",),
+        )
+        self.llm_completion_tokens = Histogram(
+            "converbot_llm_completion_tokens", "Completion tokens of the requests to the language models.",
+            TOKEN_BUCKETS, ("stage",),
+        )
+        self.prompt_section_tokens = Histogram(
+            "converbot_prompt_section_tokens", "Tokens of every section of the prompt of a turn.",
+            TOKEN_BUCKETS, ("section",),
+        )
+        self.llm_errors = Counter(
+            "converbot_llm_errors_total", "Failed requests to the language models.", ("stage",),
+        )
+        self._metrics: List[Union[Counter, Histogram]] = [
+            self.stage_seconds,
+            self.llm_request_seconds,
+            self.llm_prompt_tokens,
+            self.llm_completion_tokens,
+            self.prompt_section_tokens,
+            self.llm_errors,
+        ]
+        self._gauges: Dict[str, StatsCollector] = {}
+
+    def add_gauges(self, prefix: str, collect: StatsCollector) -> None:
+        """
+        Export the numeric stats of a component as gauges, read at every scrape.
+
+        Args:
+            prefix: The prefix of the gauge names, e.g. "conversations".
+            collect: The function returning the stats.
+        """
+        self._gauges[prefix] = collect
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for prefix, collect in self._gauges.items():
+            for key, value in collect().items():
+                if isinstance(value, (int, float)):
+                    name = f"converbot_{prefix}_{key}"
+                    lines.extend([f"# TYPE {name} gauge", f"{name} {_format_value(value)}"])
+        return "\n".join(lines) + "\n"
+
+
+_METRICS: Optional[Metrics] = None
+
+
+def get_metrics() -> Metrics:
+    """
+    Get the process-wide metrics.
+
+    Returns: The metrics.
+    """
+    global _METRICS
+    if _METRICS is None:
+        _METRICS = Metrics()
+    return _METRICS
+
+
+def current_stage() -> str:
+    return _STAGE.get()
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    get_metrics().stage_seconds.observe(seconds, stage=stage)
+
+
+@contextmanager
+def timed_stage(stage: str) -> Iterator[None]:
+    """
+    Time the block as a stage, language model requests made in the block are labelled with it.
+
+    Args:
+        stage: The name of the stage.
+    """
+    reset_token = _STAGE.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+        _STAGE.reset(reset_token)
+
+
+def start_prompt_build() -> None:
+    """
+    Mark the start of the prompt build of the current task, it ends when the language model request starts.
+    """
+    _PROMPT_BUILD_STARTED_AT.set(time.perf_counter())
+
+
+def finish_prompt_build() -> None:
+    started_at = _PROMPT_BUILD_STARTED_AT.get()
+    if started_at is not None:
+        _PROMPT_BUILD_STARTED_AT.set(None)
+        observe_stage("prompt_build", time.perf_counter() - started_at)
+
+
+def make_metrics_app(metrics: Optional[Metrics] = None) -> "web.Application":
+    """
+    Make the application serving the metrics at ``/metrics``.
+
+    Args:
+        metrics: The metrics, the process-wide ones if not provided.
+
+    Returns: The application.
+    """
+    from aiohttp import web
+
+    metrics = metrics or get_metrics()
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+async def start_metrics_server(host: str = "127.0.0.1", port: int = 9100) -> "web.AppRunner":
+    """
+    Serve the process-wide metrics on the running event loop.
+
+    Args:
+        host: The address to listen on, local only by default.
+        port: The port to listen on.
+
+    Returns: The runner of the server, to clean it up on shutdown.
+    """
+    from aiohttp import web
+
+    runner = web.AppRunner(make_metrics_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
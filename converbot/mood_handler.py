@@ -1,9 +1,22 @@
-from langchain import PromptTemplate, LLMChain, OpenAI
+from typing import Optional
 
+from langchain.llms.base import BaseLLM
 
-class ConversationToneHandler:
+from converbot.chain_handler import CachedChainHandler
+from converbot.resilience import RetryPolicy
 
-    def __init__(self):
+
+class ConversationToneHandler(CachedChainHandler):
+    cache_namespace = "tone"
+
+    def __init__(
+        self,
+        llm: Optional[BaseLLM] = None,
+        cache_size: int = 0,
+        max_batch_size: int = 0,
+        max_batch_wait: float = 0.05,
+        call_policy: Optional[RetryPolicy] = None,
+    ):
         prompt_template = """Summarize person's tone for the conversation.
         
         Example:
@@ -32,13 +45,11 @@ class ConversationToneHandler:
         Context: {user_input}
         Conversation tone:
         """
-        prompt_template = PromptTemplate(input_variables=["user_input"], template=prompt_template)
-
-        self._chain = LLMChain(
-            llm=OpenAI(),
-            prompt=prompt_template,
-            verbose=False,
+        super().__init__(
+            prompt_template,
+            llm=llm,
+            cache_size=cache_size,
+            max_batch_size=max_batch_size,
+            max_batch_wait=max_batch_wait,
+            call_policy=call_policy,
         )
-
-    def __call__(self, user_input: str) -> str:
-        return self._chain.predict(user_input=user_input)
@@ -0,0 +1,183 @@
+import asyncio
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional
+
+from converbot.metrics import observe_stage
+
+if TYPE_CHECKING:
+    # Imported on first use, they load the whole language model stack
+    from converbot.core import GPT3Conversation
+    from converbot.llm_registry import LLMRegistry
+
+
+def _retrieve_exception(future: asyncio.Future) -> None:
+    # A draft may never be awaited, its failure must not be reported as never retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+class PersonaPreprocessor:
+    """
+    Generate the texting style and the tone of the personas while their onboarding is still going on.
+
+    The texting style is drafted with ``draft_text_style`` as soon as everything but the
+    personality is known, while the user is still describing the personality. With a draft,
+    ``create_conversation`` builds the conversation at once, with the draft style and the
+    personality as tone. The style is then refined with the personality and the tone generated
+    in the background. A turn calls ``wait_ready`` first, so it waits for what is left of them,
+    usually nothing since the user is typing meanwhile. If the background generation fails, the
+    conversation goes on with the draft style and the personality as tone.
+
+    Without a draft finished within ``draft_wait`` seconds, e.g. when the user answered much faster
+    than the draft was generated or after a restart in the middle of the onboarding, the conversation is created as before: the
+    texting style and the tone are generated while the user waits.
+
+    Args:
+        registry: The registry to take the configuration and handlers from, the process-wide one if not provided.
+        draft_wait: The maximum number of seconds the end of the onboarding waits for an unfinished draft.
+        max_drafts: The maximum number of drafts kept, the oldest ones are dropped first, e.g. of
+            abandoned onboardings.
+    """
+
+    def __init__(
+        self, registry: Optional["LLMRegistry"] = None, draft_wait: float = 0.5, max_drafts: int = 10000
+    ) -> None:
+        self._registry = registry
+        self._draft_wait = draft_wait
+        self._max_drafts = max_drafts
+        self._drafts: "OrderedDict[int, asyncio.Future]" = OrderedDict()
+        self._pending: Dict[int, asyncio.Future] = {}
+
+        self.drafts = 0
+        self.drafts_used = 0
+        self.drafts_discarded = 0
+        self.background_failures = 0
+        self.turns_waited = 0
+        self.wait_seconds = 0.0
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "drafts": self.drafts,
+            "drafts_used": self.drafts_used,
+            "drafts_discarded": self.drafts_discarded,
+            "pending": len(self._pending),
+            "background_failures": self.background_failures,
+            "turns_waited": self.turns_waited,
+            "wait_seconds": self.wait_seconds,
+        }
+
+    def _get_registry(self) -> "LLMRegistry":
+        from converbot.llm_registry import get_registry
+
+        return self._registry or get_registry()
+
+    def draft_text_style(self, user_id: int, context: str) -> None:
+        """
+        Start generating the texting style of the persona of the user from its partial context.
+
+        Args:
+            user_id: The user.
+            context: The context of the persona, without its personality.
+        """
+        self.discard(user_id)
+        draft = asyncio.ensure_future(self._get_registry().text_style_handler().acall(context))
+        draft.add_done_callback(_retrieve_exception)
+        self._drafts[user_id] = draft
+        self.drafts += 1
+        while len(self._drafts) > self._max_drafts:
+            _, oldest = self._drafts.popitem(last=False)
+            oldest.cancel()
+            self.drafts_discarded += 1
+
+    def discard(self, user_id: int) -> None:
+        """
+        Cancel the draft and the background generation of the user, e.g. when the onboarding restarts.
+
+        Args:
+            user_id: The user.
+        """
+        draft = self._drafts.pop(user_id, None)
+        if draft is not None:
+            draft.cancel()
+            self.drafts_discarded += 1
+        pending = self._pending.pop(user_id, None)
+        if pending is not None:
+            pending.cancel()
+
+    async def create_conversation(
+        self, user_id: int, context: str, personality: str, config_path: Path
+    ) -> "GPT3Conversation":
+        """
+        Create the conversation of the user at the end of the onboarding.
+
+        Args:
+            user_id: The user.
+            context: The complete context of the persona.
+            personality: The personality of the persona, its tone is generated from it.
+            config_path: The path of the conversation configuration.
+
+        Returns: The conversation, its texting style and tone may still be generated in the background.
+        """
+        from converbot.bot_utils import acreate_conversation_from_context, build_conversation
+
+        registry = self._get_registry()
+        draft = self._drafts.pop(user_id, None)
+        if draft is not None and not draft.done() and self._draft_wait > 0:
+            await asyncio.wait([draft], timeout=self._draft_wait)
+        if draft is None or not draft.done() or draft.cancelled() or draft.exception() is not None:
+            # Waiting longer for the draft and then refining it would take longer than generating the style at once
+            if draft is not None:
+                draft.cancel()
+                self.drafts_discarded += 1
+            return await acreate_conversation_from_context(context, personality, config_path, registry)
+        text_style = draft.result()
+
+        self.drafts_used += 1
+        conversation = build_conversation(context, text_style, personality, config_path, registry, process_tone=False)
+        pending = asyncio.ensure_future(self._finish(conversation, text_style, personality))
+        self._pending[user_id] = pending
+
+        def forget(_):
+            if self._pending.get(user_id) is pending:
+                del self._pending[user_id]
+
+        pending.add_done_callback(forget)
+        return conversation
+
+    async def _finish(self, conversation: "GPT3Conversation", draft_text_style: str, personality: str) -> None:
+        from converbot.txtstyle_handler import refinement_input
+
+        text_style, tone_result = await asyncio.gather(
+            self._get_registry().text_style_refinement_handler().acall(
+                refinement_input(draft_text_style, personality)
+            ),
+            conversation.aset_tone(personality),
+            return_exceptions=True,
+        )
+        for result in (text_style, tone_result):
+            if isinstance(result, Exception):
+                print(result)
+                self.background_failures += 1
+        if not isinstance(text_style, Exception):
+            conversation.set_text_style(text_style, self._get_registry())
+
+    async def wait_ready(self, user_id: int) -> None:
+        """
+        Wait for the background generation of the texting style and the tone of the user, if any.
+
+        Args:
+            user_id: The user.
+        """
+        pending = self._pending.get(user_id)
+        if pending is None:
+            return
+        start = time.perf_counter()
+        # Returns when the generation is done or discarded, without raising
+        await asyncio.wait([pending])
+        waited = time.perf_counter() - start
+        self.turns_waited += 1
+        self.wait_seconds += waited
+        observe_stage("persona_wait", waited)
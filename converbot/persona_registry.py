@@ -0,0 +1,91 @@
+import hashlib
+import json
+import weakref
+from typing import Callable, Dict
+
+from converbot.cache import collapse_whitespace
+from converbot.config import RomanitcConversationConfig
+from converbot.prompt import PersonaPrompt
+from converbot.prompt_compiler import PromptCompiler
+
+
+class SharedPersona:
+    """
+    The prompt of a persona and its static token count, shared by the conversations with the persona.
+
+    Args:
+        key: The content address of the persona.
+        prompt: The compiled prompt.
+        static_prompt_tokens: The number of tokens of the prompt template without its variables.
+    """
+
+    def __init__(self, key: str, prompt: PersonaPrompt, static_prompt_tokens: int) -> None:
+        self.key = key
+        self.prompt = prompt
+        self.static_prompt_tokens = static_prompt_tokens
+
+
+class PersonaRegistry:
+    """
+    Content-addressed store of the personas, so conversations with the same persona share one prompt.
+
+    A persona is addressed by the hash of the configuration version with the context and texting
+    style, whitespace aside, so personas differing only in spacing share an entry, built from the
+    first of them. The case is kept: the prompt of the entry carries the exact words of the user.
+    The texting styles themselves are shared by the generation cache of the texting style handler.
+
+    Entries are held weakly: an entry lives as long as a conversation uses it.
+    """
+
+    def __init__(self) -> None:
+        self._personas: "weakref.WeakValueDictionary[str, SharedPersona]" = weakref.WeakValueDictionary()
+
+        self.lookups = 0
+        self.hits = 0
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        live = len(self._personas)
+        return {
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "live": live,
+            "hit_ratio": self.hits / self.lookups if self.lookups else 0.0,
+            # The number of conversations created per prompt built
+            "dedup_ratio": self.lookups / (self.lookups - self.hits) if self.lookups > self.hits else 0.0,
+        }
+
+    def make_key(self, config: RomanitcConversationConfig, context: str, text_style: str) -> str:
+        data = json.dumps([config.version, collapse_whitespace(context), collapse_whitespace(text_style)])
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(
+        self,
+        config: RomanitcConversationConfig,
+        context: str,
+        text_style: str,
+        count_tokens: Callable[[str], int],
+    ) -> SharedPersona:
+        """
+        Get the shared persona, compiling its prompt if no conversation uses it yet.
+
+        Args:
+            config: The configuration of the conversation.
+            context: The persona context of the chatbot.
+            text_style: The texting style of the chatbot.
+            count_tokens: The token counting function of the language model of the configuration.
+
+        Returns: The shared persona.
+        """
+        self.lookups += 1
+        key = self.make_key(config, context, text_style)
+        persona = self._personas.get(key)
+        if persona is not None:
+            self.hits += 1
+            return persona
+
+        compiler = PromptCompiler(count_tokens, config.prompt_budgets)
+        prompt = PersonaPrompt(config.prompt_template, context, text_style, compiler=compiler)
+        persona = SharedPersona(key, prompt, prompt.count_static_tokens(count_tokens))
+        self._personas[key] = persona
+        return persona
@@ -1,8 +1,17 @@
+from typing import Callable, List, Optional
+
 from langchain import PromptTemplate
 
+from converbot.prompt_compiler import CompiledPrompt, PromptCompiler, PromptPart
+
+AI_MODEL_INSTRUCTIONS = "You are an AI model pretending to be a human. You cannot make plans or meet anyone in the " \
+                        "real world. You are unable to leave your computer."
+RETRIEVED_MEMORY_HEADER = "Earlier in the conversation:"
+
 
 class ConversationPrompt:
     memory_key = "chat_history"
+    retrieved_memory_key = "retrieved_memory"
     user_input_key = "user_input"
     conversation_tone_key = "conversation_tone"
 
@@ -13,7 +22,7 @@ class ConversationPrompt:
         chatbot_name: str = "You",
     ):
         string_base_template = """PROMPT_TEXT
-{chat_history}
+{retrieved_memory}{chat_history}
 USER_NAME: {user_input}
 CHATBOT_NAME ({conversation_tone}):"""
         string_base_template = string_base_template.replace(
@@ -27,10 +36,11 @@ CHATBOT_NAME ({conversation_tone}):"""
         )
         #print(string_base_template)
         self._prompt = PromptTemplate(
-            input_variables=["chat_history", "user_input", "conversation_tone"],
+            input_variables=["retrieved_memory", "chat_history", "user_input", "conversation_tone"],
             template=string_base_template,
         )
 
+        self._prompt_text = prompt_text
         self._user_name = user_name
         self._chatbot_name = chatbot_name
 
@@ -38,6 +48,37 @@ CHATBOT_NAME ({conversation_tone}):"""
     def prompt(self) -> PromptTemplate:
         return self._prompt
 
+    @property
+    def prompt_text(self) -> str:
+        return self._prompt_text
+
+    def count_static_tokens(self, count_tokens: Callable[[str], int]) -> int:
+        """
+        Count the tokens of the prompt template without its variables.
+
+        Args:
+            count_tokens: The token counting function.
+
+        Returns: The number of tokens.
+        """
+        template = self._prompt.template
+        for variable in self._prompt.input_variables:
+            template = template.replace("{" + variable + "}", "")
+        return count_tokens(template)
+
+    def format_retrieved_memory(self, turns: List[str]) -> str:
+        """
+        Format the past turns retrieved for the next turn, inserted before the conversation memory.
+
+        Args:
+            turns: The turns, each one formatted like the lines of the memory.
+
+        Returns: The text of the retrieved memory, empty without turns.
+        """
+        if not turns:
+            return ""
+        return RETRIEVED_MEMORY_HEADER + "\n" + "\n".join(turns) + "\n\n"
+
     @property
     def chatbot_name(self) -> str:
         return self._chatbot_name
@@ -81,3 +122,54 @@ class RomanticConversationPrompt(ConversationPrompt):
             user_name="Human",
             chatbot_name=name,
         )
+
+
+class PersonaPrompt(ConversationPrompt):
+    """
+    Prompt for a conversation with a persona described by the user.
+
+    The prompt text is assembled by a PromptCompiler: repeated instructions are sent once and
+    every section is kept within its token budget.
+
+    Args:
+        prompt_template: The instructions of the prompt.
+        context: The persona context of the chatbot.
+        text_style: The texting style of the chatbot.
+        compiler: The prompt compiler, one without budgets if not provided.
+    """
+
+    def __init__(
+        self,
+        prompt_template: str,
+        context: str,
+        text_style: str,
+        compiler: Optional[PromptCompiler] = None,
+    ):
+        compiler = compiler or PromptCompiler()
+        self._compiled = compiler.compile([
+            PromptPart("instructions", prompt_template.rstrip("\n")),
+            PromptPart("instructions", AI_MODEL_INSTRUCTIONS, fixed=True),
+            PromptPart("persona", "Information about [Bot]:\n" + context),
+            PromptPart("style", "Following text defines [Bot] texting style and messaging style:" + text_style),
+            PromptPart("instructions", AI_MODEL_INSTRUCTIONS, fixed=True),
+            PromptPart("instructions", "Conversation:\n[Bot]: Lets start the conversation, can you tell me a little about yourself?", fixed=True),
+        ])
+        super(PersonaPrompt, self).__init__(
+            prompt_text=self._compiled.text,
+            user_name="[User]",
+            chatbot_name="[Bot]",
+        )
+        self._context = context
+        self._text_style = text_style
+
+    @property
+    def compiled(self) -> CompiledPrompt:
+        return self._compiled
+
+    @property
+    def context(self) -> str:
+        return self._context
+
+    @property
+    def text_style(self) -> str:
+        return self._text_style
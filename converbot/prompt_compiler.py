@@ -0,0 +1,176 @@
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+PROMPT_SECTIONS = ("instructions", "persona", "style", "memory", "retrieval")
+
+
+class PromptPart(NamedTuple):
+    """
+    A piece of the prompt text.
+
+    Args:
+        section: The section the part belongs to, one of PROMPT_SECTIONS.
+        text: The text of the part.
+        fixed: Whether the part is kept whole when its section is over budget.
+    """
+
+    section: str
+    text: str
+    fixed: bool = False
+
+
+@dataclass
+class CompiledPrompt:
+    """
+    The prompt text and how it was built.
+
+    Args:
+        text: The prompt text.
+        section_tokens: The number of tokens of every section, empty without a token counter.
+        truncated_sections: The sections that were cut down to their budget.
+        removed_paragraphs: The number of repeated paragraphs that were removed.
+    """
+
+    text: str
+    section_tokens: Dict[str, int] = field(default_factory=dict)
+    truncated_sections: List[str] = field(default_factory=list)
+    removed_paragraphs: int = 0
+
+
+def _paragraph_key(paragraph: str) -> str:
+    return " ".join(paragraph.split()).lower()
+
+
+class PromptCompiler:
+    """
+    Assemble a prompt from its parts, without repeated paragraphs and within a token budget per section.
+
+    Parts are joined with a blank line. A paragraph, a block separated by blank lines, that
+    already appeared earlier in the prompt is removed, whitespace and case aside. Then every
+    section over its budget loses its end: the last lines of its non fixed parts are dropped,
+    the last one kept may be cut between words.
+
+    The "memory" and "retrieval" budgets are not applied here, the conversation memory and the
+    retrieved past turns are not part of the compiled text, see ``memory_budget`` and ``retrieval_budget``.
+
+    Args:
+        count_tokens: The token counting function, budgets are not enforced nor counts reported without it.
+        budgets: The maximum number of tokens of every section, unlimited for a missing section.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Optional[Callable[[str], int]] = None,
+        budgets: Optional[Dict[str, Optional[int]]] = None,
+    ) -> None:
+        budgets = dict(budgets or {})
+        unknown = set(budgets) - set(PROMPT_SECTIONS)
+        if unknown:
+            raise ValueError(f"Unknown prompt sections: {sorted(unknown)}, expected some of {PROMPT_SECTIONS}")
+        self._count_tokens = count_tokens
+        self._budgets = budgets
+
+    @property
+    def memory_budget(self) -> Optional[int]:
+        """
+        The maximum number of tokens of the conversation buffer, None for the configured default.
+        """
+        return self._budgets.get("memory")
+
+    @property
+    def retrieval_budget(self) -> Optional[int]:
+        """
+        The maximum number of tokens of the past turns retrieved for a turn, None for no limit.
+        """
+        return self._budgets.get("retrieval")
+
+    def compile(self, parts: List[PromptPart]) -> CompiledPrompt:
+        """
+        Compile the prompt.
+
+        Args:
+            parts: The parts of the prompt, in order.
+
+        Returns: The compiled prompt.
+        """
+        parts, removed_paragraphs = self._dedupe(parts)
+        truncated_sections = []
+        if self._count_tokens is not None:
+            for section in PROMPT_SECTIONS:
+                budget = self._budgets.get(section)
+                if budget is not None and self._section_tokens(parts, section) > budget:
+                    parts = self._fit_section(parts, section, budget)
+                    truncated_sections.append(section)
+
+        return CompiledPrompt(
+            text="\n\n".join(part.text for part in parts),
+            section_tokens={
+                section: self._section_tokens(parts, section)
+                for section in PROMPT_SECTIONS
+                if self._count_tokens is not None and any(part.section == section for part in parts)
+            },
+            truncated_sections=truncated_sections,
+            removed_paragraphs=removed_paragraphs,
+        )
+
+    @staticmethod
+    def _dedupe(parts: List[PromptPart]) -> Tuple[List[PromptPart], int]:
+        seen: Set[str] = set()
+        deduped = []
+        removed = 0
+        for part in parts:
+            paragraphs = []
+            for paragraph in part.text.split("\n\n"):
+                key = _paragraph_key(paragraph)
+                if key and key in seen:
+                    removed += 1
+                    continue
+                seen.add(key)
+                paragraphs.append(paragraph)
+            if paragraphs:
+                deduped.append(part._replace(text="\n\n".join(paragraphs)))
+        return deduped, removed
+
+    def _section_tokens(self, parts: List[PromptPart], section: str) -> int:
+        return sum(self._count_tokens(part.text) for part in parts if part.section == section)
+
+    def _fit_section(self, parts: List[PromptPart], section: str, budget: int) -> List[PromptPart]:
+        # The fixed parts are always kept, the others share what they leave in order
+        remaining = budget - sum(
+            self._count_tokens(part.text) for part in parts if part.section == section and part.fixed
+        )
+        fitted = []
+        for part in parts:
+            if part.section != section or part.fixed:
+                fitted.append(part)
+                continue
+            text = self._fit(part.text, max(remaining, 0))
+            if text:
+                fitted.append(part._replace(text=text))
+                remaining -= self._count_tokens(text)
+        return fitted
+
+    def _fit(self, text: str, budget: int) -> str:
+        """
+        Get the longest beginning of the text within the budget, cut after a line or else between words.
+        """
+        if self._count_tokens(text) <= budget:
+            return text
+        kept: List[str] = []
+        for line in text.split("\n"):
+            if self._count_tokens("\n".join(kept + [line])) <= budget:
+                kept.append(line)
+                continue
+            # Binary search of the number of words of the line that still fit
+            words = line.split(" ")
+            low, high = 0, len(words)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if self._count_tokens("\n".join(kept + [" ".join(words[:middle])])) <= budget:
+                    low = middle
+                else:
+                    high = middle - 1
+            if low:
+                kept.append(" ".join(words[:low]))
+            break
+        return "\n".join(kept).rstrip()
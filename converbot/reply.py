@@ -0,0 +1,227 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import MessageNotModified, RetryAfter, TelegramAPIError
+
+from converbot.metrics import observe_stage
+
+
+class ProgressiveReply:
+    """
+    Telegram reply shown while it is generated.
+
+    Tokens are collected as they arrive. The message is sent once ``min_chars`` characters can
+    be shown and edited at most every ``edit_interval`` seconds after that. The typing action
+    is repeated while the model is still generating. The reveal is paced like a human typing
+    at ``seconds_per_char``, counted from the start of the turn so the pacing overlaps with the
+    generation, and capped to ``max_delay`` seconds for the whole reply.
+
+    With a language model that does not stream, the whole reply arrives at ``finish`` and is
+    revealed in the remaining typing budget, if any. When a streamed completion is retried,
+    ``restart`` drops the tokens of the failed attempt and the message is edited to the new one.
+    An empty reply is replaced by ``empty_reply``, so the user always gets an answer.
+
+    A failed edit or typing action does not fail the reply: under flood control the edits wait
+    for the ``RetryAfter`` delay, and other errors are printed and the edit is skipped. When the
+    generation fails, ``fail`` turns the partial message into the error text.
+
+    Args:
+        bot: The bot sending the reply.
+        chat_id: The chat to reply in.
+        seconds_per_char: The simulated typing time per character.
+        max_delay: The maximum simulated typing time of a reply, in seconds.
+        edit_interval: The minimum number of seconds between two edits of the message.
+        typing_interval: The number of seconds between two typing actions.
+        min_chars: The number of characters shown by the first message.
+        empty_reply: The text sent when the reply is empty.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        chat_id: int,
+        seconds_per_char: float = 0.07,
+        max_delay: float = 10.0,
+        edit_interval: float = 1.5,
+        typing_interval: float = 4.0,
+        min_chars: int = 20,
+        empty_reply: str = "Sorry, I lost my train of thought. What were you saying?",
+    ) -> None:
+        self._bot = bot
+        self._chat_id = chat_id
+        self._seconds_per_char = seconds_per_char
+        self._max_delay = max_delay
+        self._edit_interval = edit_interval
+        self._typing_interval = typing_interval
+        self._min_chars = min_chars
+        self._empty_reply = empty_reply
+
+        self._text = ""
+        self._done = False
+        self._progress = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._started_at = 0.0
+        self._message: Optional[types.Message] = None
+        self._shown = ""
+        # No edit before this time, counted like _elapsed, while Telegram asks to retry later
+        self._edits_blocked_until = 0.0
+
+        self.edits = 0
+        self.failed_edits = 0
+        self.typing_actions = 0
+        self.first_shown_after: Optional[float] = None
+
+    def start(self) -> None:
+        """
+        Start showing the reply, call it when the generation starts.
+        """
+        self._started_at = asyncio.get_running_loop().time()
+        self._task = asyncio.ensure_future(self._run())
+
+    def add_token(self, token: str) -> None:
+        self._text += token
+        self._progress.set()
+
+    def restart(self) -> None:
+        """
+        Drop the streamed tokens, call it before a retried completion streams again from the start.
+        """
+        self._text = ""
+        self._progress.set()
+
+    async def finish(self, text: str) -> None:
+        """
+        Show the complete reply and wait until it has been revealed.
+
+        Args:
+            text: The complete reply, which replaces the streamed tokens, ``empty_reply`` if it is blank.
+        """
+        self._text = text if text.strip() else self._empty_reply
+        self._done = True
+        self._progress.set()
+        await self._task
+
+    async def cancel(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def fail(self, text: str) -> None:
+        """
+        Stop showing the reply and show the error text instead, in place of the partial message if one is shown.
+
+        Args:
+            text: The error text.
+        """
+        await self.cancel()
+        if self._message is not None:
+            try:
+                await self._bot.edit_message_text(text, chat_id=self._chat_id, message_id=self._message.message_id)
+                return
+            except TelegramAPIError as e:
+                print(e)
+        await self._bot.send_message(self._chat_id, text=text)
+
+    async def _edit(self, text: str) -> bool:
+        """
+        Edit the message to the text.
+
+        Returns: Whether the message shows the text, False if the edit must wait for the flood control.
+        """
+        try:
+            await self._bot.edit_message_text(text, chat_id=self._chat_id, message_id=self._message.message_id)
+            self.edits += 1
+        except MessageNotModified:
+            pass
+        except RetryAfter as e:
+            self.failed_edits += 1
+            self._edits_blocked_until = self._elapsed() + e.timeout
+            return False
+        except TelegramAPIError as e:
+            # Skipped, the next edit shows the text
+            print(e)
+            self.failed_edits += 1
+        return True
+
+    async def _send_typing(self) -> None:
+        try:
+            await self._bot.send_chat_action(self._chat_id, action=types.ChatActions.TYPING)
+            self.typing_actions += 1
+        except TelegramAPIError as e:
+            print(e)
+
+    def _elapsed(self) -> float:
+        return asyncio.get_running_loop().time() - self._started_at
+
+    def _visible_text(self) -> str:
+        seconds_per_char = self._seconds_per_char
+        if self._done and self._text:
+            seconds_per_char = min(seconds_per_char, self._max_delay / len(self._text))
+        visible_chars = len(self._text) if seconds_per_char <= 0 else int(self._elapsed() / seconds_per_char)
+        return self._text[:visible_chars].rstrip()
+
+    async def _run(self) -> None:
+        last_typing = None
+        last_edit = None
+        while True:
+            self._progress.clear()
+            visible = self._visible_text()
+            complete = self._done and visible == self._text.rstrip()
+            now = self._elapsed()
+            can_show = complete or len(visible) >= self._min_chars
+            if visible and visible != self._shown and can_show:
+                if self._message is None:
+                    self._message = await self._bot.send_message(self._chat_id, text=visible)
+                    self.first_shown_after = self._elapsed()
+                    self._shown, last_edit = visible, now
+                elif (complete or now - last_edit >= self._edit_interval) and now >= self._edits_blocked_until:
+                    if await self._edit(visible):
+                        self._shown, last_edit = visible, now
+            if complete and self._shown == visible:
+                return
+            if not self._done and (last_typing is None or now - last_typing >= self._typing_interval):
+                await self._send_typing()
+                last_typing = now
+
+            # Wake up for the next token, the next edit slot or the next revealed characters
+            try:
+                await asyncio.wait_for(self._progress.wait(), timeout=self._next_wakeup(last_edit))
+            except asyncio.TimeoutError:
+                pass
+
+    def _next_wakeup(self, last_edit: Optional[float]) -> float:
+        if last_edit is None:
+            wakeup = self._seconds_per_char
+        else:
+            wakeup = self._edit_interval - (self._elapsed() - last_edit)
+        if self._done:
+            # The complete reply is shown without waiting for the next edit slot
+            fully_visible_at = min(len(self._text) * self._seconds_per_char, self._max_delay)
+            wakeup = min(wakeup, fully_visible_at - self._elapsed())
+        return max(wakeup, self._edits_blocked_until - self._elapsed(), 0.05)
+
+    @property
+    def stats(self) -> Dict[str, Optional[float]]:
+        return {
+            "edits": self.edits,
+            "failed_edits": self.failed_edits,
+            "typing_actions": self.typing_actions,
+            "first_shown_after": self.first_shown_after,
+        }
+
+
+class TimedBot(Bot):
+    """
+    Bot timing the requests sending or editing messages as the "telegram_send" stage.
+    """
+
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None, **kwargs):
+        if not method.startswith(("send", "edit")):
+            return await super().request(method, data, files, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        finally:
+            observe_stage("telegram_send", time.perf_counter() - start)
@@ -0,0 +1,237 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar, Union
+
+import aiohttp
+import openai.error
+
+from converbot.admission import AdmissionController
+
+T = TypeVar("T")
+
+_RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the language model while the provider is considered degraded.
+    """
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Whether a failed language model call may succeed if it is sent again.
+
+    Args:
+        error: The error of the call.
+
+    Returns: True for rate limits, server errors, timeouts and connection errors.
+    """
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return isinstance(error, _RETRYABLE_ERRORS)
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Get the number of seconds the provider asked to wait before a retry.
+
+    Args:
+        error: The error of the call.
+
+    Returns: The number of seconds, None if the provider did not say.
+    """
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After") or headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Process-wide breaker that stops calling a degraded provider.
+
+    After ``failure_threshold`` consecutive failed calls the breaker opens and every call fails
+    fast for ``reset_timeout`` seconds. Then a single probe call is let through: the breaker
+    closes if it succeeds and opens again if it fails. A probe cancelled before its outcome, e.g.
+    by a discarded draft, lets the next call probe instead.
+
+    Args:
+        failure_threshold: The number of consecutive failures that opens the breaker.
+        reset_timeout: The number of seconds the breaker stays open before a probe.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened_at >= self._reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self) -> bool:
+        """
+        Check that a call may be sent.
+
+        Returns: Whether the call is the probe of the half open breaker, see ``release_probe``.
+
+        Raises:
+            CircuitOpenError: If the breaker is open, or half open with a probe in flight.
+        """
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        self.rejected += 1
+        raise CircuitOpenError("The language model provider is degraded")
+
+    def release_probe(self) -> None:
+        """
+        Give up the probe without an outcome, e.g. when it is cancelled, so the next call probes instead.
+        """
+        self._probing = False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._probing or self._failures >= self._failure_threshold:
+            if self._opened_at is None:
+                self.opened += 1
+            self._opened_at = time.monotonic()
+            self._probing = False
+
+    @property
+    def stats(self) -> Dict[str, Union[str, int]]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+
+class RetryPolicy:
+    """
+    Retry of idempotent language model calls with exponential backoff and full jitter.
+
+    Only retryable errors are retried, see ``is_retryable``. A ``Retry-After`` sent by the
+    provider is waited at least. Every attempt goes through the circuit breaker, so while the
+    provider is degraded calls fail fast with ``CircuitOpenError``. With an admission
+    controller, every attempt first waits for its turn within the provider budgets.
+
+    Args:
+        max_attempts: The maximum number of attempts of a call.
+        base_delay: The maximum delay before the first retry, doubled for every next one.
+        max_delay: The maximum delay before a retry.
+        breaker: The circuit breaker, none if not provided.
+        admission: The admission controller, calls are sent at once if not provided.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 20.0,
+        breaker: Optional[CircuitBreaker] = None,
+        admission: Optional[AdmissionController] = None,
+    ) -> None:
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._breaker = breaker
+        self._admission = admission
+
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    @property
+    def breaker(self) -> Optional[CircuitBreaker]:
+        return self._breaker
+
+    @property
+    def admission(self) -> Optional[AdmissionController]:
+        return self._admission
+
+    def _delay(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self._max_delay, self._base_delay * 2 ** attempt))
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self._max_delay))
+        return delay
+
+    async def call(self, make_call: Callable[[], Awaitable[T]], tokens: int = 0) -> T:
+        """
+        Run a call, retrying it on retryable errors.
+
+        Args:
+            make_call: The function starting the call, called once per attempt.
+            tokens: The estimated number of tokens of the call, charged to the token budget.
+
+        Returns: The result of the call.
+        """
+        self.calls += 1
+        for attempt in range(self._max_attempts):
+            if self._admission is not None:
+                await self._admission.acquire(tokens)
+            probe = self._breaker is not None and self._breaker.before_call()
+            try:
+                result = await make_call()
+            except asyncio.CancelledError:
+                # Neither a success nor a failure, the probe slot must not stay taken
+                if probe:
+                    self._breaker.release_probe()
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    # The provider answered, it is not degraded
+                    if self._breaker is not None:
+                        self._breaker.record_success()
+                    raise
+                if self._breaker is not None:
+                    self._breaker.record_failure()
+                if attempt == self._max_attempts - 1:
+                    self.failures += 1
+                    raise
+                print(f"Retrying the language model call after: {e}")
+                self.retries += 1
+                await asyncio.sleep(self._delay(attempt, e))
+            else:
+                if self._breaker is not None:
+                    self._breaker.record_success()
+                return result
+
+    @property
+    def stats(self) -> Dict[str, Union[str, int]]:
+        stats = {"calls": self.calls, "retries": self.retries, "failures": self.failures}
+        if self._breaker is not None:
+            stats.update({f"breaker_{key}": value for key, value in self._breaker.stats.items()})
+        if self._admission is not None:
+            stats.update({f"admission_{key}": value for key, value in self._admission.stats.items()})
+        return stats
@@ -0,0 +1,291 @@
+import asyncio
+import csv
+import math
+import re
+import time
+import zlib
+from array import array
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from converbot.constants import (
+    CHATBOT_RESPONSE,
+    HISTORY_SAVE_DIR,
+    MAX_RETRIEVAL_INDEXES,
+    NO_CHATBOT_RESPONSE,
+    USER_MESSAGE,
+)
+from converbot.history import ChatHistoryWriter
+
+HASHED_FEATURES = 2 ** 20
+WORD_PATTERN = re.compile(r"\w+")
+
+
+@lru_cache(maxsize=100000)
+def _word_feature(word: str) -> int:
+    # crc32 is stable across processes, unlike hash()
+    return zlib.crc32(word.encode("utf-8")) % HASHED_FEATURES
+
+
+def hashed_features(text: str) -> Dict[int, float]:
+    """
+    Embed a text as a sparse vector of hashed word features.
+
+    Args:
+        text: The text.
+
+    Returns: The weight of every feature of the text: its sublinear term frequency, L2-normalized.
+    """
+    counts = Counter(map(_word_feature, WORD_PATTERN.findall(text.casefold())))
+    weights = {feature: 1.0 + math.log(count) for feature, count in counts.items()}
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    return {feature: weight / norm for feature, weight in weights.items()}
+
+
+class RetrievedTurn(NamedTuple):
+    """
+    A past turn of the conversation found relevant to the user input.
+
+    Args:
+        position: The position of the turn in the conversation, from 0 for the first one.
+        score: The relevance of the turn.
+        user_message: The message of the user.
+        chatbot_response: The response of the chatbot.
+    """
+
+    position: int
+    score: float
+    user_message: str
+    chatbot_response: str
+
+
+class RetrievalIndex:
+    """
+    Incremental TF-IDF index of the turns of a conversation, searched with NumPy.
+
+    Every turn is embedded with ``hashed_features`` and added to the postings of its features,
+    an append-only array of turn positions and weights per feature, so adding a turn never
+    touches the others. The inverse document frequencies are computed from the posting lengths
+    at search time, they are always up to date without re-weighting the index.
+    """
+
+    def __init__(self) -> None:
+        self._turns: List[Tuple[str, str]] = []
+        self._postings: Dict[int, Tuple[array, array]] = {}
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def add(self, user_message: str, chatbot_response: str) -> None:
+        """
+        Add a turn at the end of the conversation.
+
+        Args:
+            user_message: The message of the user.
+            chatbot_response: The response of the chatbot.
+        """
+        position = len(self._turns)
+        self._turns.append((user_message, chatbot_response))
+        for feature, weight in hashed_features(user_message + "\n" + chatbot_response).items():
+            postings = self._postings.get(feature)
+            if postings is None:
+                postings = self._postings[feature] = (array("i"), array("f"))
+            postings[0].append(position)
+            postings[1].append(weight)
+
+    def clear(self) -> None:
+        self._turns = []
+        self._postings = {}
+
+    def search(self, query: str, top_k: int, exclude_last: int = 0) -> List[RetrievedTurn]:
+        """
+        Find the turns most relevant to the query.
+
+        Args:
+            query: The text to search for, e.g. the user input.
+            top_k: The maximum number of turns returned.
+            exclude_last: The number of most recent turns left out, e.g. the ones still in the memory buffer.
+
+        Returns: The turns sharing words with the query, the most relevant first.
+        """
+        searched = len(self._turns) - exclude_last
+        if top_k <= 0 or searched <= 0:
+            return []
+        # Imported on the first search, building the index does not need it
+        import numpy as np
+
+        scores = np.zeros(len(self._turns), dtype=np.float32)
+        for feature, query_weight in hashed_features(query).items():
+            postings = self._postings.get(feature)
+            if postings is None:
+                continue
+            # Views of the postings, dropped before the next add since an exported array cannot grow
+            positions = np.frombuffer(postings[0], dtype=np.int32)
+            weights = np.frombuffer(postings[1], dtype=np.float32)
+            idf = math.log((1 + len(self._turns)) / (1 + len(positions))) + 1.0
+            # A turn appears at most once in the postings of a feature
+            scores[positions] += weights * np.float32(query_weight * idf)
+        scores = scores[:searched]
+
+        top_k = min(top_k, searched)
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [
+            RetrievedTurn(int(position), float(scores[position]), *self._turns[position])
+            for position in best
+            if scores[position] > 0
+        ]
+
+
+def read_history(history_file: Path) -> List[Tuple[str, str]]:
+    """
+    Read the turns of a chat history csv file, from the start of the current conversation.
+
+    Args:
+        history_file: The chat history file of the user.
+
+    Returns: The user messages and chatbot responses.
+    """
+    turns: List[Tuple[str, str]] = []
+    if not history_file.exists():
+        return turns
+    with history_file.open(encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            if row[CHATBOT_RESPONSE] == NO_CHATBOT_RESPONSE:
+                # The end of an onboarding, the turns before it were with another persona
+                turns = []
+                continue
+            turns.append((row[USER_MESSAGE], row[CHATBOT_RESPONSE]))
+    return turns
+
+
+class RetrievalStore:
+    """
+    The retrieval indexes of the conversations, loaded from the chat history on first use.
+
+    An index is built from the chat history file of its user the first time it is searched,
+    in a worker thread, and then kept up to date with ``add`` on every turn. Only the
+    ``max_indexes`` most recently searched indexes are kept, the others are rebuilt when needed.
+
+    Args:
+        history_dir: The directory of the chat history files.
+        history_writer: The writer of the chat history files, flushed before an index is built from them.
+        max_indexes: The maximum number of indexes kept in memory.
+    """
+
+    def __init__(
+        self,
+        history_dir: Path = HISTORY_SAVE_DIR,
+        history_writer: Optional[ChatHistoryWriter] = None,
+        max_indexes: int = MAX_RETRIEVAL_INDEXES,
+    ) -> None:
+        self._history_dir = history_dir
+        self._history_writer = history_writer
+        self._max_indexes = max_indexes
+        # Ordered from the least to the most recently searched
+        self._indexes: "OrderedDict[str, RetrievalIndex]" = OrderedDict()
+        self._loads: Dict[str, asyncio.Future] = {}
+        # The turns added while the index of their user is being loaded
+        self._added_while_loading: Dict[str, List[Tuple[str, str]]] = {}
+
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.searches = 0
+        self.search_seconds = 0.0
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        return {
+            "indexes": len(self._indexes),
+            "indexed_turns": sum(len(index) for index in self._indexes.values()),
+            "loads": self.loads,
+            "load_seconds": self.load_seconds,
+            "searches": self.searches,
+            "mean_search_seconds": self.search_seconds / self.searches if self.searches else 0.0,
+        }
+
+    def add(self, user_id: int, user_message: str, chatbot_response: str) -> None:
+        """
+        Index a new turn of the user, if the index of the user is loaded.
+
+        Args:
+            user_id: The user ID.
+            user_message: The message of the user.
+            chatbot_response: The response of the chatbot, NO_CHATBOT_RESPONSE starts a new conversation.
+        """
+        user_id = str(user_id)
+        if user_id in self._added_while_loading:
+            self._added_while_loading[user_id].append((user_message, chatbot_response))
+            return
+        index = self._indexes.get(user_id)
+        if index is None:
+            return
+        if chatbot_response == NO_CHATBOT_RESPONSE:
+            index.clear()
+        else:
+            index.add(user_message, chatbot_response)
+
+    def discard(self, user_id: int) -> None:
+        """
+        Drop the index of the user from memory, e.g. when the conversation is removed.
+
+        Args:
+            user_id: The user ID.
+        """
+        self._indexes.pop(str(user_id), None)
+
+    async def asearch(self, user_id: int, query: str, top_k: int, exclude_last: int = 0) -> List[RetrievedTurn]:
+        """
+        Find the past turns of the user most relevant to the query, loading the index if needed.
+
+        Args:
+            user_id: The user ID.
+            query: The text to search for, e.g. the user input.
+            top_k: The maximum number of turns returned.
+            exclude_last: The number of most recent turns left out, e.g. the ones still in the memory buffer.
+
+        Returns: The turns sharing words with the query, the most relevant first.
+        """
+        user_id = str(user_id)
+        index = self._indexes.get(user_id)
+        if index is None:
+            load = self._loads.get(user_id)
+            if load is None:
+                load = self._loads[user_id] = asyncio.ensure_future(self._load(user_id))
+                load.add_done_callback(lambda _: self._loads.pop(user_id, None))
+            index = await asyncio.shield(load)
+        else:
+            self._indexes.move_to_end(user_id)
+
+        start = time.perf_counter()
+        turns = index.search(query, top_k, exclude_last)
+        self.searches += 1
+        self.search_seconds += time.perf_counter() - start
+        return turns
+
+    async def _load(self, user_id: str) -> RetrievalIndex:
+        start = time.perf_counter()
+        self._added_while_loading[user_id] = []
+        try:
+            if self._history_writer is not None:
+                # The queued turns of the user must be in the file before it is read
+                await self._history_writer.flush()
+            index = await asyncio.get_running_loop().run_in_executor(None, self._build, user_id)
+        finally:
+            added = self._added_while_loading.pop(user_id)
+        self._indexes[user_id] = index
+        for user_message, chatbot_response in added:
+            self.add(user_id, user_message, chatbot_response)
+        while len(self._indexes) > self._max_indexes:
+            self._indexes.popitem(last=False)
+        self.loads += 1
+        self.load_seconds += time.perf_counter() - start
+        return index
+
+    def _build(self, user_id: str) -> RetrievalIndex:
+        index = RetrievalIndex()
+        for user_message, chatbot_response in read_history(self._history_dir / f"{user_id}.csv"):
+            index.add(user_message, chatbot_response)
+        return index
@@ -0,0 +1,351 @@
+import asyncio
+import functools
+import json
+import signal
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from aiogram import Bot, Dispatcher, types
+
+DispatcherHook = Optional[Callable[[Dispatcher], Awaitable[None]]]
+
+
+def get_update_user_id(update: Dict[str, Any]) -> int:
+    """
+    Get the ID of the user who sent a raw Telegram update.
+
+    Args:
+        update: The update as received from the Bot API.
+
+    Returns: The user ID, 0 for updates without a user.
+    """
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user is not None:
+            return int(user["id"])
+    return 0
+
+
+def shard_for(user_id: int, num_shards: int) -> int:
+    """
+    Get the shard owning the conversations of a user.
+
+    Args:
+        user_id: The user ID.
+        num_shards: The number of shards.
+
+    Returns: The index of the shard.
+    """
+    return hash(int(user_id)) % num_shards
+
+
+class ShardUnavailableError(Exception):
+    """
+    Raised for the updates of a shard whose worker closed its connection before handling them.
+    """
+
+
+class _PendingUpdate:
+    def __init__(self, future: asyncio.Future, line: bytes) -> None:
+        self.future = future
+        self.line = line
+        self.deliveries = 1
+
+
+class ShardRouter:
+    """
+    Front of the sharded mode, forwarding every update to the worker process owning its user.
+
+    Workers listen on local Unix sockets. Updates are sent as newline-delimited json and every
+    worker answers with the ID of each update once it has been handled.
+
+    Every routed update is pending until its worker acknowledges it. When the connection of a
+    worker closes, ``on_shard_lost`` is called, e.g. to restart the worker, the router reconnects
+    and sends the pending updates again, before the updates routed meanwhile. An update is sent
+    at most ``max_redeliveries`` more times, so an update crashing its worker is not retried
+    forever; it then fails with ShardUnavailableError, as do the pending updates of a worker
+    the router cannot reconnect to. An update not acknowledged within ``ack_timeout`` seconds
+    fails with asyncio.TimeoutError. Failed updates are printed and counted as lost.
+
+    The delivery to the workers is at least once: an update handled by a worker that closed its
+    connection before acknowledging it is handled again. ``poll`` confirms the updates to Telegram
+    once they are routed, so the updates still pending when the router itself stops are lost.
+
+    Args:
+        socket_paths: The sockets of the workers, the index of a socket is the index of its shard.
+        ack_timeout: The maximum number of seconds to wait for the acknowledgement of an update, None to wait forever.
+        on_shard_lost: Called with the index of a shard whose connection closed, before reconnecting to it.
+        max_redeliveries: The maximum number of times an update is sent again after its worker closed its connection.
+    """
+
+    def __init__(
+        self,
+        socket_paths: List[Path],
+        ack_timeout: Optional[float] = 600.0,
+        on_shard_lost: Optional[Callable[[int], Awaitable[None]]] = None,
+        max_redeliveries: int = 1,
+    ) -> None:
+        self._socket_paths = socket_paths
+        self._ack_timeout = ack_timeout
+        self._on_shard_lost = on_shard_lost
+        self._max_redeliveries = max_redeliveries
+        self._connect_timeout = 30.0
+        self._writers: List[Optional[asyncio.StreamWriter]] = [None] * len(socket_paths)
+        self._readers: List[Optional[asyncio.Task]] = [None] * len(socket_paths)
+        self._reconnects: List[Optional[asyncio.Task]] = [None] * len(socket_paths)
+        # The updates not acknowledged yet per shard, by update ID
+        self._pending: List[Dict[int, _PendingUpdate]] = [{} for _ in socket_paths]
+        # The updates routed to a shard while it is disconnected
+        self._backlog: List[List[bytes]] = [[] for _ in socket_paths]
+        self._closing = False
+
+        self.routed = [0] * len(socket_paths)
+        self.handled = [0] * len(socket_paths)
+        self.lost = [0] * len(socket_paths)
+        self.redelivered = [0] * len(socket_paths)
+        self.reconnects = [0] * len(socket_paths)
+
+    @property
+    def num_shards(self) -> int:
+        return len(self._socket_paths)
+
+    async def connect(self, timeout: float = 30.0) -> None:
+        """
+        Connect to every worker, waiting for them to listen.
+
+        Args:
+            timeout: The maximum number of seconds to wait for a worker, also when reconnecting.
+        """
+        self._connect_timeout = timeout
+        for shard in range(self.num_shards):
+            await self._connect_shard(shard)
+
+    async def _connect_shard(self, shard: int) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._connect_timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(str(self._socket_paths[shard]))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self._writers[shard] = writer
+        self._readers[shard] = asyncio.ensure_future(self._read_acks(shard, reader))
+        for line in self._backlog[shard]:
+            writer.write(line)
+        self._backlog[shard] = []
+
+    async def _read_acks(self, shard: int, reader: asyncio.StreamReader) -> None:
+        try:
+            async for line in reader:
+                self.handled[shard] += 1
+                pending = self._pending[shard].pop(json.loads(line)["update_id"], None)
+                if pending is not None and not pending.future.done():
+                    pending.future.set_result(None)
+        except ConnectionError as e:
+            print(e)
+        self._shard_lost(shard)
+
+    def _shard_lost(self, shard: int) -> None:
+        self._writers[shard].close()
+        self._writers[shard] = None
+        print(f"Lost the connection to shard {shard}, {len(self._pending[shard])} updates in flight")
+        if self._closing:
+            self._fail_pending(shard, ShardUnavailableError(f"Shard {shard} closed its connection before handling the update"))
+            return
+        self._redeliver_pending(shard)
+        self._reconnects[shard] = asyncio.ensure_future(self._reconnect(shard))
+
+    def _redeliver_pending(self, shard: int) -> None:
+        lines = []
+        # In routing order, the pending updates were sent before the backlog
+        for update_id, pending in list(self._pending[shard].items()):
+            if pending.deliveries > self._max_redeliveries:
+                del self._pending[shard][update_id]
+                if not pending.future.done():
+                    pending.future.set_exception(ShardUnavailableError(
+                        f"Shard {shard} closed its connection before handling update {update_id} "
+                        f"{pending.deliveries} times"
+                    ))
+                continue
+            pending.deliveries += 1
+            self.redelivered[shard] += 1
+            lines.append(pending.line)
+        self._backlog[shard][:0] = lines
+
+    async def _reconnect(self, shard: int) -> None:
+        try:
+            if self._on_shard_lost is not None:
+                await self._on_shard_lost(shard)
+            await self._connect_shard(shard)
+            self.reconnects[shard] += 1
+        except Exception as e:
+            # The next update routed to the shard tries again
+            print(e)
+            self._backlog[shard] = []
+            self._fail_pending(shard, ShardUnavailableError(f"Shard {shard} is unavailable: {e}"))
+
+    def _fail_pending(self, shard: int, error: Exception) -> None:
+        pending, self._pending[shard] = self._pending[shard], {}
+        for update in pending.values():
+            if not update.future.done():
+                update.future.set_exception(error)
+
+    def _expire(self, shard: int, update_id: int) -> None:
+        pending = self._pending[shard].pop(update_id, None)
+        if pending is not None and not pending.future.done():
+            pending.future.set_exception(asyncio.TimeoutError(f"Shard {shard} did not handle update {update_id} in time"))
+
+    def _settle(self, shard: int, update_id: int, future: asyncio.Future) -> None:
+        # Also retrieves the exception of the futures nobody awaits, e.g. the ones of poll
+        pending = self._pending[shard].get(update_id)
+        if pending is not None and pending.future is future:
+            del self._pending[shard][update_id]
+        if not future.cancelled() and future.exception() is not None:
+            self.lost[shard] += 1
+            if not isinstance(future.exception(), ShardUnavailableError):
+                # The updates of a lost shard are reported at once
+                print(future.exception())
+
+    def route(self, update: Dict[str, Any]) -> asyncio.Future:
+        """
+        Send an update to the shard owning its user.
+
+        Args:
+            update: The update as received from the Bot API.
+
+        Returns: A future done once the worker has handled the update, failed if the update is lost.
+        """
+        shard = shard_for(get_update_user_id(update), self.num_shards)
+        update_id = update["update_id"]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(functools.partial(self._settle, shard, update_id))
+        if self._ack_timeout is not None:
+            timer = loop.call_later(self._ack_timeout, self._expire, shard, update_id)
+            future.add_done_callback(lambda _: timer.cancel())
+        line = json.dumps(update).encode("utf-8") + b"\n"
+        self._pending[shard][update_id] = _PendingUpdate(future, line)
+        writer = self._writers[shard]
+        if writer is not None:
+            writer.write(line)
+        else:
+            self._backlog[shard].append(line)
+            reconnect = self._reconnects[shard]
+            if not self._closing and (reconnect is None or reconnect.done()):
+                self._reconnects[shard] = asyncio.ensure_future(self._reconnect(shard))
+        self.routed[shard] += 1
+        return future
+
+    async def poll(self, bot: Bot, timeout: int = 20) -> None:
+        """
+        Receive the updates with long polling and route them until cancelled.
+
+        The updates are confirmed to Telegram by the next request once routed, the router keeps
+        them until their worker has handled them.
+
+        Args:
+            bot: The bot receiving the updates.
+            timeout: The long polling timeout in seconds.
+        """
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=timeout)
+            except Exception as e:
+                print(e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self.route(update.to_python())
+            # A lost connection is handled by the reader of its acknowledgements
+            await asyncio.gather(
+                *(writer.drain() for writer in self._writers if writer is not None), return_exceptions=True
+            )
+
+    async def close(self, timeout: float = 30.0) -> None:
+        """
+        Wait for the workers to handle the updates in flight, then close the connections.
+
+        Args:
+            timeout: The maximum number of seconds to wait for the updates in flight.
+        """
+        self._closing = True
+        in_flight = [update.future for pending in self._pending for update in pending.values()]
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=timeout)
+        for task in self._reconnects + self._readers:
+            if task is not None:
+                task.cancel()
+        for shard, writer in enumerate(self._writers):
+            if writer is not None:
+                writer.close()
+            self._fail_pending(shard, ShardUnavailableError(f"Shard {shard} did not handle the update before the shutdown"))
+
+    @property
+    def stats(self) -> Dict[str, List[int]]:
+        return {
+            "routed": list(self.routed),
+            "in_flight": [len(pending) for pending in self._pending],
+            "lost": list(self.lost),
+            "redelivered": list(self.redelivered),
+            "reconnects": list(self.reconnects),
+        }
+
+
+async def serve_shard(
+    dispatcher: Dispatcher,
+    socket_path: Path,
+    on_startup: DispatcherHook = None,
+    on_shutdown: DispatcherHook = None,
+) -> None:
+    """
+    Handle the updates routed to this shard until SIGTERM or SIGINT.
+
+    Args:
+        dispatcher: The dispatcher handling the updates, with the conversations of the shard.
+        socket_path: The Unix socket to listen on.
+        on_startup: Called with the dispatcher before the first update.
+        on_shutdown: Called with the dispatcher after the last update.
+    """
+    Bot.set_current(dispatcher.bot)
+    Dispatcher.set_current(dispatcher)
+    if on_startup is not None:
+        await on_startup(dispatcher)
+
+    async def handle_update(line: bytes, writer: asyncio.StreamWriter) -> None:
+        update = json.loads(line)
+        try:
+            await dispatcher.process_update(types.Update(**update))
+        except Exception as e:
+            print(e)
+        writer.write(json.dumps({"update_id": update["update_id"]}).encode("utf-8") + b"\n")
+
+    in_flight: Set[asyncio.Task] = set()
+
+    async def handle_router(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # Every update runs in its own task, the state filters of aiogram are bound to the task
+        async for line in reader:
+            task = asyncio.ensure_future(handle_update(line, writer))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    socket_path.unlink(missing_ok=True)
+    server = await asyncio.start_unix_server(handle_router, str(socket_path))
+    async with server:
+        await stop.wait()
+    # The updates already received are handled and acknowledged before the shutdown
+    if in_flight:
+        await asyncio.wait(set(in_flight))
+    if on_shutdown is not None:
+        await on_shutdown(dispatcher)
@@ -0,0 +1,65 @@
+import json
+from dataclasses import asdict, dataclass, field
+from typing import List, Tuple
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+@dataclass
+class ConversationSnapshot:
+    """
+    The per-user state of a conversation, everything else is shared and stored by reference.
+
+    The prompt template, the language model settings and the memory settings come from the
+    configuration at ``config_path``, ``config_version`` tells which version of it the
+    conversation was created with.
+
+    Args:
+        config_path: The path of the conversation configuration.
+        config_version: The version of the configuration.
+        context: The persona context of the chatbot.
+        text_style: The texting style of the chatbot.
+        tone: The generated conversation tone.
+        summary: The running summary of the conversation.
+        buffer: The buffered turns of the conversation, not summarized yet.
+        format_version: The version of the snapshot format.
+    """
+
+    config_path: str
+    config_version: str
+    context: str
+    text_style: str
+    tone: str
+    summary: str = ""
+    buffer: List[str] = field(default_factory=list)
+    format_version: int = SNAPSHOT_FORMAT_VERSION
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, data: str) -> "ConversationSnapshot":
+        """
+        Load a snapshot from its json representation.
+
+        Args:
+            data: The json returned by ``to_json``.
+
+        Returns: The snapshot.
+        """
+        fields = json.loads(data)
+        if fields.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format version: {fields.get('format_version')}")
+        return cls(**fields)
+
+
+def decode_snapshots(rows: List[Tuple[str, str]]) -> List[Tuple[str, ConversationSnapshot]]:
+    """
+    Decode the json snapshots of several users, e.g. in a worker process.
+
+    Args:
+        rows: The user IDs and their json snapshots.
+
+    Returns: The user IDs and their snapshots.
+    """
+    return [(user_id, ConversationSnapshot.from_json(data)) for user_id, data in rows]
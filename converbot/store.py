@@ -0,0 +1,102 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Container, Iterable, List, Optional, Tuple
+
+from converbot.snapshot import ConversationSnapshot
+
+
+class ConversationStore:
+    """
+    Embedded SQLite store of conversation snapshots, one row per user.
+
+    The connection can be used from worker threads, every call is serialized by a lock. Several
+    processes can share the file, e.g. the shards of the bot, each writing its own users.
+
+    Args:
+        path: The path of the database file.
+        fsync: Whether every commit waits for the disk (synchronous=FULL), otherwise the
+            write-ahead log is synced at checkpoints only (synchronous=NORMAL).
+    """
+
+    def __init__(self, path: Path, fsync: bool = False) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), timeout=30.0, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS conversations ("
+            "user_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    def save_many(
+        self, snapshots: Iterable[Tuple[str, ConversationSnapshot]], skip: Optional[Container[str]] = None
+    ) -> int:
+        """
+        Insert or replace the snapshots of several users in one transaction.
+
+        Args:
+            snapshots: The user IDs and their snapshots.
+            skip: The user IDs not to save, checked under the lock, e.g. users deleted while the snapshots were encoded.
+
+        Returns: The number of saved snapshots.
+        """
+        now = time.time()
+        rows = [(user_id, snapshot.to_json(), now) for user_id, snapshot in snapshots]
+        with self._lock, self._connection:
+            if skip is not None:
+                rows = [row for row in rows if row[0] not in skip]
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO conversations (user_id, state, updated_at) VALUES (?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def load(self, user_id: str) -> Optional[ConversationSnapshot]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT state FROM conversations WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return None if row is None else ConversationSnapshot.from_json(row[0])
+
+    def load_recent(self, limit: Optional[int] = None) -> List[Tuple[str, str]]:
+        """
+        Read the json snapshots of the most recently saved users, without decoding them.
+
+        Args:
+            limit: The maximum number of snapshots, all of them if not provided.
+
+        Returns: The user IDs and their json snapshots, the most recent first.
+        """
+        with self._lock:
+            return self._connection.execute(
+                "SELECT user_id, state FROM conversations ORDER BY updated_at DESC LIMIT ?",
+                (-1 if limit is None else limit,),
+            ).fetchall()
+
+    def exists(self, user_id: str) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM conversations WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row is not None
+
+    def delete(self, user_id: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+
+    def user_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._connection.execute("SELECT user_id FROM conversations")]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,91 @@
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+import tiktoken
+from langchain.llms.base import BaseLLM
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """
+    Get the tiktoken encoding of the model, loaded once per process.
+
+    Args:
+        model_name: The name of the model.
+
+    Returns: The encoding.
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("gpt2")
+
+
+def get_token_counter(llm: BaseLLM) -> Callable[[str], int]:
+    """
+    Get a function counting the tokens of a text for the language model.
+
+    OpenAI models are counted with their tiktoken encoding, other models with their own
+    ``get_num_tokens``.
+
+    Args:
+        llm: The language model.
+
+    Returns: The token counting function.
+    """
+    model_name: Optional[str] = getattr(llm, "model_name", None)
+    if model_name is None:
+        return llm.get_num_tokens
+
+    def count_tokens(text: str) -> int:
+        return len(get_encoding(model_name).encode(text))
+
+    return count_tokens
+
+
+class MemoizedTokenCount:
+    """
+    Token count of a text that changes rarely, recomputed only when the text changes.
+
+    Args:
+        count_tokens: The token counting function.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int]) -> None:
+        self._count_tokens = count_tokens
+        self._text: Optional[str] = None
+        self._tokens = 0
+
+    def __call__(self, text: str) -> int:
+        if text != self._text:
+            self._text = text
+            self._tokens = self._count_tokens(text) if text else 0
+        return self._tokens
+
+
+class TokenLedger:
+    """
+    Token counts of the lines of a conversation buffer, each line counted once when added.
+
+    Args:
+        count_tokens: The token counting function.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int]) -> None:
+        self._count_tokens = count_tokens
+        self._counts: List[int] = []
+        self.total = 0
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def append(self, line: str) -> None:
+        self._counts.append(self._count_tokens(line))
+        self.total += self._counts[-1]
+
+    def pop_oldest(self) -> None:
+        self.total -= self._counts.pop(0)
+
+    def reset(self, lines: List[str]) -> None:
+        self._counts = [self._count_tokens(line) for line in lines]
+        self.total = sum(self._counts)
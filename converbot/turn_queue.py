@@ -0,0 +1,117 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, TypeVar
+
+from converbot.metrics import observe_stage
+
+T = TypeVar("T")
+
+
+class Turn(NamedTuple):
+    user_input: str
+    response: str
+
+
+class _UserTurns:
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.pending: List[str] = []
+        self.waiting = False
+        # The calls holding or waiting for the lock
+        self.users = 0
+
+
+class TurnQueue:
+    """
+    Run the turns of each user strictly one after another and merge bursts of messages.
+
+    A message that arrives while a turn of the same user is in flight waits for it, and
+    every further message arriving meanwhile is merged into that waiting turn, so a burst
+    of messages costs one completion and the memory is always updated in order. Other
+    changes of the conversation, like commands, run between the turns with ``run_exclusive``.
+
+    Args:
+        separator: The separator used to join merged messages.
+    """
+
+    def __init__(self, separator: str = "\n") -> None:
+        self._separator = separator
+        self._turns: Dict[str, _UserTurns] = {}
+
+        self.turns = 0
+        self.merged_messages = 0
+
+    async def submit(
+        self,
+        user_id: int,
+        message: str,
+        run_turn: Callable[[str], Awaitable[str]],
+    ) -> Optional[Turn]:
+        """
+        Run a turn for the message once the previous turns of the user are done.
+
+        Args:
+            user_id: The user ID.
+            message: The user's message.
+            run_turn: The coroutine function producing the chatbot response to a user input.
+
+        Returns: The turn with the (possibly merged) user input and the response, or None if
+            the message was merged into the turn of another call.
+        """
+        user_id = str(user_id)
+        turns = self._turns.setdefault(user_id, _UserTurns())
+        turns.pending.append(message)
+        if turns.waiting:
+            self.merged_messages += 1
+            return None
+
+        turns.waiting = True
+        turns.users += 1
+        enqueued_at = time.perf_counter()
+        try:
+            async with turns.lock:
+                observe_stage("queue_wait", time.perf_counter() - enqueued_at)
+                turns.waiting = False
+                user_input = self._separator.join(turns.pending)
+                turns.pending = []
+                self.turns += 1
+                response = await run_turn(user_input)
+        finally:
+            self._release(user_id, turns)
+
+        return Turn(user_input=user_input, response=response)
+
+    async def run_exclusive(self, user_id: int, action: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run an action between the turns of the user, e.g. a command changing the conversation.
+
+        The action waits for the turns of the user in flight or already waiting, and the turns
+        of the messages arriving after it wait for the action. No message is merged into it.
+
+        Args:
+            user_id: The user ID.
+            action: The coroutine function to run.
+
+        Returns: The result of the action.
+        """
+        user_id = str(user_id)
+        turns = self._turns.setdefault(user_id, _UserTurns())
+        turns.users += 1
+        try:
+            async with turns.lock:
+                return await action()
+        finally:
+            self._release(user_id, turns)
+
+    def _release(self, user_id: str, turns: _UserTurns) -> None:
+        turns.users -= 1
+        if turns.users == 0 and self._turns.get(user_id) is turns:
+            del self._turns[user_id]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "turns": self.turns,
+            "merged_messages": self.merged_messages,
+            "active_users": len(self._turns),
+        }
@@ -1,11 +1,23 @@
 import os
+from typing import Optional
 
-from langchain import PromptTemplate, LLMChain, OpenAI
+from langchain.llms.base import BaseLLM
 
+from converbot.chain_handler import CachedChainHandler
+from converbot.resilience import RetryPolicy
 
-class ConversationTextStyleHandler:
 
-    def __init__(self):
+class ConversationTextStyleHandler(CachedChainHandler):
+    cache_namespace = "text_style"
+
+    def __init__(
+        self,
+        llm: Optional[BaseLLM] = None,
+        cache_size: int = 0,
+        max_batch_size: int = 0,
+        max_batch_wait: float = 0.05,
+        call_policy: Optional[RetryPolicy] = None,
+    ):
         prompt_template = """Describe the texting style. 
         
         Example:
@@ -76,17 +88,71 @@ class ConversationTextStyleHandler:
         Context: {user_input}
         Texting style:
         """
-        prompt_template = PromptTemplate(input_variables=["user_input"], template=prompt_template)
-
-        self._chain = LLMChain(
-            llm=OpenAI(),
-            prompt=prompt_template,
-            verbose=False,
+        super().__init__(
+            prompt_template,
+            llm=llm,
+            cache_size=cache_size,
+            max_batch_size=max_batch_size,
+            max_batch_wait=max_batch_wait,
+            call_policy=call_policy,
         )
 
-    def __call__(self, user_input: str) -> str:
-        #print('txtstyle user_input',user_input)
-        return self._chain.predict(user_input=user_input)
+
+
+def refinement_input(text_style: str, personality: str) -> str:
+    return f"Texting style: {text_style.strip()}\nPersonality: {personality.strip()}"
+
+
+class ConversationTextStyleRefinementHandler(CachedChainHandler):
+    """
+    Adjust a texting style drafted without the personality of the persona to its personality.
+
+    The input is made by ``refinement_input``.
+    """
+
+    cache_namespace = "text_style_refinement"
+
+    def __init__(
+        self,
+        llm: Optional[BaseLLM] = None,
+        cache_size: int = 0,
+        max_batch_size: int = 0,
+        max_batch_wait: float = 0.05,
+        call_policy: Optional[RetryPolicy] = None,
+    ):
+        prompt_template = """Adjust the texting style to the personality.
+
+        Example:
+
+        Texting style: John's writing style is professional yet concise. He likes to get straight to the
+        point and does not waste time with unnecessary pleasantries or small talk. He uses formal language and proper
+        grammar, but he does not come across as stuffy or overly formal. John is single and open to meeting someone new.
+        Personality: playful and a bit of a flirt
+
+        Texting style: John's writing style is concise and playful. He gets to the point quickly but likes to tease
+        and throw in a light joke or a flirty compliment. He uses proper grammar, with the odd winking emoji 😉 to
+        keep things light. John is single and open to meeting someone new.
+
+        Texting style: Lily's writing style is creative and expressive. She has a poetic way of expressing herself
+        and uses vivid imagery to bring her stories to life. Lily is single and often jokes about it.
+        Personality: shy and anxious
+
+        Texting style: Lily's writing style is creative but hesitant. She writes short, careful messages, often
+        trailing off with "..." and softening what she says with "maybe" or "I guess". When she feels comfortable she
+        opens up with vivid imagery. Lily is single and often jokes about it.
+
+        {user_input}
+
+        Texting style:
+        """
+        super().__init__(
+            prompt_template,
+            llm=llm,
+            cache_size=cache_size,
+            max_batch_size=max_batch_size,
+            max_batch_wait=max_batch_wait,
+            call_policy=call_policy,
+        )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+import asyncio
+import hmac
+from typing import Dict, Optional, Set
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+from converbot.sharding import DispatcherHook
+
+OVERFLOW_POLICIES = ("retry", "drop")
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Webhook endpoint feeding the updates to the dispatcher through a bounded intake queue.
+
+    At most ``max_in_flight`` updates are handled at once, the others wait in the queue. When the
+    queue is full a request waits up to ``intake_timeout`` seconds for room, then the update is
+    shed: with the "retry" policy Telegram gets a 503 and delivers it again later, with the
+    "drop" policy it is acknowledged and discarded.
+
+    With a secret token, the one given to ``set_webhook``, requests without it in the
+    ``X-Telegram-Bot-Api-Secret-Token`` header get a 401: only Telegram can send updates.
+    Bodies that are not an update get a 400. Until the bot is started, and once it is
+    stopping, updates get a 503 so Telegram delivers them again later. ``/health`` answers as long as the process serves requests, ``/ready`` only
+    while the bot is started and the intake queue has room, so a load balancer stops sending
+    traffic to a saturated instance.
+
+    Args:
+        dispatcher: The dispatcher handling the updates.
+        path: The path of the webhook endpoint.
+        max_in_flight: The maximum number of updates handled at once.
+        queue_size: The maximum number of updates waiting to be handled.
+        intake_timeout: The maximum number of seconds a request waits for room in a full queue.
+        overflow: What to do with an update that found no room, "retry" or "drop".
+        retry_after: The number of seconds Telegram is asked to wait before a retry.
+        secret_token: The secret token of the webhook, requests are not authenticated if not provided.
+        on_startup: Called with the dispatcher before the first update.
+        on_shutdown: Called with the dispatcher after the last update.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        path: str = "/webhook",
+        max_in_flight: int = 100,
+        queue_size: int = 1000,
+        intake_timeout: float = 1.0,
+        overflow: str = "retry",
+        retry_after: int = 5,
+        secret_token: Optional[str] = None,
+        on_startup: DispatcherHook = None,
+        on_shutdown: DispatcherHook = None,
+    ) -> None:
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}, expected one of {OVERFLOW_POLICIES}")
+        self._dispatcher = dispatcher
+        self._path = path
+        self._max_in_flight = max_in_flight
+        self._intake_timeout = intake_timeout
+        self._overflow = overflow
+        self._retry_after = retry_after
+        self._secret_token = secret_token
+        self._on_startup = on_startup
+        self._on_shutdown = on_shutdown
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._in_flight: Set[asyncio.Task] = set()
+        self._consumer: Optional[asyncio.Task] = None
+        self._ready = False
+
+        self.accepted = 0
+        self.delayed = 0
+        self.shed = 0
+        self.not_ready = 0
+        self.unauthorized = 0
+        self.malformed = 0
+        self.handled = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self._path, self._handle_webhook)
+        app.router.add_get("/health", self._handle_health)
+        app.router.add_get("/ready", self._handle_ready)
+        app.on_startup.append(self._start)
+        app.on_shutdown.append(self._stop)
+        return app
+
+    async def _start(self, app: web.Application) -> None:
+        Bot.set_current(self._dispatcher.bot)
+        Dispatcher.set_current(self._dispatcher)
+        if self._on_startup is not None:
+            await self._on_startup(self._dispatcher)
+        self._consumer = asyncio.ensure_future(self._consume())
+        self._ready = True
+
+    async def _stop(self, app: web.Application) -> None:
+        # Stop taking traffic, then finish the updates already accepted
+        self._ready = False
+        await self._queue.join()
+        if self._consumer is not None:
+            self._consumer.cancel()
+        if self._on_shutdown is not None:
+            await self._on_shutdown(self._dispatcher)
+
+    async def _consume(self) -> None:
+        semaphore = asyncio.Semaphore(self._max_in_flight)
+        while True:
+            update = await self._queue.get()
+            await semaphore.acquire()
+            # Every update runs in its own task, the state filters of aiogram are bound to the task
+            task = asyncio.ensure_future(self._process(update))
+            self._in_flight.add(task)
+            task.add_done_callback(lambda done: (self._in_flight.discard(done), semaphore.release()))
+
+    async def _process(self, update: types.Update) -> None:
+        try:
+            await self._dispatcher.process_update(update)
+        except Exception as e:
+            print(e)
+        finally:
+            self.handled += 1
+            self._queue.task_done()
+
+    def _retry_later(self) -> web.Response:
+        return web.Response(status=503, headers={"Retry-After": str(self._retry_after)})
+
+    def _is_authorized(self, request: web.Request) -> bool:
+        if self._secret_token is None:
+            return True
+        token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        return hmac.compare_digest(token.encode("utf-8"), self._secret_token.encode("utf-8"))
+
+    async def _handle_webhook(self, request: web.Request) -> web.Response:
+        if not self._is_authorized(request):
+            self.unauthorized += 1
+            return web.Response(status=401)
+        if not self._ready:
+            # Nothing consumes the queue before the startup and after the shutdown
+            self.not_ready += 1
+            return self._retry_later()
+        try:
+            update = types.Update(**(await request.json()))
+        except (ValueError, TypeError):
+            # Not json, or not a json object
+            self.malformed += 1
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.delayed += 1
+            try:
+                await asyncio.wait_for(self._queue.put(update), timeout=self._intake_timeout)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                if self._overflow == "retry":
+                    return self._retry_later()
+                return web.Response()
+        self.accepted += 1
+        return web.Response()
+
+    async def _handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def _handle_ready(self, request: web.Request) -> web.Response:
+        ready = self._ready and not self._queue.full()
+        return web.json_response({"ready": ready, **self.stats}, status=200 if ready else 503)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self._queue.qsize(),
+            "in_flight": len(self._in_flight),
+            "accepted": self.accepted,
+            "delayed": self.delayed,
+            "shed": self.shed,
+            "not_ready": self.not_ready,
+            "unauthorized": self.unauthorized,
+            "malformed": self.malformed,
+            "handled": self.handled,
+        }